@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# generate.py -*-python-*-
+
+# Synthetic data for the benchmarks: file trees for --scan and tape
+# manifests (md5sum.txt and stat.txt) for --load. Everything is derived from
+# a seed, so two runs with the same parameters produce the same data.
+
+import argparse
+import hashlib
+import math
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# pylint: disable=unused-import,wrong-import-position
+from urfiles.log import DEBUG, INFO, ERROR, FATAL
+
+
+def _directories(depth, fanout):
+    directories = ['']
+    level = ['']
+    for _ in range(depth):
+        level = [os.path.join(parent, 'd{:03d}'.format(idx))
+                 for parent in level for idx in range(fanout)]
+        directories.extend(level)
+    return directories
+
+
+def _size(rng, median, sigma, max_size):
+    # File sizes in real trees are roughly log-normal: many small files and
+    # a long tail of large ones.
+    return min(int(rng.lognormvariate(math.log(median), sigma)), max_size)
+
+
+def make_tree(root, files=1000, depth=3, fanout=4, median=16384, sigma=2.0,
+              max_size=2**26, duplicates=0.1, seed=0):
+    rng = random.Random(seed)
+    directories = _directories(depth, fanout)
+    for directory in directories:
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+
+    written = []
+    total = 0
+    for idx in range(files):
+        path = os.path.join(root, rng.choice(directories),
+                            'f{:07d}.dat'.format(idx))
+        if written and rng.random() < duplicates:
+            data = rng.choice(written)
+        else:
+            data = rng.randbytes(_size(rng, median, sigma, max_size))
+            # Only small files are kept as candidates for duplication, to
+            # bound memory use.
+            if len(data) < 2**20:
+                written.append(data)
+        with open(path, 'wb') as fp:
+            fp.write(data)
+        total += len(data)
+    return {'files': files, 'directories': len(directories), 'bytes': total}
+
+
+def make_manifest(directory, lines=1000000, duplicates=0.1, depth=3,
+                  fanout=8, median=16384, sigma=2.0, max_size=2**36, seed=0,
+                  salt=''):
+    # The paths are generated in sorted order, as they would be after the
+    # sort in the README. md5sum.txt is not sorted by hash, which Load does
+    # not need. The md5s depend only on the line number and salt, so two
+    # manifests with the same salt share their content.
+    rng = random.Random(seed)
+    label = os.path.basename(os.path.normpath(directory))
+    directories = sorted(_directories(depth, fanout))
+    per_directory = max(-(-lines // len(directories)), 1)
+    os.makedirs(directory, exist_ok=True)
+    md5s = []
+    count = 0
+    with open(os.path.join(directory, 'md5sum.txt'), 'w') as md5fp, \
+         open(os.path.join(directory, 'stat.txt'), 'w') as statfp:
+        for subdir in directories:
+            for idx in range(per_directory):
+                if count >= lines:
+                    break
+                path = os.path.join(label, subdir, 'f{:07d}.dat'.format(idx))
+                if md5s and rng.random() < duplicates:
+                    md5 = rng.choice(md5s)
+                else:
+                    md5 = hashlib.md5(
+                        (salt + str(count)).encode()).hexdigest()
+                    if len(md5s) < 100000:
+                        md5s.append(md5)
+                size = _size(rng, median, sigma, max_size)
+                mtime = 1500000000 + rng.randrange(200000000)
+                ns = rng.randrange(1000000000)
+                stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(mtime))
+                md5fp.write('{} {}\n'.format(md5, path))
+                statfp.write('{} r 644 {} 1000 1000 {} {}.{:09d} +0000\n'.
+                             format(path, size, mtime, stamp, ns))
+                count += 1
+    return {'lines': count}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='urfiles benchmark data')
+    parser.add_argument('--tree', default=None, metavar=('DIR'),
+                        help='Create a file tree in DIR')
+    parser.add_argument('--manifest', default=None, metavar=('DIR'),
+                        help='Create md5sum.txt and stat.txt in DIR')
+    parser.add_argument('--files', type=int, default=1000,
+                        help='Number of files (or manifest lines)')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='Directory depth')
+    parser.add_argument('--fanout', type=int, default=4,
+                        help='Subdirectories per directory')
+    parser.add_argument('--median', type=int, default=16384,
+                        help='Median file size in bytes')
+    parser.add_argument('--sigma', type=float, default=2.0,
+                        help='Spread of the log-normal size distribution')
+    parser.add_argument('--duplicates', type=float, default=0.1,
+                        help='Fraction of files that duplicate another')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed')
+    args = parser.parse_args()
+
+    if args.tree:
+        INFO('%s', make_tree(args.tree, files=args.files, depth=args.depth,
+                             fanout=args.fanout, median=args.median,
+                             sigma=args.sigma, duplicates=args.duplicates,
+                             seed=args.seed))
+    if args.manifest:
+        INFO('%s', make_manifest(args.manifest, lines=args.files,
+                                 depth=args.depth, fanout=args.fanout,
+                                 median=args.median, sigma=args.sigma,
+                                 duplicates=args.duplicates, seed=args.seed))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
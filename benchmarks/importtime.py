@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# importtime.py -*-python-*-
+
+# Checks the cold start of urfiles commands with python -X importtime: each
+# command is run against a throwaway SQLite database, and fails if its
+# imports take longer than a budget, or if it imports a module that it
+# should not need (e.g., magic or psycopg2 for a search). Exits non-zero on
+# failure, so that it can be run before a commit:
+#
+#     python3 benchmarks/importtime.py --budget 75
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+import generate
+
+# Arguments for each command, and the modules it must not import.
+COMMANDS = {
+    'search': (['--re', 'x', '--no-server'],
+               ['magic', 'pymediainfo', 'psycopg2', 'multiprocessing',
+                'urfiles.identify', 'urfiles.scan', 'urfiles.server']),
+    'show-config': (['--show-config'],
+                    ['magic', 'pymediainfo', 'psycopg2', 'humanize',
+                     'urfiles.db', 'urfiles.format']),
+    'info': (['--info'],
+             ['magic', 'pymediainfo', 'humanize', 'urfiles.identify',
+              'urfiles.format']),
+}
+
+# Lines of -X importtime output: self and cumulative microseconds, and the
+# module name, indented by its depth in the import tree.
+LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$')
+
+
+def importtime(configfile, arguments):
+    # Returns the total import time in ms, and the modules imported.
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime',
+         os.path.join(generate.ROOT, 'bin', 'urfiles'),
+         '--config', configfile] + arguments,
+        cwd=generate.ROOT, capture_output=True, text=True, check=False)
+    if proc.returncode != 0:
+        print(proc.stderr, file=sys.stderr)
+        raise SystemExit('urfiles {} failed'.format(' '.join(arguments)))
+    total = 0
+    modules = set()
+    for line in proc.stderr.splitlines():
+        match = LINE.match(line)
+        if match is None:
+            continue
+        modules.add(match.group(4))
+        if match.group(3) == '':
+            total += int(match.group(2))
+    return total / 1000, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description='urfiles import times')
+    parser.add_argument('--command', default=None, nargs='+',
+                        choices=list(COMMANDS), help='Commands to check')
+    parser.add_argument('--budget', type=float, default=75.0,
+                        metavar=('MS'),
+                        help='Maximum import time for each command')
+    parser.add_argument('--runs', type=int, default=5, metavar=('N'),
+                        help='Run each command N times and use the fastest')
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory(prefix='urfiles-importtime-') as tmpdir:
+        configfile = os.path.join(tmpdir, 'urfiles.cfg')
+        with open(configfile, 'w') as fp:
+            fp.write('[urfiles]\nbackend = sqlite\n[sqlite]\n'
+                     'database = {}\n[serve]\nsocket = {}\n'.format(
+                         os.path.join(tmpdir, 'urfiles.sqlite'),
+                         os.path.join(tmpdir, 'serve.sock')))
+        importtime(configfile, ['--init'])
+
+        for command in args.command if args.command else COMMANDS:
+            arguments, forbidden = COMMANDS[command]
+            best = None
+            for _ in range(args.runs):
+                total, modules = importtime(configfile, arguments)
+                best = total if best is None else min(best, total)
+            unwanted = sorted(modules.intersection(forbidden))
+            ok = best <= args.budget and not unwanted
+            failed = failed or not ok
+            print('{:<12s} {:8.1f}ms {}{}'.format(
+                command, best, 'ok' if ok else 'FAILED',
+                ' (imports {})'.format(', '.join(unwanted))
+                if unwanted else ''))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
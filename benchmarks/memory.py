@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# memory.py -*-python-*-
+
+# Measures the peak memory (maximum resident set size) of --load, which
+# must stay bounded for tapes with tens of millions of files. A synthetic
+# manifest is loaded into a throwaway SQLite database twice: the first load
+# inserts every row, and the second finds every path and md5 already known.
+# The results are written as JSON, so that two commits can be compared:
+#
+#     python3 benchmarks/memory.py --lines 20000000 --output new.json
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import generate
+
+
+def load(configfile, directory):
+    # Returns the elapsed time, and the peak RSS of the load in MB.
+    start = time.perf_counter()
+    with tempfile.TemporaryFile('w+') as stderr:
+        proc = subprocess.Popen(
+            [sys.executable, os.path.join(generate.ROOT, 'bin', 'urfiles'),
+             '--config', configfile, '--load', directory],
+            cwd=generate.ROOT, stdout=subprocess.DEVNULL, stderr=stderr)
+        # wait4 gives the resource usage of this child alone.
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        elapsed = time.perf_counter() - start
+        if proc.returncode != 0:
+            stderr.seek(0)
+            print(stderr.read(), file=sys.stderr)
+            raise SystemExit('urfiles --load failed')
+    # ru_maxrss is in kB.
+    return elapsed, rusage.ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description='urfiles --load memory')
+    parser.add_argument('--lines', type=int, default=1000000, metavar=('N'),
+                        help='Number of lines in the manifest')
+    parser.add_argument('--output', default=None, metavar=('FILE'),
+                        help='Write the results as JSON to FILE')
+    args = parser.parse_args()
+
+    commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                            cwd=generate.ROOT, capture_output=True,
+                            text=True, check=False).stdout.strip()
+    results = {'commit': commit, 'lines': args.lines, 'loads': {}}
+    with tempfile.TemporaryDirectory(prefix='urfiles-memory-') as tmpdir:
+        configfile = os.path.join(tmpdir, 'urfiles.cfg')
+        with open(configfile, 'w') as fp:
+            fp.write('[urfiles]\nbackend = sqlite\n[sqlite]\n'
+                     'database = {}\n'.format(
+                         os.path.join(tmpdir, 'urfiles.sqlite')))
+        subprocess.run([sys.executable,
+                        os.path.join(generate.ROOT, 'bin', 'urfiles'),
+                        '--config', configfile, '--init'],
+                       cwd=generate.ROOT, capture_output=True, check=True)
+        directory = os.path.join(tmpdir, 'TAPE0001')
+        generate.make_manifest(directory, lines=args.lines)
+
+        for name in ['first', 'reload']:
+            elapsed, peak = load(configfile, directory)
+            results['loads'][name] = {'seconds': round(elapsed, 2),
+                                      'max_rss_mb': round(peak, 1)}
+            print('{:<8s} {:8.2f}s {:8.1f}MB'.format(name, elapsed, peak))
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+            fp.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
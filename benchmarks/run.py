@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# run.py -*-python-*-
+
+# Timed scenarios for Scan.scan, Load.load, Identify.id, Search.re and
+# Format.pretty_print. Each run uses a throwaway SQLite database in a
+# temporary directory and writes its results as JSON, so that the results
+# for two commits can be compared with --compare.
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import generate
+
+# pylint: disable=wrong-import-position,wrong-import-order
+import urfiles.config
+import urfiles.db
+from urfiles.log import PDLOG_SET_LEVEL, DEBUG, INFO, ERROR, FATAL
+
+SCENARIOS = ['scan', 'rescan', 'load', 'load_shared', 'identify',
+             'search', 'format']
+
+
+class Benchmark():
+    def __init__(self, workdir, files=1000, lines=100000, workers=3,
+                 seed=0):
+        self.workdir = workdir
+        self.files = files
+        self.lines = lines
+        self.workers = workers
+        self.seed = seed
+        self.results = dict()
+        self.tree = os.path.join(workdir, 'tree')
+        self.manifest = os.path.join(workdir, 'TAPE0001')
+        self.search_result = None
+
+        configfile = os.path.join(workdir, 'urfiles.cfg')
+        with open(configfile, 'w') as fp:
+            fp.write('[urfiles]\nbackend = sqlite\n[sqlite]\n'
+                     'database = {}\n'.format(os.path.join(workdir,
+                                                           'urfiles.sqlite')))
+        self.config = urfiles.config.Config([configfile])
+        urfiles.db.DB(self.config.config).maybe_create()
+
+    def _time(self, name, items, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        seconds = time.perf_counter() - start
+        self.results[name] = {'seconds': seconds,
+                              'items': items,
+                              'per_second': items / seconds if seconds else 0}
+        print('{:<10s} {:8.3f}s {:10d} items {:12.1f}/s'.format(
+            name, seconds, items, self.results[name]['per_second']),
+              file=sys.stderr)
+        return result
+
+    def _tree_files(self):
+        paths = []
+        for dirpath, _, filenames in os.walk(self.tree):
+            paths.extend(os.path.join(dirpath, filename)
+                         for filename in filenames)
+        return sorted(paths)
+
+    def scan(self):
+        import urfiles.scan
+        if not os.path.isdir(self.tree):
+            generate.make_tree(self.tree, files=self.files, seed=self.seed)
+        scan = urfiles.scan.Scan([self.tree], self.config, source='bench',
+                                 max_workers=self.workers, precount=False)
+        self._time('scan', self.files, scan.scan)
+
+    def rescan(self):
+        # A second scan of an unchanged tree only does path lookups.
+        import urfiles.scan
+        scan = urfiles.scan.Scan([self.tree], self.config, source='bench',
+                                 max_workers=self.workers, precount=False)
+        self._time('rescan', self.files, scan.scan)
+
+    def load(self):
+        import urfiles.load
+        generate.make_manifest(self.manifest, lines=self.lines,
+                               seed=self.seed)
+        load = urfiles.load.Load([self.manifest], self.config)
+        self._time('load', self.lines, load.load)
+
+    def load_shared(self):
+        # One --load of two tapes with the same content, none of it in the
+        # database yet: its md5s must be written to meta only once.
+        import urfiles.load
+        directories = [os.path.join(self.workdir, label)
+                       for label in ['TAPE0002', 'TAPE0003']]
+        for directory in directories:
+            generate.make_manifest(directory, lines=self.lines,
+                                   seed=self.seed, salt='shared')
+        db = urfiles.db.DB(self.config.config)
+        conn = db.connect()
+        before = conn.execute('select count(*) from meta').fetchone()[0]
+        load = urfiles.load.Load(directories, self.config)
+        self._time('load_shared', 2 * self.lines, load.load)
+        after = conn.execute('select count(*) from meta').fetchone()[0]
+        conn.close()
+        if load.meta_count != after - before:
+            FATAL('load_shared wrote %d meta rows for %d new md5s',
+                  load.meta_count, after - before)
+
+    def identify(self):
+        import urfiles.identify
+        if not os.path.isdir(self.tree):
+            generate.make_tree(self.tree, files=self.files, seed=self.seed)
+        paths = self._tree_files()
+
+        def identify_all():
+            for path in paths:
+                urfiles.identify.Identify(path).id()
+        self._time('identify', len(paths), identify_all)
+
+    def search(self):
+        import urfiles.search
+        search = urfiles.search.Search('/d00[0-3]/.*f00000[0-9]',
+                                       self.config)
+        self.search_result = self._time('search', self.lines, search.re)
+
+    def format(self):
+        import urfiles.format
+        if self.search_result is None:
+            self.search()
+        matches, meta = self.search_result
+        fmt = urfiles.format.Format()
+        self._time('format', len(matches), fmt.pretty_print, matches, meta)
+
+    def run(self, scenarios):
+        for scenario in scenarios:
+            getattr(self, scenario)()
+        return self.results
+
+
+def _commit():
+    try:
+        proc = subprocess.run(['git', 'describe', '--always', '--dirty'],
+                              cwd=generate.ROOT, capture_output=True,
+                              text=True, check=False)
+    except OSError:
+        return None
+    return proc.stdout.strip() if proc.returncode == 0 else None
+
+
+def compare(old_file, new_file):
+    with open(old_file) as fp:
+        old = json.load(fp)
+    with open(new_file) as fp:
+        new = json.load(fp)
+    print('{:<10s} {:>10s} {:>10s} {:>8s}'.format(
+        'scenario', old.get('commit') or 'old', new.get('commit') or 'new',
+        'ratio'))
+    for name, result in new['scenarios'].items():
+        if name not in old['scenarios']:
+            continue
+        before = old['scenarios'][name]['seconds']
+        after = result['seconds']
+        print('{:<10s} {:>9.3f}s {:>9.3f}s {:>7.2f}x'.format(
+            name, before, after, before / after if after else 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='urfiles benchmarks')
+    parser.add_argument('--scenario', default=None, nargs='+',
+                        choices=SCENARIOS, help='Scenarios to run')
+    parser.add_argument('--files', type=int, default=1000,
+                        help='Files in the synthetic tree')
+    parser.add_argument('--lines', type=int, default=100000,
+                        help='Lines in the synthetic tape manifest')
+    parser.add_argument('--workers', type=int, default=3,
+                        help='Scan workers')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed for the synthetic data')
+    parser.add_argument('--workdir', default=None, metavar=('DIR'),
+                        help='Keep the data in DIR instead of a temporary'
+                        ' directory')
+    parser.add_argument('--output', default=None, metavar=('FILE'),
+                        help='Write JSON results to FILE (default: stdout)')
+    parser.add_argument('--compare', default=None, nargs=2,
+                        metavar=('OLD', 'NEW'),
+                        help='Compare two JSON result files and exit')
+    parser.add_argument('--debug', action='store_true', default=False,
+                        help='Output urfiles log messages')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return 0
+
+    if not args.debug:
+        PDLOG_SET_LEVEL('ERROR')
+
+    with tempfile.TemporaryDirectory(prefix='urfiles-bench-') as tmpdir:
+        workdir = args.workdir if args.workdir else tmpdir
+        os.makedirs(workdir, exist_ok=True)
+        benchmark = Benchmark(workdir, files=args.files, lines=args.lines,
+                              workers=args.workers, seed=args.seed)
+        scenarios = args.scenario if args.scenario else SCENARIOS
+        results = {
+            'commit': _commit(),
+            'time': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'parameters': {'files': args.files, 'lines': args.lines,
+                           'workers': args.workers, 'seed': args.seed},
+            'scenarios': benchmark.run(scenarios),
+        }
+
+    output = json.dumps(results, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(output + '\n')
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
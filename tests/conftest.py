@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# conftest.py -*-python-*-
+
+# Fixtures shared by the tests. Each test gets a throwaway SQLite database
+# and search cache in its own temporary directory, as benchmarks/run.py
+# does, so the tests need no PostgreSQL server.
+
+import pytest
+
+import urfiles.config
+import urfiles.db
+
+
+@pytest.fixture
+def config(tmp_path):
+    configfile = tmp_path / 'urfiles.cfg'
+    configfile.write_text('[urfiles]\nbackend = sqlite\n'
+                          '[sqlite]\ndatabase = {0}/urfiles.sqlite\n'
+                          '[cache]\npath = {0}/cache/search.sqlite\n'
+                          '[identify]\ntimeout = 10\n'.format(tmp_path))
+    config = urfiles.config.Config([str(configfile)])
+    assert urfiles.db.DB(config.config).maybe_create()
+    return config
+
+
+@pytest.fixture
+def db(config):
+    # A backend and a connection to it, closed after the test.
+    db = urfiles.db.DB(config.config)
+    conn = db.connect()
+    yield db, conn
+    conn.close()
+
+
+def make_tree(root, names):
+    # Creates root/name for each name, with the name as its content, and
+    # returns the paths.
+    paths = []
+    for name in names:
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(name)
+        paths.append(str(path))
+    return paths
+
+
+def paths(db, conn):
+    return {row[0] for row in db.iter_paths(conn)}
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# test_archive.py -*-python-*-
+
+import random
+import tarfile
+import time
+import zipfile
+
+import urfiles.archive
+
+from conftest import make_tree, paths
+
+SEPARATOR = urfiles.archive.Archive.SEPARATOR
+
+
+def _members(tmp_path, count=3):
+    # Members with enough text to be compressed, so that damage to one of
+    # them shows up when it is read.
+    rng = random.Random(0)
+    names = ['m/f{}'.format(i) for i in range(count)]
+    make_tree(tmp_path, names)
+    for name in names:
+        (tmp_path / name).write_text(
+            '\n'.join(str(rng.random()) for _ in range(2000)))
+    return names
+
+
+def _scan(config, archives):
+    archive = urfiles.archive.Archive([str(path) for path in archives],
+                                      config)
+    archive.scan()
+    return archive.progress.counts
+
+
+def test_members_can_be_looked_up(config, db, tmp_path, monkeypatch):
+    db, conn = db
+    monkeypatch.chdir(tmp_path)
+    names = _members(tmp_path)
+    with tarfile.open(tmp_path / 'a.tar.gz', 'w:gz') as tar:
+        for name in names:
+            tar.add(name)
+    with zipfile.ZipFile(tmp_path / 'a.zip', 'w', zipfile.ZIP_DEFLATED) \
+            as zf:
+        for name in names:
+            zf.write(name)
+
+    counts = _scan(config, [tmp_path / 'a.tar.gz', tmp_path / 'a.zip'])
+    assert counts['new'] == 2 * len(names)
+    assert counts['errors'] == 0
+
+    with tarfile.open(tmp_path / 'a.tar.gz') as tar:
+        for member in tar.getmembers():
+            path = str(tmp_path / 'a.tar.gz') + SEPARATOR + member.name
+            assert db.lookup_path(conn, path, member.size,
+                                  int(member.mtime) * 10**9) is not None
+    with zipfile.ZipFile(tmp_path / 'a.zip') as zf:
+        for info in zf.infolist():
+            path = str(tmp_path / 'a.zip') + SEPARATOR + info.filename
+            mtime_ns = int(time.mktime(info.date_time + (0, 0, -1))) * \
+                10**9
+            assert db.lookup_path(conn, path, info.file_size,
+                                  mtime_ns) is not None
+
+    # A second scan finds every member.
+    counts = _scan(config, [tmp_path / 'a.tar.gz', tmp_path / 'a.zip'])
+    assert counts['unchanged'] == 2 * len(names)
+    assert counts['new'] == 0
+
+
+def test_bad_zip_member_is_skipped(config, db, tmp_path, monkeypatch):
+    db, conn = db
+    monkeypatch.chdir(tmp_path)
+    names = _members(tmp_path)
+    archive = tmp_path / 'bad.zip'
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name in names:
+            zf.write(name)
+        info = zf.getinfo(names[1])
+    # Damage the data of the second member.
+    data = bytearray(archive.read_bytes())
+    start = info.header_offset + 30 + len(info.filename) + 100
+    for offset in range(start, start + 50):
+        data[offset] ^= 0xff
+    archive.write_bytes(bytes(data))
+
+    counts = _scan(config, [archive])
+    assert counts['errors'] == 1
+    assert paths(db, conn) == {str(archive) + SEPARATOR + name
+                               for name in [names[0], names[2]]}
+
+
+def test_truncated_tar_keeps_members_read(config, db, tmp_path,
+                                          monkeypatch):
+    db, conn = db
+    monkeypatch.chdir(tmp_path)
+    names = _members(tmp_path)
+    archive = tmp_path / 'a.tar.gz'
+    with tarfile.open(archive, 'w:gz') as tar:
+        for name in names:
+            tar.add(name)
+    data = archive.read_bytes()
+    truncated = tmp_path / 'truncated.tar.gz'
+    truncated.write_bytes(data[:len(data) // 2])
+
+    counts = _scan(config, [truncated])
+    assert counts['errors'] >= 1
+    assert str(truncated) + SEPARATOR + names[0] in paths(db, conn)
+    assert str(truncated) + SEPARATOR + names[2] not in paths(db, conn)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# test_scan.py -*-python-*-
+
+import json
+import os
+
+import pytest
+
+import urfiles.identify
+import urfiles.scan
+
+from conftest import make_tree, paths
+
+
+def _scan(config, tree, journal, **kwargs):
+    scan = urfiles.scan.Scan([str(tree)], config, journal=str(journal),
+                             max_workers=2, precount=False, **kwargs)
+    scan.scan()
+    return scan
+
+
+def _write_journal(journal, tree, records):
+    header = {'directories': [str(tree)], 'source': '', 'spool': None}
+    with open(journal, 'w') as fp:
+        for record in [['header', header]] + records:
+            fp.write(json.dumps(record) + '\n')
+
+
+def test_resume_scans_only_pending_directories(config, db, tmp_path):
+    tree = tmp_path / 'tree'
+    make_tree(tree, ['top', 'a/done', 'b/pending', 'b/c/below'])
+    journal = tmp_path / 'scan.journal'
+    # A scan that was interrupted after it had completed the top directory
+    # and a, but not b.
+    _write_journal(journal, tree, [['queued', str(tree)],
+                                   ['queued', str(tree / 'a')],
+                                   ['queued', str(tree / 'b')],
+                                   ['completed', str(tree)],
+                                   ['completed', str(tree / 'a')]])
+
+    _scan(config, tree, journal, resume=True)
+    assert paths(*db) == {str(tree / 'b/pending'), str(tree / 'b/c/below')}
+    with open(journal) as fp:
+        assert json.loads(fp.readlines()[-1]) == ['done']
+
+
+def test_resume_without_journal_scans_everything(config, db, tmp_path):
+    tree = tmp_path / 'tree'
+    files = make_tree(tree, ['top', 'a/one', 'b/two'])
+    _scan(config, tree, tmp_path / 'scan.journal', resume=True)
+    assert paths(*db) == set(files)
+
+
+def test_resume_rejects_journal_of_another_scan(config, tmp_path):
+    tree = tmp_path / 'tree'
+    make_tree(tree, ['top'])
+    journal = tmp_path / 'scan.journal'
+    _write_journal(journal, tmp_path / 'elsewhere', [])
+    with pytest.raises(SystemExit):
+        _scan(config, tree, journal, resume=True)
+
+
+def _exiftool(bindir, script):
+    # Puts a stand-in for exiftool that runs script first on PATH.
+    bindir.mkdir(exist_ok=True)
+    exiftool = bindir / 'exiftool'
+    exiftool.write_text('#!/bin/sh\n{}\n'.format(script))
+    exiftool.chmod(0o755)
+
+
+def _row(db, conn, path):
+    # The (size, mtime_ns, md5) recorded for path.
+    for row in db.iter_paths(conn):
+        if row[0] == path:
+            return row[2], row[3], row[4]
+    return None
+
+
+def test_quarantine_and_retry(config, db, tmp_path, monkeypatch):
+    db, conn = db
+    tree = tmp_path / 'tree'
+    [path] = make_tree(tree, ['a.txt'])
+    journal = tmp_path / 'scan.journal'
+    bindir = tmp_path / 'bin'
+    monkeypatch.setenv('PATH', '{}:{}'.format(bindir, os.environ['PATH']))
+
+    # A crash quarantines the file, but its path and the metadata of the
+    # other extractors are still recorded.
+    _exiftool(bindir, 'kill -SEGV $$')
+    _scan(config, tree, journal)
+    size, mtime_ns, md5 = _row(db, conn, path)
+    assert 'signal' in db.lookup_quarantine(conn, path, size, mtime_ns)
+    metadata = db.lookup_meta(conn, md5)
+    assert 'magic' in metadata
+    assert 'extractor_version' not in metadata
+
+    # An unchanged file is not tried again.
+    _exiftool(bindir, "echo '[{}]'")
+    _scan(config, tree, journal)
+    assert db.lookup_quarantine(conn, path, size, mtime_ns) is not None
+
+    # Unless the quarantine is retried, which completes its metadata.
+    _scan(config, tree, journal, retry=True)
+    assert db.lookup_quarantine(conn, path, size, mtime_ns) is None
+    metadata = db.lookup_meta(conn, md5)
+    assert metadata['extractor_version'] == urfiles.identify.Identify.VERSION
+
+
+def test_missing_extractor_does_not_quarantine(config, db, tmp_path,
+                                               monkeypatch):
+    db, conn = db
+    tree = tmp_path / 'tree'
+    files = make_tree(tree, ['a.txt', 'b.txt'])
+    # Nothing on PATH, so there is no exiftool.
+    monkeypatch.setenv('PATH', str(tmp_path / 'empty'))
+    _scan(config, tree, tmp_path / 'scan.journal')
+    for path in files:
+        size, mtime_ns, md5 = _row(db, conn, path)
+        assert db.lookup_quarantine(conn, path, size, mtime_ns) is None
+        metadata = db.lookup_meta(conn, md5)
+        assert 'magic' in metadata
+        assert 'extractor_version' not in metadata
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# test_search.py -*-python-*-
+
+import time
+
+import urfiles.cache
+import urfiles.search
+
+HOUR_NS = urfiles.search.Search.CACHE_SECONDS * 10**9
+# Half way through an hour, so that a second either side is in the same
+# hour for the cache key.
+CUTOFF = 480000 * HOUR_NS + HOUR_NS // 2
+
+
+def _search(config, **kwargs):
+    search = urfiles.search.Search('^/t/', config, **kwargs)
+    matches, _ = search.re()
+    return [row[0] for row in matches], search.next_after
+
+
+def _stats(config):
+    # The hits and misses of the search cache so far.
+    line = urfiles.cache.Cache.from_config(config).info()[-1]
+    stats = dict(field.split('=') for field in line.split())
+    return int(stats['hits']), int(stats['misses'])
+
+
+def test_cache_is_invalidated_by_writes(config, db):
+    db, conn = db
+    db.insert_path(conn, '/t/one', '', 1, 10**9, '1' * 32)
+    conn.commit()
+    assert _search(config) == (['/t/one'], None)
+    assert _search(config) == (['/t/one'], None)
+    assert _stats(config) == (1, 1)
+
+    # A commit changes the generation, so the entry is not used again.
+    db.insert_path(conn, '/t/two', '', 1, 10**9, '2' * 32)
+    conn.commit()
+    assert _search(config) == (['/t/one', '/t/two'], None)
+    assert _stats(config) == (1, 2)
+
+
+def test_cached_times_are_exact(config, db):
+    db, conn = db
+    db.insert_path(conn, '/t/before', '', 1, CUTOFF - 10**9, '1' * 32)
+    db.insert_path(conn, '/t/after', '', 1, CUTOFF + 10**9, '2' * 32)
+    conn.commit()
+
+    assert _search(config, newer=CUTOFF) == (['/t/after'], None)
+    assert _search(config, older=CUTOFF) == (['/t/before'], None)
+    # Cutoffs in the same hour share an entry, but each gets the rows of
+    # its own cutoff.
+    assert _search(config, newer=CUTOFF - 2 * 10**9) == \
+        (['/t/after', '/t/before'], None)
+    assert _search(config, newer=CUTOFF) == (['/t/after'], None)
+    assert _stats(config) == (2, 2)
+
+
+def test_cached_pages_are_full(config, db):
+    db, conn = db
+    db.insert_path(conn, '/t/a', '', 1, CUTOFF - 10**9, '1' * 32)
+    for name in ['b', 'c']:
+        db.insert_path(conn, '/t/' + name, '', 1, CUTOFF + 10**9, '2' * 32)
+    conn.commit()
+
+    # /t/a is in the cached page of the hour, but not in this one, which
+    # still has a full page of rows.
+    for _ in range(2):
+        matches, next_after = _search(config, newer=CUTOFF, limit=2)
+        assert matches == ['/t/b', '/t/c']
+        assert next_after is not None
+
+
+def test_relative_times_are_not_rounded():
+    before = time.time_ns()
+    cutoff = urfiles.search.Search.parse_time('30d')
+    after = time.time_ns()
+    day_ns = 86400 * 10**9
+    assert before - 30 * day_ns <= cutoff <= after - 30 * day_ns
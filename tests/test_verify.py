@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# test_verify.py -*-python-*-
+
+import csv
+import hashlib
+import io
+import os
+import time
+
+import urfiles.db
+import urfiles.verify
+
+from conftest import make_tree
+
+
+def _record(db, conn, path, source=''):
+    # Records path as a scan would.
+    statinfo = os.stat(path)
+    with open(path, 'rb') as fp:
+        md5 = hashlib.md5(fp.read()).hexdigest()
+    db.insert_path(conn, path, source, statinfo.st_size,
+                   statinfo.st_mtime_ns, md5)
+
+
+def _statuses(db, conn):
+    fp = io.BytesIO()
+    assert db.dump(conn, 'verify', fp)
+    rows = csv.DictReader(io.StringIO(fp.getvalue().decode()))
+    return {row['path']: row['status'] for row in rows}
+
+
+def test_verify_missing_and_mismatch(config, db, tmp_path, monkeypatch):
+    db, conn = db
+    ok, gone, rot, edited = make_tree(tmp_path / 'tree', [
+        'ok', 'gone', 'rot', 'edited'])
+    for path in [ok, gone, rot, edited]:
+        _record(db, conn, path)
+    # Rows that cannot be opened by path: a file on a tape, loaded from its
+    # manifest, and an archive member.
+    db.insert_path(conn, 'tree/a/f4', 'tape1', 2, 10**9, '0' * 32)
+    db.insert_path(conn, ok + '.tar//ok', '', 2, 10**9, '0' * 32)
+    conn.commit()
+
+    os.remove(gone)
+    statinfo = os.stat(rot)
+    with open(rot, 'w') as fp:
+        fp.write('ROT')
+    os.utime(rot, ns=(statinfo.st_atime_ns, statinfo.st_mtime_ns))
+    with open(edited, 'a') as fp:
+        fp.write(' and more')
+
+    # Small chunks, so that the run reads on from one chunk to the next.
+    monkeypatch.setattr(urfiles.verify.Verify, 'CHUNK', 2)
+    verify = urfiles.verify.Verify(None, config, max_workers=2)
+    verify.verify()
+    assert verify.stopped == 'done'
+    assert verify.progress.counts['missing'] == 1
+    assert verify.progress.counts['mismatched'] == 1
+    assert _statuses(db, conn) == {ok: 'ok', gone: 'missing',
+                                   rot: 'mismatch', edited: 'changed'}
+
+
+def test_fetch_verify_order(db):
+    db, conn = db
+    for name in ['/a', '/b', '/c']:
+        db.insert_path(conn, name, '', 1, 10**9, '0' * 32)
+    db.insert_path(conn, 'relative', 'tape1', 1, 10**9, '0' * 32)
+    db.insert_path(conn, '/x.tar//member', '', 1, 10**9, '0' * 32)
+    conn.commit()
+    start_ns = time.time_ns()
+    db.insert_verify(conn, '/c', '', 1, 10**9, 'ok', '0' * 32)
+    db.insert_verify(conn, '/a', '', 1, 10**9, 'ok', '0' * 32)
+    conn.commit()
+
+    # Rows never verified come first, then the least recently verified,
+    # one row at a time.
+    before_ns = time.time_ns()
+    fetched = []
+    after = None
+    while True:
+        rows = db.fetch_verify(conn, before_ns, 1, after=after)
+        if not rows:
+            break
+        fetched.extend(row[0] for row in rows)
+        after = urfiles.db.Backend.verify_key(rows[-1])
+    assert fetched == ['/b', '/c', '/a']
+
+    # Rows verified since the cutoff are left for a later cycle.
+    assert [row[0] for row in db.fetch_verify(conn, start_ns, 10)] == ['/b']
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# archive.py -*-python-*-
+
+import hashlib
+import os
+import tarfile
+import time
+import traceback
+import zipfile
+import zlib
+import urfiles.db
+import urfiles.hasher
+import urfiles.identify
+import urfiles.progress
+import urfiles.sandbox
+
+# pylint: disable=unused-import
+from urfiles.log import DEBUG, INFO, ERROR, FATAL
+
+
+class Archive():
+    # Archive records the members of tar and zip files without extracting
+    # them. Each member is stored as a virtual path, ARCHIVE//MEMBER, with
+    # the size and mtime from the archive. Tar files are read as a stream
+    # (mode 'r|*'), so even a compressed archive is read once, front to
+    # back. Zip members are read in the order they are stored. A member that
+    # cannot be read is counted as an error and the rest are still scanned,
+    # as far as a tar stream can be followed past it.
+    SEPARATOR = '//'
+    # Encrypted zip members raise RuntimeError, and unsupported compression
+    # methods NotImplementedError.
+    MEMBER_ERRORS = (OSError, EOFError, tarfile.TarError, zipfile.BadZipFile,
+                     zlib.error, RuntimeError, NotImplementedError)
+
+    def __init__(self, archives, config, source=None, debug=False,
+                 report=None):
+        self.archives = [os.path.abspath(archive) for archive in archives]
+        self.config = config
+        self.source = source if source is not None else ''
+        self.debug = debug
+        # Members up to this size are kept in memory while they are hashed,
+        # so that metadata can be extracted from the buffer. Larger members
+        # are only hashed. 0 turns metadata extraction off.
+        self.metadata_limit = urfiles.hasher.Hasher.parse_size(
+            config.config['archive'].get('metadata_limit', '16M'))
+        self.report = report
+        self.progress = urfiles.progress.Progress('scan-archive')
+        self.block_size = urfiles.hasher.Hasher.from_config(
+            config.config).block_size
+        self.sandbox = None
+        self.timeout = None
+        # Members of the current archive read so far.
+        self.members = 0
+
+    def _failed(self, path, e):
+        ERROR('%s: %s', path, repr(e))
+        self.progress.update(-1, {'errors': 1})
+
+    def _member(self, db, conn, path, size, mtime_ns, fp):
+        counts = urfiles.progress.Progress.new_counts()
+        counts['files'] += 1
+        counts['bytes'] += size
+        if db.lookup_path(conn, path, size, mtime_ns) is not None:
+            # The data still has to be read past, but not hashed.
+            counts['unchanged'] += 1
+            self.progress.update(-1, counts)
+            return
+
+        start_time = time.time()
+        checksum = hashlib.md5()
+        buffer = None
+        if size <= self.metadata_limit:
+            buffer = bytearray()
+        while True:
+            data = fp.read(self.block_size)
+            if not data:
+                break
+            checksum.update(data)
+            if buffer is not None:
+                buffer += data
+        md5 = checksum.hexdigest()
+        counts['hash_seconds'] += time.time() - start_time
+        counts['hashed_bytes'] += size
+        counts['new'] += 1
+
+        if db.lookup_meta(conn, md5) is None:
+            if buffer is not None:
+                identify = urfiles.identify.Identify(path,
+                                                     sandbox=self.sandbox,
+                                                     timeout=self.timeout,
+                                                     buffer=bytes(buffer))
+                metadata = identify.id_buffer()
+                for extractor, reason in identify.failures:
+                    ERROR('%s: %s failed: %s', path, extractor, reason)
+            else:
+                # As for --load, so that --backfill can find it later.
+                metadata = dict()
+            db.insert_meta(conn, md5, metadata)
+        db.insert_path(conn, path, self.source, size, mtime_ns, md5)
+        self.progress.update(-1, counts)
+
+    def _tar(self, db, conn, archive):
+        with tarfile.open(archive, mode='r|*') as tar:
+            for member in tar:
+                path = archive + self.SEPARATOR + member.name
+                if not member.isfile():
+                    if not member.isdir():
+                        self.progress.update(-1, {'skipped': 1})
+                    continue
+                try:
+                    fp = tar.extractfile(member)
+                    self._member(db, conn, path, member.size,
+                                 int(member.mtime) * 10**9, fp)
+                except self.MEMBER_ERRORS as e:
+                    self._failed(path, e)
+                self.members += 1
+                self.progress.log()
+
+    def _zip(self, db, conn, archive):
+        with zipfile.ZipFile(archive) as zf:
+            for info in sorted(zf.infolist(),
+                               key=lambda info: info.header_offset):
+                if info.is_dir():
+                    continue
+                path = archive + self.SEPARATOR + info.filename
+                # Zip timestamps are local time, with 2 second resolution.
+                mtime_ns = int(time.mktime(info.date_time + (0, 0, -1))) * \
+                    10**9
+                try:
+                    with zf.open(info) as fp:
+                        self._member(db, conn, path, info.file_size,
+                                     mtime_ns, fp)
+                except self.MEMBER_ERRORS as e:
+                    self._failed(path, e)
+                self.members += 1
+                self.progress.log()
+
+    def scan(self):
+        try:
+            db = urfiles.db.DB(self.config.config)
+            conn = db.connect()
+        except Exception as e:
+            FATAL('Cannot connect to database: %s', repr(e))
+        db.prepare_source(conn, self.source)
+        conn.commit()
+
+        section = self.config.config['identify']
+        self.timeout = float(section.get('timeout', 60)) or None
+        if section.getboolean('sandbox', True):
+            self.sandbox = urfiles.sandbox.Sandbox(timeout=self.timeout)
+
+        for archive in self.archives:
+            INFO('Scanning %s', archive)
+            self.members = 0
+            try:
+                if zipfile.is_zipfile(archive):
+                    self._zip(db, conn, archive)
+                else:
+                    self._tar(db, conn, archive)
+            except (OSError, EOFError, tarfile.TarError,
+                    zipfile.BadZipFile) as e:
+                if self.members:
+                    ERROR('%s is partially scanned, cannot read past %d'
+                          ' members: %s', archive, self.members, repr(e))
+                else:
+                    ERROR('Cannot read %s: %s', archive, repr(e))
+                self.progress.update(-1, {'errors': 1})
+            except Exception:
+                ERROR('%s: %s', archive, traceback.format_exc())
+                self.progress.update(-1, {'errors': 1})
+            db.bump_generation(conn)
+            conn.commit()
+        if self.sandbox is not None:
+            self.sandbox.close()
+        db.update_stats(conn, [self.source])
+        conn.close()
+
+        self.progress.finish()
+        self.progress.log(force=True)
+        if self.report:
+            self.progress.write_report(self.report, archives=self.archives,
+                                       source=self.source)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# backfill.py -*-python-*-
+
+import concurrent.futures
+import os
+import stat
+import time
+import urfiles.db
+import urfiles.identify
+import urfiles.progress
+import urfiles.sandbox
+
+# pylint: disable=unused-import
+from urfiles.log import DEBUG, INFO, ERROR, FATAL
+
+
+class Backfill():
+    # --load inserts '{}' as the metadata of content first seen on tape. When
+    # a copy of that content is later found on disk by --scan, the md5 is
+    # already known, so its metadata is never extracted. Backfill finds such
+    # meta rows (and, with stale=True, rows from an older Identify.VERSION),
+    # looks for a copy on disk using the path table, and runs Identify on it.
+    CHUNK = 1000
+
+    # Set in each worker process by _init_worker.
+    sandbox = None
+    timeout = None
+
+    def __init__(self, config, max_workers=3, debug=False, stale=False,
+                 rate=None, budget=None, batch_size=100, report=None):
+        self.config = config
+        self.max_workers = max_workers
+        self.debug = debug
+        self.stale = stale
+        self.rate = rate
+        self.budget = budget
+        self.batch_size = batch_size
+        self.report = report
+        self.progress = urfiles.progress.Progress('backfill', max_workers)
+
+    def _candidates(self, db, conn):
+        # Keyset pagination over md5, so that only one chunk is in memory and
+        # rows updated during the run are not returned again.
+        version = urfiles.identify.Identify.VERSION if self.stale else None
+        after = ''
+        while True:
+            rows = db.fetch_backfill(conn, after, self.CHUNK, version=version)
+            if not rows:
+                return
+            md5 = None
+            paths = []
+            for row in rows:
+                if row[0] != md5:
+                    if md5 is not None:
+                        yield md5, paths
+                    md5 = row[0]
+                    paths = []
+                if row[1] is not None:
+                    paths.append((row[1], row[2], row[3]))
+            yield md5, paths
+            after = md5
+
+    @staticmethod
+    def _init_worker(timeout, sandbox):
+        Backfill.timeout = timeout
+        if sandbox:
+            Backfill.sandbox = urfiles.sandbox.Sandbox(timeout=timeout)
+
+    @staticmethod
+    def _identify(md5, paths):
+        # A path is only used if its size and mtime still match the path
+        # row, which is the same test --scan uses to skip hashing a file.
+        for path, size, mtime_ns in paths:
+            try:
+                statinfo = os.stat(path)
+            except OSError:
+                continue
+            if not stat.S_ISREG(statinfo.st_mode) or \
+               statinfo.st_size != size or \
+               statinfo.st_mtime_ns != mtime_ns or \
+               not os.access(path, os.R_OK):
+                continue
+            identify = urfiles.identify.Identify(path,
+                                                 sandbox=Backfill.sandbox,
+                                                 timeout=Backfill.timeout)
+            _, metadata = identify.id(checksum=False, statinfo=statinfo)
+            return md5, path, size, metadata, identify.failures
+        return md5, None, 0, None, []
+
+    def _result(self, db, conn, result):
+        md5, path, size, metadata, failures = result
+        counts = urfiles.progress.Progress.new_counts()
+        counts['files'] += 1
+        if path is None:
+            DEBUG('%s: no readable copy', md5)
+            counts['skipped'] += 1
+        elif failures:
+            # The metadata is left empty, so the next run tries again.
+            for extractor, reason in failures:
+                ERROR('%s: %s failed: %s', path, extractor, reason)
+            counts['errors'] += 1
+        else:
+            db.update_meta(conn, md5, metadata)
+            counts['new'] += 1
+            counts['bytes'] += size
+        self.progress.update(-1, counts)
+        return counts['new']
+
+    def backfill(self):
+        try:
+            db = urfiles.db.DB(self.config.config)
+            conn = db.connect()
+        except Exception as e:
+            FATAL('Cannot connect to database: %s', repr(e))
+
+        section = self.config.config['identify']
+        timeout = float(section.get('timeout', 60)) or None
+        sandbox = section.getboolean('sandbox', True)
+
+        # Each worker has at most two items queued, so that the time budget
+        # and the rate limit apply to work that has actually started.
+        start_time = time.time()
+        submitted = 0
+        updated = 0
+        pending = set()
+        stopped = None
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                initializer=self._init_worker,
+                initargs=(timeout, sandbox)) as executor:
+            candidates = self._candidates(db, conn)
+            while True:
+                while stopped is None and len(pending) < 2 * self.max_workers:
+                    elapsed = time.time() - start_time
+                    if self.budget is not None and elapsed >= self.budget:
+                        stopped = 'time budget exhausted'
+                        break
+                    if self.rate and submitted >= self.rate * elapsed:
+                        break
+                    try:
+                        md5, paths = next(candidates)
+                    except StopIteration:
+                        stopped = 'done'
+                        break
+                    pending.add(executor.submit(self._identify, md5, paths))
+                    submitted += 1
+                if not pending and stopped is not None:
+                    break
+
+                done, pending = concurrent.futures.wait(
+                    pending, timeout=1.0,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        updated += self._result(db, conn, future.result())
+                    except Exception as e:
+                        ERROR('Backfill failed: %s', repr(e))
+                        self.progress.update(-1, {'errors': 1})
+                    if updated >= self.batch_size:
+                        db.bump_generation(conn)
+                        conn.commit()
+                        updated = 0
+                self.progress.log()
+        db.bump_generation(conn)
+        conn.commit()
+        conn.close()
+        INFO('Backfill stopped: %s', stopped)
+
+        self.progress.finish()
+        self.progress.log(force=True)
+        if self.report:
+            self.progress.write_report(self.report, stale=self.stale,
+                                       rate=self.rate, budget=self.budget,
+                                       workers=self.max_workers,
+                                       stopped=stopped)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# cache.py -*-python-*-
+
+import json
+import os
+import sqlite3
+import time
+import zlib
+import urfiles.hasher
+
+# pylint: disable=unused-import
+from urfiles.log import DEBUG, INFO, ERROR, FATAL
+
+
+class Cache():
+    # A local cache of search results, in an SQLite file. Each entry is
+    # keyed on the database and the normalized query, and records the
+    # database generation it was computed at (see Backend.fetch_generation),
+    # so an entry is only used while nothing has been written since. Values
+    # are zlib-compressed JSON, and the least recently used entries are
+    # evicted when the cache is larger than max_size bytes.
+    STATS = ['hits', 'misses', 'evictions']
+
+    def __init__(self, path, max_size=64 * 2**20, timeout=10.0):
+        self.path = path
+        self.max_size = max_size
+        self.timeout = timeout
+        self.conn = None
+
+    @staticmethod
+    def from_config(config):
+        # Returns None when the cache is disabled (max_size = 0).
+        section = config.config['cache']
+        max_size = urfiles.hasher.Hasher.parse_size(
+            section.get('max_size', '64M'))
+        if max_size == 0:
+            return None
+        return Cache(os.path.expanduser(
+            section.get('path', '~/.cache/urfiles/search.sqlite')),
+                     max_size=max_size)
+
+    @staticmethod
+    def key(database, criteria, order_by, limit, after):
+        # Criteria that are not set are left out, so that equivalent queries
+        # share an entry.
+        return json.dumps({'database': database,
+                           'criteria': {name: value for name, value in
+                                        criteria.items()
+                                        if value is not None},
+                           'order_by': order_by, 'limit': limit,
+                           'after': after}, sort_keys=True)
+
+    def _connect(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.conn = sqlite3.connect(self.path, timeout=self.timeout)
+            with self.conn:
+                self.conn.execute('''create table if not exists entry (
+                key text primary key,
+                generation bigint,
+                value blob,
+                bytes bigint,
+                atime_ns bigint
+                )''')
+                self.conn.execute('''create index if not exists'''
+                                  ''' entry_atime_ns on entry(atime_ns)''')
+                self.conn.execute('''create table if not exists stats (
+                name text primary key,
+                value bigint
+                )''')
+        return self.conn
+
+    def _count(self, name):
+        self.conn.execute('''insert into stats(name, value) values(?, 1)'''
+                          ''' on conflict(name) do update set'''
+                          ''' value = value + 1;''', (name,))
+
+    def get(self, key, generation):
+        # Returns the cached value, or None.
+        conn = self._connect()
+        with conn:
+            row = conn.execute('''select generation, value from entry'''
+                               ''' where key=?;''', (key,)).fetchone()
+            if row is None or row[0] != generation:
+                if row is not None:
+                    conn.execute('''delete from entry where key=?;''',
+                                 (key,))
+                self._count('misses')
+                return None
+            conn.execute('''update entry set atime_ns=? where key=?;''',
+                         (time.time_ns(), key))
+            self._count('hits')
+        return json.loads(zlib.decompress(row[1]))
+
+    def put(self, key, generation, value):
+        data = zlib.compress(json.dumps(value).encode())
+        if len(data) > self.max_size:
+            return
+        conn = self._connect()
+        with conn:
+            conn.execute('''insert or replace into entry(key, generation,'''
+                         ''' value, bytes, atime_ns) values(?,?,?,?,?);''',
+                         (key, generation, data, len(data), time.time_ns()))
+            total = conn.execute('''select coalesce(sum(bytes), 0)'''
+                                 ''' from entry;''').fetchone()[0]
+            if total <= self.max_size:
+                return
+            cur = conn.execute('''select key, bytes from entry'''
+                               ''' order by atime_ns;''')
+            evicted = []
+            for old_key, size in cur:
+                if total <= self.max_size:
+                    break
+                evicted.append((old_key,))
+                total -= size
+            cur.close()
+            conn.executemany('''delete from entry where key=?;''', evicted)
+            for _ in evicted:
+                self._count('evictions')
+
+    def info(self):
+        output = []
+        output.append('Search cache')
+        if not os.path.exists(self.path):
+            output.append('  {} (empty)'.format(self.path))
+            return output
+        conn = self._connect()
+        entries, total = conn.execute('''select count(*),'''
+                                      ''' coalesce(sum(bytes), 0)'''
+                                      ''' from entry;''').fetchone()
+        stats = dict(conn.execute('''select name, value from stats;'''))
+        output.append('  {} ({} entries, {} kB of {} kB)'.format(
+            self.path, entries, total // 1024, self.max_size // 1024))
+        output.append('  ' + ' '.join('{}={}'.format(name,
+                                                     stats.get(name, 0))
+                                      for name in self.STATS))
+        return output
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
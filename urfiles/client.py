@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# client.py -*-python-*-
+
+import json
+import os
+import socket
+
+# pylint: disable=unused-import
+from urfiles.log import DEBUG, INFO, ERROR, FATAL
+
+
+class Client():
+    # Talks to a --serve daemon (see server.py). This is kept apart from the
+    # server, so that a search that uses the daemon does not import the
+    # server's multiprocessing and database modules.
+    def __init__(self, socket_path, timeout=60.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    @staticmethod
+    def default_socket(config):
+        section = config.config['serve']
+        return os.path.expanduser(section.get('socket',
+                                              '~/.cache/urfiles/serve.sock'))
+
+    def request(self, request):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            with sock.makefile('rwb') as fp:
+                fp.write(json.dumps(request).encode() + b'\n')
+                fp.flush()
+                line = fp.readline()
+        if not line:
+            raise ConnectionError('no response from server')
+        response = json.loads(line)
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response
+
+    def search(self, criteria, order_by='path', limit=None, after=None):
+        response = self.request({'command': 'search', 'criteria': criteria,
+                                 'order_by': order_by, 'limit': limit,
+                                 'after': after})
+        return ([tuple(row) for row in response['matches']],
+                response['meta'], response['next_after'])
+
+    def reload(self):
+        # Rebuilds the daemon's index, if it has one, before returning.
+        return self.request({'command': 'reload'})['reloaded']
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# compact.py -*-python-*-
+
+import array
+import bisect
+import re
+
+# pylint: disable=unused-import
+from urfiles.log import DEBUG, INFO, ERROR, FATAL
+
+
+def match_lines(text, expr):
+    # Returns the indexes of the lines of text (each ending with a newline)
+    # that match expr. A match found in the text may span lines, so each
+    # candidate line is checked by itself, and the search resumes at the
+    # next line. Lines are counted as the search goes, so the text is only
+    # scanned once.
+    pattern = re.compile(expr, re.MULTILINE)
+    result = []
+    pos = 0
+    line = 0
+    counted = 0
+    while True:
+        found = pattern.search(text, pos)
+        if found is None or found.start() >= len(text):
+            return result
+        start = text.rfind('\n', 0, found.start()) + 1
+        line += text.count('\n', counted, start)
+        counted = start
+        end = text.index('\n', start)
+        if found.end() <= end or \
+           pattern.search(text[start:end]) is not None:
+            result.append(line)
+        pos = end + 1
+
+
+class Records():
+    # A read-only sequence view of fixed-width records in a bytes-like
+    # object (e.g., an mmap), starting at start, so that bisect can search
+    # it without a Python object per record.
+    def __init__(self, data, width, start=0, count=None):
+        self.data = data
+        self.width = width
+        self.start = start
+        self.count = (len(data) - start) // width if count is None else count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        start = self.start + idx * self.width
+        return self.data[start:start + self.width]
+
+
+class DigestSet():
+    # A set of md5s, held as one sorted array of 16-byte digests (rather
+    # than a Python set of 32-character strings, which costs about six times
+    # as much). An index of where each 2-byte prefix starts narrows each
+    # binary search to a few hundred digests, even for hundreds of millions
+    # of md5s. md5s should be given in sorted order (e.g., from
+    # Backend.iter_md5s); otherwise they are sorted once they are all read.
+    WIDTH = 16
+
+    def __init__(self, md5s=()):
+        self.data = bytearray()
+        # Anything that is not a hex md5 is kept as is.
+        self.other = set()
+        counts = array.array('q', bytes(8 * 65536))
+        last = b''
+        unsorted = False
+        for md5 in md5s:
+            try:
+                digest = bytes.fromhex(md5)
+            except (TypeError, ValueError):
+                digest = None
+            if digest is None or len(digest) != self.WIDTH:
+                self.other.add(md5)
+                continue
+            if digest < last:
+                unsorted = True
+            last = digest
+            self.data += digest
+            counts[digest[0] << 8 | digest[1]] += 1
+        self.data = bytes(self.data)
+        if unsorted:
+            records = Records(self.data, self.WIDTH)
+            self.data = b''.join(
+                sorted(records[idx] for idx in range(len(records))))
+
+        self.starts = array.array('q', [0])
+        for count in counts:
+            self.starts.append(self.starts[-1] + count)
+        self.records = Records(self.data, self.WIDTH)
+        # Sets added later with update, e.g., the md5s that a load has just
+        # written.
+        self.added = []
+
+    def update(self, digests):
+        # Adds the md5s of the DigestSet digests (without copying them).
+        self.added.append(digests)
+
+    def __len__(self):
+        return len(self.records) + len(self.other) + \
+            sum(len(digests) for digests in self.added)
+
+    def __contains__(self, md5):
+        try:
+            digest = bytes.fromhex(md5)
+        except (TypeError, ValueError):
+            digest = None
+        if digest is None or len(digest) != self.WIDTH:
+            found = md5 in self.other
+        else:
+            prefix = digest[0] << 8 | digest[1]
+            lo, hi = self.starts[prefix], self.starts[prefix + 1]
+            idx = bisect.bisect_left(self.records, digest, lo, hi)
+            found = idx < hi and self.records[idx] == digest
+        return found or any(md5 in digests for digests in self.added)
+
+
+class PathSet():
+    # A set of paths, front-coded: the paths are sorted (by their UTF-8
+    # bytes) into blocks, and each path in a block after the first is stored
+    # as the length of the prefix it shares with the one before, and the
+    # rest. Paths in a tree share long prefixes, so this is a fraction of
+    # the size of a Python set. A lookup finds the block by binary search
+    # over the first paths, and decodes it; the last block decoded is kept,
+    # since lookups usually come in (roughly) sorted order.
+    BLOCK = 32
+
+    def __init__(self, paths=()):
+        self.heads = []
+        self.blocks = []
+        self.count = 0
+        self.cached = None
+        self.cached_block = None
+        self._last = None
+
+        encoded = (self._encode(path) for path in paths)
+        previous = None
+        unsorted = []
+        for path in encoded:
+            if previous is not None and path <= previous:
+                if path == previous:
+                    continue
+                # Not in order: collect the rest and sort them.
+                unsorted.append(path)
+                continue
+            self._append(path)
+            previous = path
+        if unsorted:
+            everything = set(unsorted)
+            for idx in range(len(self.heads)):
+                everything.update(self._decode(idx))
+            self.cached = None
+            self.heads = []
+            self.blocks = []
+            self.count = 0
+            for path in sorted(everything):
+                self._append(path)
+        # bytearrays over-allocate as they grow.
+        self.blocks = [bytes(block) for block in self.blocks]
+
+    @staticmethod
+    def _encode(path):
+        return path.encode('utf-8', 'surrogateescape')
+
+    @staticmethod
+    def _varint(value):
+        result = bytearray()
+        while value >= 0x80:
+            result.append(value & 0x7f | 0x80)
+            value >>= 7
+        result.append(value)
+        return result
+
+    def _append(self, path):
+        if self.count % self.BLOCK == 0:
+            self.heads.append(path)
+            self.blocks.append(bytearray())
+        else:
+            block = self.blocks[-1]
+            previous = self._last
+            # The shared prefix is found by binary search over slices, which
+            # compares bytes in C rather than one at a time.
+            shared, limit = 0, min(len(previous), len(path))
+            while shared < limit:
+                middle = (shared + limit + 1) // 2
+                if previous[:middle] == path[:middle]:
+                    shared = middle
+                else:
+                    limit = middle - 1
+            block += self._varint(shared)
+            block += self._varint(len(path) - shared)
+            block += path[shared:]
+        self._last = path
+        self.count += 1
+
+    def _decode(self, idx):
+        if self.cached == idx:
+            return self.cached_block
+        block = self.blocks[idx]
+        path = self.heads[idx]
+        paths = [path]
+        pos = 0
+        while pos < len(block):
+            values = []
+            for _ in range(2):
+                value = 0
+                shift = 0
+                while True:
+                    byte = block[pos]
+                    pos += 1
+                    value |= (byte & 0x7f) << shift
+                    shift += 7
+                    if byte < 0x80:
+                        break
+                values.append(value)
+            shared, length = values
+            path = path[:shared] + bytes(block[pos:pos + length])
+            pos += length
+            paths.append(path)
+        self.cached = idx
+        self.cached_block = paths
+        return paths
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, path):
+        key = self._encode(path)
+        idx = bisect.bisect_right(self.heads, key) - 1
+        if idx < 0:
+            return False
+        return key in self._decode(idx)
+
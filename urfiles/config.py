@@ -10,26 +10,50 @@ from urfiles.log import PDLOG_SET_LEVEL, DEBUG, INFO, ERROR, FATAL, DECODE
 
 class Config():
     def __init__(self, paths=['/etc/urfiles', '~/.config/urfiles',
-                              '~/.urfiles']):
+                              '~/.urfiles'], check=True):
         self.paths = []
         for path in paths:
             self.paths.append(os.path.expanduser(path))
         self.config = configparser.ConfigParser()
 
         self.config.read_dict(
-            {'postgresql': {'host': 'localhost',
+            {'urfiles': {'backend': 'postgresql'},
+             'postgresql': {'host': 'localhost',
                             'database': 'urfiles',
                             'user': 'postgresql'},
+             'sqlite': {'database': '~/.urfiles.sqlite'},
+             'scan': {'hdd_readers': '1',
+                      'ssd_readers': '0'},
+             'hash': {'block_size': '1M',
+                      'dontneed': 'yes',
+                      'direct': 'no'},
+             'identify': {'timeout': '60',
+                          'sandbox': 'yes'},
+             'archive': {'metadata_limit': '16M'},
+             'serve': {'socket': '~/.cache/urfiles/serve.sock',
+                       'pool_size': '4'},
+             'cache': {'path': '~/.cache/urfiles/search.sqlite',
+                       'max_size': '64M'},
              })
         self.config.read(self.paths)
 
         error = ''
-        if not self.config.has_section('postgresql') or \
+        backend = self.config['urfiles']['backend']
+        if backend not in ['postgresql', 'sqlite']:
+            error += '''
+    The "backend" key in the [urfiles] section must be "postgresql" or
+    "sqlite".'''
+        if backend == 'postgresql' and \
            'password' not in self.config['postgresql']:
             error += '''
     The configuration file (e.g., ~/.urfiles) must have a section called
     [postgresql] with a "password" key. This password will be used with the
-    "host", "database", and "user" keys to access the text database.'''
+    "host", "database", and "user" keys to access the text database.
+    Alternatively, set "backend = sqlite" in the [urfiles] section to use
+    the embedded SQLite database named by the "database" key in the [sqlite]
+    section.'''
 
-        if error != '':
+        # Commands that do not use the database (e.g., --id or a spooled
+        # --scan) do not need a usable database configuration.
+        if error != '' and check:
             FATAL(error)
@@ -1,364 +1,418 @@
 #!/usr/bin/env python3
 # db.py -*-python-*-
 
-import json
-
-try:
-    import psycopg2
-except ImportError as e:
-    print('''\
-# Cannot import psycopg2: {}
-# Consider: apt-get install python3-psycopg2'''.format(e))
-    raise SystemExit from e
+import abc
+import time
 
 # pylint: disable=unused-import
 from urfiles.log import PDLOG_SET_LEVEL, DEBUG, INFO, ERROR, FATAL, DECODE
 
 
-class DB():
-    def __init__(self, config, section='postgresql'):
-        self.config = config
-        self.section = section
-        self.conn = None
+class Backend(abc.ABC):
+    # This is the interface that every storage backend implements. Methods
+    # that take a conn argument use a connection returned by connect(), so
+    # that callers can batch several operations on one connection. A backend
+    # that does not implement one of the abstract methods cannot be
+    # instantiated.
 
-        if self.section not in self.config:
-            FATAL('Configuration file is missing the [%s] section',
-                  self.section)
+    # For search_path: the sort columns for each order, ending with the
+    # rest of the primary key so that the order is total, and whether the
+    # order is descending (largest and newest first).
+    ORDERS = {'size': (['bytes', 'path', 'source', 'mtime_ns'], True),
+              'mtime': (['mtime_ns', 'path', 'source', 'bytes'], True),
+              'path': (['path', 'source', 'bytes', 'mtime_ns'], False)}
 
-        self.params = dict()
-        for key, value in self.config[self.section].items():
-            self.params[key] = value
+    @staticmethod
+    def _search_query(criteria, order_by, limit, after, placeholder,
+                      regexp):
+        # Builds the query for search_path. placeholder(name) returns the
+        # backend's named parameter syntax, and regexp its regular
+        # expression operator.
+        conditions = []
+        args = dict()
+        for key, condition in [('re', 'path {} {}'),
+                               ('source', 'source = {1}'),
+                               ('md5', 'md5 = {1}'),
+                               ('min_size', 'bytes >= {1}'),
+                               ('max_size', 'bytes <= {1}'),
+                               ('newer', 'mtime_ns >= {1}'),
+                               ('older', 'mtime_ns < {1}')]:
+            if criteria.get(key) is not None:
+                conditions.append(condition.format(regexp, placeholder(key)))
+                args[key] = criteria[key]
+
+        # Keyset pagination: after is the sort key of the last row of the
+        # previous page, so the next page starts with an index seek.
+        columns, descending = Backend.ORDERS[order_by]
+        if after is not None:
+            names = ['after{}'.format(idx) for idx in range(len(columns))]
+            conditions.append('({}) {} ({})'.format(
+                ', '.join(columns), '<' if descending else '>',
+                ', '.join([placeholder(name) for name in names])))
+            args.update(zip(names, after))
+
+        query = 'select path, source, bytes, mtime_ns, md5 from path'
+        if conditions:
+            query += ' where ' + ' and '.join(conditions)
+        query += ' order by ' + ', '.join(
+            [column + (' desc' if descending else '') for column in columns])
+        if limit is not None:
+            query += ' limit ' + placeholder('limit')
+            args['limit'] = limit
+        return query, args
+
+    # For dump and restore: the tables that can be dumped, and how the rows
+    # of one source are selected from each.
+    TABLES = {'path': 'source = {}',
+              'meta': 'md5 in (select md5 from path where source = {})',
+              'quarantine': 'source = {}',
+              'verify': 'source = {}'}
+
+    # For update_stats: the paths, bytes, md5s and bytes of distinct content
+    # of one source, grouped by md5 so that the path_source_md5 index can be
+    # used.
+    STATS = '''select coalesce(sum(paths), 0), coalesce(sum(bytes), 0),''' \
+        ''' count(*), coalesce(sum(unique_bytes), 0) from (select''' \
+        ''' count(*) as paths, sum(bytes) as bytes, max(bytes) as''' \
+        ''' unique_bytes from path where source = {} group by md5) g'''
 
     @staticmethod
-    def _connect(params, autocommit=False, use_schema=True):
-        try:
-            conn = psycopg2.connect(**params)
-            conn.autocommit = autocommit
-            with conn.cursor() as cur:
-                if use_schema:
-                    cur.execute('set search_path to urfiles, public')
-        except (Exception, psycopg2.DatabaseError) as error:
-            DECODE('Cannot connect to database')
-            return None
-        return conn
-
-    def _execute(self, commands, args=None, conn=None, autocommit=False,
-                 use_schema=True, use_database=True, close=None,
-                 commit=True):
-        DEBUG('autocommit=%s use_schema=%s use_database=%s close=%s commit=%s',
-              autocommit, use_schema, use_database, close, commit)
-        retcode = True
-        if use_database or 'database' not in self.params:
-            params = self.params
-        else:
-            params = self.params.copy()
-            del params['database']
-
-        if conn is None:
-            conn = self._connect(params, autocommit=autocommit,
-                                 use_schema=use_schema)
-            if conn is None:
-                FATAL('Cannot connect to database.'
-                      ' Has --init been used to initialize the database??')
-
-            # If we created a connection, then we'll close that connection,
-            # and the cursor will become invalid, so we have to close both in
-            # this case.
-            if close is None:
-                close = True
-
-        cur = conn.cursor()
-
-        for command in commands:
-            try:
-                cur.execute(command, args)
-            except (Exception, psycopg2.DatabaseError) as error:
-                DECODE('command=%s args=%s failed', command, args)
-                retcode = False
+    def _size(size):
+        for unit in ['B', 'kB', 'MB', 'GB', 'TB']:
+            if size < 1024 or unit == 'TB':
                 break
+            size /= 1024
+        return '{:.1f} {}'.format(size, unit) if unit != 'B' else \
+            '{} B'.format(size)
 
-        if commit:
-            conn.commit()
-        if close is True:
-            cur.close()
-            cur = None
-            conn.close()
-            conn = None
-        return retcode, conn, cur
-
-    def _maybe_create_tables(self):
-        commands = [
-            '''create table if not exists path (
-            path text,
-            source text,
-            bytes bigint,
-            mtime_ns bigint,
-            md5 text,
-            primary key(path, source, bytes, mtime_ns)
-            )''',
-
-            '''create table if not exists meta (
-            md5 text primary key,
-            metadata json
-            )'''
-        ]
-        return self._execute(commands)[0]
-
-    def _create_database(self):
-        commands = [
-            "create database {} with encoding='UTF8'".
-            format(self.params['database']),
-
-            '''create schema urfiles'''
-        ]
-        return self._execute(commands, use_database=False, use_schema=False,
-                             autocommit=True)[0]
+    @staticmethod
+    def _stats_info(rows, md5s):
+        # Formats the stats rows (source, paths, bytes, md5s, unique_bytes,
+        # time_ns) for info. md5s is the number of rows in meta, if known.
+        # The ratio is bytes per byte of distinct content for a source, and
+        # paths per md5 for the total.
+        output = []
+        output.append('Sources')
+        total_paths, total_bytes = 0, 0
+        for source, paths, size, count, unique, time_ns in rows:
+            output.append('  {:<30s} {:>12d} paths {:>10s} {:>12d} md5s'
+                          ' {:>6.2f}x  {}'.format(
+                              source, paths, Backend._size(size), count,
+                              size / unique if unique else 1.0,
+                              time.strftime('%Y-%m-%d %H:%M', time.localtime(
+                                  time_ns / 1e9))))
+            total_paths += paths
+            total_bytes += size
+        output.append('  {:<30s} {:>12d} paths {:>10s} {:>12s} md5s'
+                      ' {:>6s}'.format(
+                          'total', total_paths, Backend._size(total_bytes),
+                          '?' if md5s is None else str(md5s),
+                          '{:.2f}x'.format(total_paths / md5s) if md5s
+                          else ''))
+        return output
 
-    def maybe_create(self):
-        commands = [
-            '''select datname from pg_database where datistemplate=false'''
-        ]
-        retcode, conn, cur = self._execute(commands, use_database=False,
-                                           use_schema=False, close=False,
-                                           commit=False)
-        if not retcode:
-            cur.close()
-            conn.close()
-            return retcode
-
-        exists = False
-        for datname in cur:
-            DEBUG('datname=%s', datname[0])
-            if datname[0] == self.params['database']:
-                exists = True
-                break
-        cur.close()
-        conn.close()
+    @staticmethod
+    def _dump_query(table, source, placeholder):
+        # Builds the query for dump. table must be in TABLES.
+        query = 'select * from {}'.format(table)
+        args = dict()
+        if source is not None:
+            query += ' where ' + Backend.TABLES[table].format(
+                placeholder('source'))
+            args['source'] = source
+        return query, args
 
-        if not exists:
-            retcode = self._create_database()
-        if not retcode:
-            return retcode
-        return self._maybe_create_tables()
+    @staticmethod
+    def search_key(row, order_by):
+        # The value to pass as after to get the page that follows row.
+        columns, _ = Backend.ORDERS[order_by]
+        fields = dict(zip(['path', 'source', 'bytes', 'mtime_ns'], row))
+        return [fields[column] for column in columns]
 
-    def drop(self):
-        commands = [
-            'drop database if exists {}'.format(self.params['database']),
-            'drop schema if exists {}'.format(self.params['database'])
-        ]
-        retcode, _, _ = self._execute(commands, use_database=False,
-                                      autocommit=True)
-        if retcode:
-            INFO('Database %s dropped', self.params['database'])
+    @staticmethod
+    def verify_key(row):
+        # The value to pass as after to fetch_verify to get the rows that
+        # follow row. Rows that were never verified sort first.
+        path, source, size, mtime_ns, _, time_ns = row
+        return [time_ns or 0, path, source, size, mtime_ns]
 
-    def connect(self):
-        # FIXME we should have two different sets of params.
-        self.conn = self._connect(self.params)
-        return self.conn
-
-    def _get_version(self):
-        versions = []
-        commands = [
-            '''select version();'''
-        ]
-        retcode, conn, cur = self._execute(commands, close=False)
-        if retcode:
-            for version in cur:
-                versions.append(version[0])
-        cur.close()
-        conn.close()
-        return versions[0]
-
-    def _get_tables(self):
-        tables = []
-        commands = [
-            '''select tablename from pg_catalog.pg_tables where
-            schemaname != 'pg_catalog' and
-            schemaname != 'information_schema';'''
-        ]
-        retcode, conn, cur = self._execute(commands, close=False)
-        if retcode:
-            for table in cur:
-                tables.append(table[0])
-        cur.close()
-        conn.close()
-        return tables
-
-    def _get_table_size(self, table):
-        sizes = []
-        commands = [
-            '''select pg_size_pretty(pg_relation_size(%s));'''
-        ]
-        retcode, conn, cur = self._execute(commands, (table,), close=False)
-        if retcode:
-            for size in cur:
-                sizes.append(size[0])
-        cur.close()
-        conn.close()
-        return sizes[0]
-
-    def _get_table_count(self, table):
-        counts = []
-        commands = [
-            '''select count(*) from %s;'''
-        ]
-        retcode, conn, cur = self._execute(commands,
-                                           (psycopg2.extensions.AsIs(table),),
-                                           close=False)
-        if retcode:
-            for size in cur:
-                counts.append(size[0])
-        cur.close()
-        conn.close()
-        return counts[0]
-
-    def _get_table_description(self, table):
-        columns = []
-        commands = [
-            '''select column_name, data_type from information_schema.columns
-            where table_name=%s;'''
-        ]
-        retcode, conn, cur = self._execute(commands, (table,), close=False)
-        if retcode:
-            for column in cur:
-                columns.append(column)
-        cur.close()
-        conn.close()
-        return columns
-
-    def info(self):
-        output = []
-        output.append('Database')
-        output.append('  {}'.format(self._get_version()))
-
-        output.append('Tables')
-        tables = self._get_tables()
-        for table in tables:
-            size = self._get_table_size(table)
-            count = self._get_table_count(table)
-            output.append('  {:<30s} {:<10s} {:>d} entries'.format(table,
-                                                                   size,
-                                                                   count))
-
-        for table in tables:
-            output.append('Description of {}'.format(table))
-            columns = self._get_table_description(table)
-            for column in columns:
-                output.append('  {:<30s} {}'.format(column[0], column[1]))
+    @staticmethod
+    def accept(row, criteria):
+        # Whether row meets the criteria of search_path other than re.
+        _, source, size, mtime_ns, md5 = row
+        return (criteria.get('source') is None or
+                source == criteria['source']) and \
+            (criteria.get('md5') is None or md5 == criteria['md5']) and \
+            (criteria.get('min_size') is None or
+             size >= criteria['min_size']) and \
+            (criteria.get('max_size') is None or
+             size <= criteria['max_size']) and \
+            (criteria.get('newer') is None or
+             mtime_ns >= criteria['newer']) and \
+            (criteria.get('older') is None or mtime_ns < criteria['older'])
 
-        return output
+    @staticmethod
+    def select_rows(rows, criteria, order_by='path', limit=None, after=None):
+        # Returns the rows that search_path would return from rows whose
+        # paths match criteria['re']: for searches that do not use the
+        # database (e.g., the --serve index).
+        def key(row):
+            return Backend.search_key(row, order_by)
+
+        _, descending = Backend.ORDERS[order_by]
+        matches = [row for row in rows if Backend.accept(row, criteria)]
+        if after is not None:
+            after = list(after)
+            matches = [row for row in matches
+                       if (key(row) < after if descending
+                           else key(row) > after)]
+        matches.sort(key=key, reverse=descending)
+        return matches[:limit] if limit is not None else matches
+
+    @abc.abstractmethod
+    def connect(self):
+        pass
 
-    def fetch_rows(self, table):
-        commands = [
-            '''select * from %s;'''
-        ]
-
-        retcode, conn, cur = self._execute(commands,
-                                           (psycopg2.extensions.AsIs(table),),
-                                           close=False)
-        rows = []
-        if retcode:
-            for row in cur:
-                rows.append(row)
-        cur.close()
-        conn.close()
-        return rows
+    @abc.abstractmethod
+    def maybe_create(self):
+        pass
 
+    @abc.abstractmethod
+    def drop(self):
+        pass
+
+    @abc.abstractmethod
+    def info(self, exact=False):
+        # Returns lines describing the database. Row counts are estimates
+        # where the backend keeps them, unless exact is set.
+        pass
+
+    @abc.abstractmethod
+    def dump(self, conn, table, fp, fmt='csv', source=None):
+        # Writes the rows of table (only those of source, if given) to fp, a
+        # binary file, as CSV with a header line, or in PostgreSQL's binary
+        # COPY format. The rows are streamed, not held in memory.
+        pass
+
+    @abc.abstractmethod
+    def restore(self, conn, table, fp, fmt='csv'):
+        # Adds the rows written by dump to table, and commits. Nothing is
+        # added if any row is already present.
+        pass
+
+    @abc.abstractmethod
     def fetch_md5s(self):
-        commands = [
-            '''select md5 from meta;'''
-        ]
-
-        retcode, conn, cur = self._execute(commands, close=False)
-        md5s = set()
-        if retcode:
-            for row in cur:
-                md5s.add(row[0])
-        cur.close()
-        conn.close()
-        return md5s
+        pass
 
+    @abc.abstractmethod
     def fetch_paths(self, source):
-        commands = [
-            '''select path from path where source=%s;'''
-        ]
-
-        retcode, conn, cur = self._execute(commands, (source,), close=False)
-        paths = set()
-        if retcode:
-            for row in cur:
-                paths.add(row[0])
-        cur.close()
-        conn.close()
-        return paths
+        pass
 
+    @abc.abstractmethod
+    def iter_md5s(self, conn):
+        # Yields every md5 in meta, in byte order, without holding them all
+        # in memory.
+        pass
+
+    @abc.abstractmethod
+    def iter_source_paths(self, conn, source):
+        # Yields the paths of source, in byte order (of their UTF-8
+        # encoding), without holding them all in memory.
+        pass
+
+    @abc.abstractmethod
     def insert_path(self, conn, path, source, size, mtime_ns, md5):
-        commands = [
-            '''insert into path(path,source,bytes,mtime_ns,md5)'''
-            ''' values(%s,%s,%s,%s,%s);'''
-        ]
-        retcode, _, _ = self._execute(commands,
-                                      (path, source, size, mtime_ns, md5),
-                                      conn=conn, commit=False)
-        return retcode
+        pass
 
+    @abc.abstractmethod
     def lookup_path(self, conn, path, size, mtime_ns):
-        commands = [
-            '''select md5 from path where'''
-            ''' path=%s and bytes=%s and mtime_ns=%s;''',
-        ]
-        retcode, _, cur = self._execute(commands, (path,size,mtime_ns),
-                                        conn=conn)
-
-        md5 = cur.fetchone() if retcode else None
-        cur.close()
-        return md5
+        pass
 
+    @abc.abstractmethod
     def re_path(self, conn, re):
-        commands = [
-            '''select path,source,bytes,mtime_ns,md5'''
-            ''' from path where path ~ %s;''',
-        ]
-        retcode, _, cur = self._execute(commands, (re,), conn=conn)
-
-        paths = []
-        if retcode:
-            while True:
-                result = cur.fetchone()
-                if result is None:
-                    break
-                paths.append(result)
-        cur.close()
-        return paths
-
+        pass
+
+    @abc.abstractmethod
+    def iter_paths(self, conn, ordered=False):
+        # Yields every path row (path, source, bytes, mtime_ns, md5) without
+        # reading the whole table into memory. With ordered, the rows are in
+        # byte order of path, then source.
+        pass
+
+    @abc.abstractmethod
+    def iter_meta(self, conn):
+        # Yields every meta row (md5, metadata as JSON text), in byte order
+        # of md5, without reading the whole table into memory.
+        pass
+
+    @abc.abstractmethod
+    def search_path(self, conn, criteria, order_by='path', limit=None,
+                    after=None):
+        # criteria may have re, source, md5, min_size, max_size, newer and
+        # older (mtime_ns). Returns rows as re_path does.
+        pass
+
+    @abc.abstractmethod
     def insert_meta(self, conn, md5, metadata):
-        commands = [
-            '''insert into meta(md5, metadata) values(%s,%s);'''
-        ]
-        retcode, _, _ = self._execute(commands, (md5, json.dumps(metadata),),
-                                      conn=conn, commit=False)
-        return retcode
+        pass
 
+    @abc.abstractmethod
     def lookup_meta(self, conn, md5):
-        commands = [
-            '''select * from meta where md5=%s;''',
-        ]
-        retcode, _, cur = self._execute(commands, (str(md5),), conn=conn)
-
-        metadata = None
-        if retcode:
-            row = cur.fetchone()
-            if row is not None:
-                metadata = row[0]
-        cur.close()
-        return metadata
+        pass
 
+    @abc.abstractmethod
     def bulk_insert(self, conn, path_rows=None, meta_rows=None):
-        cur = conn.cursor()
-        if path_rows:
-            cur.copy_expert("copy path from stdin with delimiter ',' csv",
-                            path_rows)
-        if meta_rows:
-            cur.copy_expert("copy meta from stdin with delimiter ',' csv",
-                            meta_rows)
-        conn.commit()
+        pass
+
+    @abc.abstractmethod
+    def fetch_dups(self, conn, min_size=0, sources=None, limit=None):
+        # Yields (md5, bytes, copies, reclaimable, [(source, path), ...]) for
+        # content with more than one distinct (source, path), largest
+        # reclaimable bytes first, without reading all groups into memory.
+        pass
+
+    @abc.abstractmethod
+    def fetch_missing(self, conn, source, missing_from):
+        # Yields (md5, bytes, copies, path) for content in source that has
+        # no path row in missing_from, in md5 order. path is one example.
+        pass
+
+    @abc.abstractmethod
+    def count_missing(self, conn, source, missing_from):
+        # Returns (contents, bytes) for the content fetch_missing would list.
+        pass
+
+    @abc.abstractmethod
+    def fetch_backfill(self, conn, after, limit, version=None):
+        # Returns (md5, path, bytes, mtime_ns) for up to limit md5s greater
+        # than after, in md5 order, whose metadata is empty (or older than
+        # version). An md5 without a path row has path None.
+        pass
+
+    @abc.abstractmethod
+    def update_meta(self, conn, md5, metadata):
+        pass
+
+    @abc.abstractmethod
+    def fetch_verify(self, conn, before_ns, limit, source=None,
+                     prefix=None, after=None):
+        # Returns (path, source, bytes, mtime_ns, md5, time_ns) for up to
+        # limit path rows that were never verified (time_ns is None), in key
+        # order, and then for rows last verified before before_ns, oldest
+        # first. Both are read from an index from after (see verify_key) on,
+        # so a cycle reads each row once. Rows of tapes and archive members
+        # are skipped because their paths cannot be opened.
+        pass
+
+    @abc.abstractmethod
+    def insert_verify(self, conn, path, source, size, mtime_ns, status,
+                      md5):
+        # Records the result of verifying a path row, replacing the last one.
+        pass
+
+    @abc.abstractmethod
+    def insert_quarantine(self, conn, path, source, size, mtime_ns, reason):
+        pass
+
+    @abc.abstractmethod
+    def lookup_quarantine(self, conn, path, size, mtime_ns):
+        # Returns the reason a file was quarantined, or None.
+        pass
+
+    @abc.abstractmethod
+    def delete_quarantine(self, conn, path, source):
+        pass
+
+    @abc.abstractmethod
+    def bulk_merge(self, conn, table, rows, sources=None):
+        # Like bulk_insert, for one table, but rows that are already in the
+        # table (or duplicated in rows) are skipped, and the partitions of
+        # new sources are created (see prepare_source). Returns the number of
+        # rows added, or None if the rows cannot be added, in which case
+        # nothing is. If sources is a set, the sources of the rows are added
+        # to it.
+        pass
+
+    @abc.abstractmethod
+    def write_rows(self, conn, path_rows=(), meta_rows=(),
+                   quarantine_rows=(), unquarantine_rows=(),
+                   meta_update_rows=()):
+        # Writes a batch of rows from a scan in one transaction (with a few
+        # statements rather than one per row), changes the generation, and
+        # commits. meta_rows are (md5, metadata as JSON text), and
+        # unquarantine_rows the (path, source) of quarantine rows to delete.
+        # Rows that are already in a table are skipped, except for
+        # meta_update_rows, which replace the metadata of their md5. Returns
+        # whether the rows were written.
+        pass
+
+    @abc.abstractmethod
+    def fetch_generation(self, conn):
+        # Returns a number that changes whenever path or meta rows are
+        # written, for the search cache, or None if the database predates
+        # the generation table.
+        pass
+
+    @abc.abstractmethod
+    def bump_generation(self, conn):
+        # Changes the generation in the current transaction. Writers call
+        # this before they commit; bulk_insert and bulk_merge do it
+        # themselves.
+        pass
+
+    @abc.abstractmethod
+    def prepare_source(self, conn, source):
+        # Makes room for the rows of source before they are written (a
+        # partition of its own, when the path table is partitioned), in the
+        # current transaction.
+        pass
+
+    @abc.abstractmethod
+    def replace_source(self, conn, source, path_rows):
+        # Replaces all the path rows of source with path_rows (a file-like
+        # object of CSV rows, as for bulk_insert), and commits.
+        pass
+
+    @abc.abstractmethod
+    def drop_source(self, conn, source):
+        # Deletes the path, verify and quarantine rows of source, and
+        # commits.
+        pass
+
+    @abc.abstractmethod
+    def update_stats(self, conn, sources=None):
+        # Recomputes the stats rows of sources (every source, if None) that
+        # info reports, and commits. Writers call this once they have
+        # committed the rows of a source.
+        pass
+
+
+class DB():
+    BACKENDS = ['postgresql', 'sqlite']
+
+    def __init__(self, config, section=None):
+        self.config = config
+        if 'urfiles' in self.config:
+            self.name = self.config['urfiles'].get('backend', 'postgresql')
+        else:
+            self.name = 'postgresql'
+        if section is None:
+            section = self.name
+
+        # The backend modules are only imported when used, so that, e.g.,
+        # the SQLite backend works without psycopg2 being installed.
+        if self.name == 'postgresql':
+            import urfiles.db_postgresql
+            self.backend = urfiles.db_postgresql.PostgresqlDB(config,
+                                                              section)
+        elif self.name == 'sqlite':
+            import urfiles.db_sqlite
+            self.backend = urfiles.db_sqlite.SqliteDB(config, section)
+        else:
+            FATAL('Unknown backend "%s" (expected one of: %s)', self.name,
+                  ', '.join(DB.BACKENDS))
+
+    def __getattr__(self, name):
+        if name == 'backend':
+            raise AttributeError(name)
+        return getattr(self.backend, name)
@@ -0,0 +1,954 @@
+#!/usr/bin/env python3
+# db_postgresql.py -*-python-*-
+
+import hashlib
+import json
+import time
+
+try:
+    import psycopg2
+    import psycopg2.extras
+except ImportError as e:
+    print('''\
+# Cannot import psycopg2: {}
+# Consider: apt-get install python3-psycopg2'''.format(e))
+    raise SystemExit from e
+
+import urfiles.db
+
+# pylint: disable=unused-import
+from urfiles.log import PDLOG_SET_LEVEL, DEBUG, INFO, ERROR, FATAL, DECODE
+
+
+class PostgresqlDB(urfiles.db.Backend):
+    # Content in one source that has no path row in another.
+    MISSING = \
+        '''select p.md5, max(p.bytes) as bytes, count(*), min(p.path)''' \
+        ''' from path p where p.source = %(source)s and''' \
+        ''' p.md5 is not null and not exists (select 1 from path q''' \
+        ''' where q.source = %(missing_from)s and q.md5 = p.md5)''' \
+        ''' group by p.md5'''
+
+    def __init__(self, config, section='postgresql'):
+        self.config = config
+        self.section = section
+        self.conn = None
+        # Whether the database has a generation table and a stats table
+        # (see --init), once known.
+        self.generation = None
+        self.stats = None
+
+        if self.section not in self.config:
+            FATAL('Configuration file is missing the [%s] section',
+                  self.section)
+
+        self.params = dict()
+        for key, value in self.config[self.section].items():
+            self.params[key] = value
+        # With partition = yes, --init creates the path table partitioned by
+        # source. This is not a connection parameter.
+        self.partition = self.config[self.section].getboolean('partition',
+                                                              False)
+        self.params.pop('partition', None)
+        # Whether the path table is partitioned, once known.
+        self.partitioned = None
+
+    @staticmethod
+    def _connect(params, autocommit=False, use_schema=True):
+        try:
+            conn = psycopg2.connect(**params)
+            conn.autocommit = autocommit
+            with conn.cursor() as cur:
+                if use_schema:
+                    cur.execute('set search_path to urfiles, public')
+        except (Exception, psycopg2.DatabaseError) as error:
+            DECODE('Cannot connect to database')
+            return None
+        return conn
+
+    def _execute(self, commands, args=None, conn=None, autocommit=False,
+                 use_schema=True, use_database=True, close=None,
+                 commit=True):
+        DEBUG('autocommit=%s use_schema=%s use_database=%s close=%s commit=%s',
+              autocommit, use_schema, use_database, close, commit)
+        retcode = True
+        if use_database or 'database' not in self.params:
+            params = self.params
+        else:
+            params = self.params.copy()
+            del params['database']
+
+        if conn is None:
+            conn = self._connect(params, autocommit=autocommit,
+                                 use_schema=use_schema)
+            if conn is None:
+                FATAL('Cannot connect to database.'
+                      ' Has --init been used to initialize the database??')
+
+            # If we created a connection, then we'll close that connection,
+            # and the cursor will become invalid, so we have to close both in
+            # this case.
+            if close is None:
+                close = True
+
+        cur = conn.cursor()
+
+        for command in commands:
+            try:
+                cur.execute(command, args)
+            except (Exception, psycopg2.DatabaseError) as error:
+                DECODE('command=%s args=%s failed', command, args)
+                retcode = False
+                break
+
+        if commit:
+            conn.commit()
+        if close is True:
+            cur.close()
+            cur = None
+            conn.close()
+            conn = None
+        return retcode, conn, cur
+
+    def _maybe_create_tables(self):
+        commands = [
+            '''create table if not exists path (
+            path text,
+            source text,
+            bytes bigint,
+            mtime_ns bigint,
+            md5 text,
+            primary key(path, source, bytes, mtime_ns)
+            ){}'''.format(' partition by list (source)' if self.partition
+                          else ''),
+
+            '''create table if not exists meta (
+            md5 text primary key,
+            metadata json
+            )''',
+
+            '''create table if not exists quarantine (
+            path text,
+            source text,
+            bytes bigint,
+            mtime_ns bigint,
+            reason text,
+            time_ns bigint,
+            primary key(path, source, bytes, mtime_ns)
+            )''',
+
+            '''create table if not exists verify (
+            path text,
+            source text,
+            bytes bigint,
+            mtime_ns bigint,
+            status text,
+            md5 text,
+            time_ns bigint,
+            primary key(path, source, bytes, mtime_ns)
+            )''',
+
+            '''create table if not exists generation (
+            value bigint
+            )''',
+
+            '''insert into generation(value) select 0 where not exists'''
+            ''' (select 1 from generation)''',
+
+            '''create table if not exists stats (
+            source text primary key,
+            paths bigint,
+            bytes bigint,
+            md5s bigint,
+            unique_bytes bigint,
+            time_ns bigint
+            )''',
+
+            '''create index if not exists path_md5 on path(md5)''',
+
+            '''create index if not exists path_source_md5 on'''
+            ''' path(source, md5)''',
+
+            '''create index if not exists path_bytes on path(bytes)''',
+
+            '''create index if not exists path_mtime_ns on path(mtime_ns)''',
+
+            '''create index if not exists verify_time_ns on verify(time_ns)'''
+        ]
+        if self.partition:
+            # Rows of sources without a partition of their own.
+            commands.append('''create table if not exists path_default'''
+                            ''' partition of path default''')
+        return self._execute(commands)[0]
+
+    def _create_database(self):
+        commands = [
+            "create database {} with encoding='UTF8'".
+            format(self.params['database']),
+
+            '''create schema urfiles'''
+        ]
+        return self._execute(commands, use_database=False, use_schema=False,
+                             autocommit=True)[0]
+
+    def maybe_create(self):
+        commands = [
+            '''select datname from pg_database where datistemplate=false'''
+        ]
+        retcode, conn, cur = self._execute(commands, use_database=False,
+                                           use_schema=False, close=False,
+                                           commit=False)
+        if not retcode:
+            cur.close()
+            conn.close()
+            return retcode
+
+        exists = False
+        for datname in cur:
+            DEBUG('datname=%s', datname[0])
+            if datname[0] == self.params['database']:
+                exists = True
+                break
+        cur.close()
+        conn.close()
+
+        if not exists:
+            retcode = self._create_database()
+        if not retcode:
+            return retcode
+        return self._maybe_create_tables()
+
+    def drop(self):
+        commands = [
+            'drop database if exists {}'.format(self.params['database']),
+            'drop schema if exists {}'.format(self.params['database'])
+        ]
+        retcode, _, _ = self._execute(commands, use_database=False,
+                                      autocommit=True)
+        if retcode:
+            INFO('Database %s dropped', self.params['database'])
+
+    def connect(self):
+        # FIXME we should have two different sets of params.
+        self.conn = self._connect(self.params)
+        return self.conn
+
+    def _query(self, conn, command, args=None):
+        # Returns all the rows of one query on conn ([] if it fails).
+        retcode, _, cur = self._execute([command], args, conn=conn,
+                                        commit=False)
+        rows = cur.fetchall() if retcode else []
+        cur.close()
+        if not retcode:
+            conn.rollback()
+        return rows
+
+    @staticmethod
+    def _time(value):
+        return value.strftime('%Y-%m-%d %H:%M') if value is not None \
+            else 'never'
+
+    def info(self, exact=False):
+        # Everything comes from the catalog and the statistics views, on
+        # one connection: row counts are the planner's estimates
+        # (reltuples, as of the last vacuum or analyze) unless exact is
+        # set, since count(*) reads the whole table.
+        conn = self._connect(self.params)
+        if conn is None:
+            FATAL('Cannot connect to database.'
+                  ' Has --init been used to initialize the database??')
+        output = []
+        output.append('Database')
+        output.append('  {}'.format(
+            self._query(conn, '''select version();''')[0][0]))
+
+        output.append('Tables')
+        tables = self._query(
+            conn,
+            '''select c.relname, c.relkind, c.reltuples::bigint,'''
+            ''' pg_total_relation_size(c.oid), pg_indexes_size(c.oid),'''
+            ''' greatest(s.last_vacuum, s.last_autovacuum),'''
+            ''' greatest(s.last_analyze, s.last_autoanalyze)'''
+            ''' from pg_class c join pg_namespace n on'''
+            ''' n.oid = c.relnamespace left join pg_stat_user_tables s on'''
+            ''' s.relid = c.oid where n.nspname = current_schema() and'''
+            ''' c.relkind in ('r', 'p') order by c.relname;''')
+        counts = dict()
+        for table, kind, count, size, index_size, vacuum, analyze in tables:
+            if exact:
+                count = self._query(conn, '''select count(*) from "{}";'''.
+                                    format(table))[0][0]
+            elif kind == 'p' or count < 0:
+                # Not analyzed yet, or a partitioned table, whose rows are
+                # counted in its partitions.
+                count = None
+            counts[table] = count
+            output.append('  {:<30s} {:>12s} rows {:>10s} ({} indexes)'
+                          ' vacuum {} analyze {}'.format(
+                              table, '?' if count is None else
+                              ('' if exact else '~') + str(count),
+                              self._size(size), self._size(index_size),
+                              self._time(vacuum), self._time(analyze)))
+
+        output.append('Indexes')
+        for table, index, size, scans in self._query(
+                conn,
+                '''select relname, indexrelname,'''
+                ''' pg_relation_size(indexrelid), idx_scan from'''
+                ''' pg_stat_user_indexes where schemaname ='''
+                ''' current_schema() order by relname, indexrelname;'''):
+            output.append('  {:<30s} {:<14s} {:>10s} {:>12d} scans'.format(
+                index, table, self._size(size), scans))
+
+        if 'stats' in counts:
+            output.extend(self._stats_info(
+                self._query(conn, '''select source, paths, bytes, md5s,'''
+                            ''' unique_bytes, time_ns from stats'''
+                            ''' order by source;'''),
+                counts.get('meta')))
+
+        description = dict()
+        for table, column, data_type in self._query(
+                conn,
+                '''select table_name, column_name, data_type from'''
+                ''' information_schema.columns where table_schema ='''
+                ''' current_schema() order by table_name,'''
+                ''' ordinal_position;'''):
+            description.setdefault(table, []).append((column, data_type))
+        for table in counts:
+            output.append('Description of {}'.format(table))
+            for column, data_type in description.get(table, []):
+                output.append('  {:<30s} {}'.format(column, data_type))
+
+        conn.close()
+        return output
+
+    @staticmethod
+    def _copy_options(fmt):
+        return '(format {}{})'.format(fmt, ', header' if fmt == 'csv' else '')
+
+    def dump(self, conn, table, fp, fmt='csv', source=None):
+        if table not in self.TABLES:
+            ERROR('Cannot dump %s: not one of %s', table,
+                  ', '.join(sorted(self.TABLES)))
+            return False
+        query, args = self._dump_query(table, source,
+                                       lambda name: '%({})s'.format(name))
+        # copy (select ...) also works for a partitioned path table.
+        try:
+            with conn.cursor() as cur:
+                cur.copy_expert('copy ({}) to stdout with {}'.format(
+                    cur.mogrify(query, args).decode(),
+                    self._copy_options(fmt)), fp)
+        except (Exception, psycopg2.DatabaseError) as error:
+            DECODE('Cannot dump %s', table)
+            conn.rollback()
+            return False
+        conn.commit()
+        return True
+
+    def restore(self, conn, table, fp, fmt='csv'):
+        if table not in self.TABLES:
+            ERROR('Cannot restore %s: not one of %s', table,
+                  ', '.join(sorted(self.TABLES)))
+            return False
+        # With a partitioned path table, rows of sources without a
+        # partition go to the default partition, as for --ingest.
+        try:
+            with conn.cursor() as cur:
+                cur.copy_expert('copy {} from stdin with {}'.format(
+                    table, self._copy_options(fmt)), fp)
+            self.bump_generation(conn)
+        except (Exception, psycopg2.DatabaseError) as error:
+            DECODE('Cannot restore %s', table)
+            conn.rollback()
+            return False
+        conn.commit()
+        return True
+
+    def fetch_md5s(self):
+        commands = [
+            '''select md5 from meta;'''
+        ]
+
+        retcode, conn, cur = self._execute(commands, close=False)
+        md5s = set()
+        if retcode:
+            for row in cur:
+                md5s.add(row[0])
+        cur.close()
+        conn.close()
+        return md5s
+
+    def fetch_paths(self, source):
+        commands = [
+            '''select path from path where source=%s;'''
+        ]
+
+        retcode, conn, cur = self._execute(commands, (source,), close=False)
+        paths = set()
+        if retcode:
+            for row in cur:
+                paths.add(row[0])
+        cur.close()
+        conn.close()
+        return paths
+
+    def iter_md5s(self, conn):
+        with conn.cursor(name='md5s') as cur:
+            cur.itersize = 100000
+            cur.execute('''select md5 from meta order by md5 collate "C";''')
+            for row in cur:
+                yield row[0]
+        conn.commit()
+
+    def iter_source_paths(self, conn, source):
+        with conn.cursor(name='source_paths') as cur:
+            cur.itersize = 100000
+            cur.execute('''select path from path where source=%s'''
+                        ''' order by path collate "C";''', (source,))
+            for row in cur:
+                yield row[0]
+        conn.commit()
+
+    def insert_path(self, conn, path, source, size, mtime_ns, md5):
+        commands = [
+            '''insert into path(path,source,bytes,mtime_ns,md5)'''
+            ''' values(%s,%s,%s,%s,%s);'''
+        ]
+        retcode, _, _ = self._execute(commands,
+                                      (path, source, size, mtime_ns, md5),
+                                      conn=conn, commit=False)
+        return retcode
+
+    def lookup_path(self, conn, path, size, mtime_ns):
+        commands = [
+            '''select md5 from path where'''
+            ''' path=%s and bytes=%s and mtime_ns=%s;''',
+        ]
+        retcode, _, cur = self._execute(commands, (path,size,mtime_ns),
+                                        conn=conn)
+
+        md5 = cur.fetchone() if retcode else None
+        cur.close()
+        return md5
+
+    def re_path(self, conn, re):
+        commands = [
+            '''select path,source,bytes,mtime_ns,md5'''
+            ''' from path where path ~ %s;''',
+        ]
+        retcode, _, cur = self._execute(commands, (re,), conn=conn)
+
+        paths = []
+        if retcode:
+            while True:
+                result = cur.fetchone()
+                if result is None:
+                    break
+                paths.append(result)
+        cur.close()
+        return paths
+
+    def iter_paths(self, conn, ordered=False):
+        with conn.cursor(name='paths') as cur:
+            cur.itersize = 10000
+            cur.execute('''select path, source, bytes, mtime_ns, md5'''
+                        ''' from path{};'''.format(
+                            ''' order by path collate "C",'''
+                            ''' source collate "C"''' if ordered else ''))
+            yield from cur
+        conn.commit()
+
+    def iter_meta(self, conn):
+        # metadata is cast to text, so that it is not parsed here only to be
+        # written out again.
+        with conn.cursor(name='meta') as cur:
+            cur.itersize = 10000
+            cur.execute('''select md5, metadata::text from meta'''
+                        ''' order by md5 collate "C";''')
+            yield from cur
+        conn.commit()
+
+    def search_path(self, conn, criteria, order_by='path', limit=None,
+                    after=None):
+        query, args = self._search_query(criteria, order_by, limit, after,
+                                         lambda name: '%({})s'.format(name),
+                                         '~')
+        retcode, _, cur = self._execute([query], args, conn=conn,
+                                        commit=False)
+        paths = cur.fetchall() if retcode else []
+        cur.close()
+        return paths
+
+    def insert_meta(self, conn, md5, metadata):
+        commands = [
+            '''insert into meta(md5, metadata) values(%s,%s);'''
+        ]
+        retcode, _, _ = self._execute(commands, (md5, json.dumps(metadata),),
+                                      conn=conn, commit=False)
+        return retcode
+
+    def lookup_meta(self, conn, md5):
+        commands = [
+            '''select metadata from meta where md5=%s;''',
+        ]
+        retcode, _, cur = self._execute(commands, (str(md5),), conn=conn)
+
+        metadata = None
+        if retcode:
+            row = cur.fetchone()
+            if row is not None:
+                metadata = row[0]
+        cur.close()
+        return metadata
+
+    def fetch_dups(self, conn, min_size=0, sources=None, limit=None):
+        # A named cursor is a server-side cursor, so rows are fetched
+        # itersize at a time rather than all at once.
+        where = 'bytes >= %(min_size)s'
+        if sources:
+            where += ' and source = any(%(sources)s)'
+        command = \
+            '''select md5, max(bytes),''' \
+            ''' count(distinct (source, path)) as n,''' \
+            ''' max(bytes) * (count(distinct (source, path)) - 1) as r,''' \
+            ''' json_agg(json_build_array(source, path))''' \
+            ''' from path where {} and md5 is not null''' \
+            ''' group by md5 having count(distinct (source, path)) > 1''' \
+            ''' order by r desc, md5'''.format(where)
+        if limit is not None:
+            command += ' limit %(limit)s'
+        with conn.cursor(name='dups') as cur:
+            cur.itersize = 1000
+            cur.execute(command, {'min_size': min_size,
+                                  'sources': list(sources or []),
+                                  'limit': limit})
+            for md5, size, copies, reclaimable, paths in cur:
+                yield md5, size, copies, reclaimable, \
+                    sorted(set(tuple(path) for path in paths))
+        conn.commit()
+
+    def fetch_missing(self, conn, source, missing_from):
+        # The anti-join is answered from the path_source_md5 index.
+        with conn.cursor(name='missing') as cur:
+            cur.itersize = 1000
+            cur.execute(self.MISSING + ' order by p.md5',
+                        {'source': source, 'missing_from': missing_from})
+            for row in cur:
+                yield row
+        conn.commit()
+
+    def count_missing(self, conn, source, missing_from):
+        commands = [
+            '''select count(*), coalesce(sum(bytes), 0) from (''' +
+            self.MISSING + ''') m;'''
+        ]
+        retcode, _, cur = self._execute(commands,
+                                        {'source': source,
+                                         'missing_from': missing_from},
+                                        conn=conn, commit=False)
+        row = cur.fetchone() if retcode else (0, 0)
+        cur.close()
+        return tuple(row)
+
+    def fetch_backfill(self, conn, after, limit, version=None):
+        where = "metadata::text = '{}'"
+        if version is not None:
+            where += " or coalesce((metadata->>'extractor_version')::int," \
+                " 0) < %(version)s"
+        commands = [
+            '''select m.md5, p.path, p.bytes, p.mtime_ns from'''
+            ''' (select md5 from meta where md5 > %(after)s and'''
+            ''' ({}) order by md5 limit %(limit)s) m'''
+            ''' left join path p on p.md5 = m.md5'''
+            ''' order by m.md5;'''.format(where)
+        ]
+        retcode, _, cur = self._execute(commands, {'after': after,
+                                                   'limit': limit,
+                                                   'version': version},
+                                        conn=conn, commit=False)
+        rows = cur.fetchall() if retcode else []
+        cur.close()
+        return rows
+
+    def update_meta(self, conn, md5, metadata):
+        commands = [
+            '''update meta set metadata=%s where md5=%s;'''
+        ]
+        retcode, _, _ = self._execute(commands, (json.dumps(metadata), md5),
+                                      conn=conn, commit=False)
+        return retcode
+
+    def bulk_insert(self, conn, path_rows=None, meta_rows=None):
+        cur = conn.cursor()
+        if path_rows:
+            cur.copy_expert("copy path from stdin with delimiter ',' csv",
+                            path_rows)
+        if meta_rows:
+            cur.copy_expert("copy meta from stdin with delimiter ',' csv",
+                            meta_rows)
+        self.bump_generation(conn)
+        conn.commit()
+
+    def fetch_verify(self, conn, before_ns, limit, source=None,
+                     prefix=None, after=None):
+        where = " and left(p.path, 1) = '/' and strpos(p.path, '//') = 0"
+        if source is not None:
+            where += ' and p.source = %(source)s'
+        if prefix is not None:
+            where += ' and left(p.path, length(%(prefix)s)) = %(prefix)s'
+        args = {'before': before_ns, 'limit': limit, 'source': source,
+                'prefix': prefix}
+        if after is not None:
+            args.update(zip(['time_ns', 'path', 'source_', 'bytes',
+                             'mtime_ns'], after))
+        rows = []
+        if after is None or not after[0]:
+            keyset = ''
+            if after is not None:
+                keyset = ' and (p.path, p.source, p.bytes, p.mtime_ns) >' \
+                    ' (%(path)s, %(source_)s, %(bytes)s, %(mtime_ns)s)'
+            commands = [
+                '''select p.path, p.source, p.bytes, p.mtime_ns, p.md5,'''
+                ''' null::bigint from path p where not exists (select 1'''
+                ''' from verify v where v.path = p.path and'''
+                ''' v.source = p.source and v.bytes = p.bytes and'''
+                ''' v.mtime_ns = p.mtime_ns){}{} order by p.path, p.source,'''
+                ''' p.bytes, p.mtime_ns limit %(limit)s;'''.format(where,
+                                                                   keyset)
+            ]
+            retcode, _, cur = self._execute(commands, args, conn=conn,
+                                            commit=False)
+            rows = cur.fetchall() if retcode else []
+            cur.close()
+        if len(rows) < limit:
+            keyset = ''
+            if after is not None and after[0]:
+                keyset = ' and v.time_ns >= %(time_ns)s and (v.time_ns,' \
+                    ' v.path, v.source, v.bytes, v.mtime_ns) >' \
+                    ' (%(time_ns)s, %(path)s, %(source_)s, %(bytes)s,' \
+                    ' %(mtime_ns)s)'
+            args['limit'] = limit - len(rows)
+            commands = [
+                '''select p.path, p.source, p.bytes, p.mtime_ns, p.md5,'''
+                ''' v.time_ns from verify v join path p on'''
+                ''' p.path = v.path and p.source = v.source and'''
+                ''' p.bytes = v.bytes and p.mtime_ns = v.mtime_ns'''
+                ''' where v.time_ns < %(before)s{}{} order by v.time_ns,'''
+                ''' v.path, v.source, v.bytes, v.mtime_ns'''
+                ''' limit %(limit)s;'''.format(where, keyset)
+            ]
+            retcode, _, cur = self._execute(commands, args, conn=conn,
+                                            commit=False)
+            rows += cur.fetchall() if retcode else []
+            cur.close()
+        return rows
+
+    def insert_verify(self, conn, path, source, size, mtime_ns, status,
+                      md5):
+        commands = [
+            '''insert into verify(path,source,bytes,mtime_ns,status,md5,'''
+            '''time_ns) values(%s,%s,%s,%s,%s,%s,%s)'''
+            ''' on conflict (path,source,bytes,mtime_ns) do update set'''
+            ''' status=excluded.status, md5=excluded.md5,'''
+            ''' time_ns=excluded.time_ns;'''
+        ]
+        retcode, _, _ = self._execute(commands,
+                                      (path, source, size, mtime_ns, status,
+                                       md5, time.time_ns()),
+                                      conn=conn, commit=False)
+        return retcode
+
+    def insert_quarantine(self, conn, path, source, size, mtime_ns, reason):
+        commands = [
+            '''insert into quarantine(path,source,bytes,mtime_ns,reason,'''
+            '''time_ns) values(%s,%s,%s,%s,%s,%s) on conflict do nothing;'''
+        ]
+        retcode, _, _ = self._execute(commands,
+                                      (path, source, size, mtime_ns, reason,
+                                       time.time_ns()),
+                                      conn=conn, commit=False)
+        return retcode
+
+    def lookup_quarantine(self, conn, path, size, mtime_ns):
+        commands = [
+            '''select reason from quarantine where'''
+            ''' path=%s and bytes=%s and mtime_ns=%s;''',
+        ]
+        retcode, _, cur = self._execute(commands, (path, size, mtime_ns),
+                                        conn=conn)
+        row = cur.fetchone() if retcode else None
+        cur.close()
+        return row[0] if row is not None else None
+
+    def delete_quarantine(self, conn, path, source):
+        commands = [
+            '''delete from quarantine where path=%s and source=%s;'''
+        ]
+        retcode, _, _ = self._execute(commands, (path, source), conn=conn,
+                                      commit=False)
+        return retcode
+
+    def bulk_merge(self, conn, table, rows, sources=None):
+        keys = {'path': 'path,source,bytes,mtime_ns', 'meta': 'md5',
+                'quarantine': 'path,source,bytes,mtime_ns'}[table]
+        merged = []
+        try:
+            with conn.cursor() as cur:
+                cur.execute('create temporary table merge_rows (like {})'
+                            ' on commit drop'.format(table))
+                cur.copy_expert(
+                    "copy merge_rows from stdin with delimiter ',' csv", rows)
+                if table != 'meta':
+                    cur.execute('select distinct source from merge_rows')
+                    merged = [row[0] for row in cur]
+                # With partition = yes, a new source needs its partition
+                # before its path rows can be added.
+                if table == 'path' and \
+                   not all(self.prepare_source(conn, source)
+                           for source in merged):
+                    conn.rollback()
+                    return None
+                cur.execute('insert into {} select distinct on ({}) *'
+                            ' from merge_rows on conflict do nothing'.format(
+                                table, keys))
+                count = cur.rowcount
+            if table in ['path', 'meta']:
+                self.bump_generation(conn)
+            conn.commit()
+        except (Exception, psycopg2.DatabaseError) as error:
+            DECODE('Cannot merge rows into %s', table)
+            conn.rollback()
+            return None
+        if sources is not None:
+            sources.update(merged)
+        return count
+
+    def write_rows(self, conn, path_rows=(), meta_rows=(),
+                   quarantine_rows=(), unquarantine_rows=(),
+                   meta_update_rows=()):
+        # execute_values sends up to page_size rows in each statement.
+        statements = [
+            ('''delete from quarantine where (path, source) in'''
+             ''' (values %s);''', unquarantine_rows),
+            ('''insert into quarantine(path,source,bytes,mtime_ns,reason,'''
+             '''time_ns) values %s on conflict do nothing;''',
+             quarantine_rows),
+            ('''insert into meta(md5, metadata) values %s'''
+             ''' on conflict do nothing;''', meta_rows),
+            ('''insert into meta(md5, metadata) values %s'''
+             ''' on conflict (md5) do update set'''
+             ''' metadata = excluded.metadata;''', meta_update_rows),
+            ('''insert into path(path,source,bytes,mtime_ns,md5)'''
+             ''' values %s on conflict do nothing;''', path_rows),
+        ]
+        try:
+            with conn.cursor() as cur:
+                for statement, rows in statements:
+                    if rows:
+                        psycopg2.extras.execute_values(cur, statement, rows,
+                                                       page_size=1000)
+            self.bump_generation(conn)
+            conn.commit()
+        except (Exception, psycopg2.DatabaseError) as error:
+            DECODE('Cannot write %d path rows', len(path_rows))
+            conn.rollback()
+            return False
+        return True
+
+    def _has_generation(self, conn):
+        if self.generation is None:
+            retcode, _, cur = self._execute(
+                ['''select to_regclass('generation') is not null;'''],
+                conn=conn, commit=False)
+            self.generation = retcode and cur.fetchone()[0]
+            cur.close()
+        return self.generation
+
+    def fetch_generation(self, conn):
+        if not self._has_generation(conn):
+            return None
+        retcode, _, cur = self._execute(
+            ['''select value from generation;'''], conn=conn, commit=False)
+        row = cur.fetchone() if retcode else None
+        cur.close()
+        return row[0] if row is not None else None
+
+    def bump_generation(self, conn):
+        if not self._has_generation(conn):
+            return True
+        # Only a transaction that has written something has a transaction
+        # id, so a rescan that finds nothing new keeps the cache valid.
+        retcode, _, _ = self._execute(
+            ['''update generation set value = value + 1'''
+             ''' where txid_current_if_assigned() is not null;'''],
+            conn=conn, commit=False)
+        return retcode
+
+    def _is_partitioned(self, conn):
+        if self.partitioned is None:
+            retcode, _, cur = self._execute(
+                ['''select relkind = 'p' from pg_class'''
+                 ''' where oid = to_regclass('path');'''],
+                conn=conn, commit=False)
+            row = cur.fetchone() if retcode else None
+            self.partitioned = row is not None and row[0]
+            cur.close()
+        return self.partitioned
+
+    @staticmethod
+    def _partition(source):
+        # Sources are arbitrary strings, so partitions are named by a hash.
+        return 'path_' + hashlib.md5(source.encode()).hexdigest()[:16]
+
+    def _lock_partitions(self, conn):
+        # Serializes partition changes until the end of the transaction.
+        return self._execute(
+            ['''select pg_advisory_xact_lock(hashtext('urfiles.path'));'''],
+            conn=conn, commit=False)[0]
+
+    def _has_partition(self, conn, name):
+        retcode, _, cur = self._execute(
+            ['''select to_regclass(%s) is not null;'''], (name,),
+            conn=conn, commit=False)
+        exists = retcode and cur.fetchone()[0]
+        cur.close()
+        return exists
+
+    def prepare_source(self, conn, source):
+        if not self._is_partitioned(conn):
+            return True
+        name = self._partition(source)
+        if self._has_partition(conn, name):
+            return True
+        self._lock_partitions(conn)
+        if self._has_partition(conn, name):
+            return True
+        # Rows already in the default partition for this source have to
+        # move, or the partition could not be attached.
+        commands = [
+            '''create table {} (like path including defaults);'''.format(
+                name),
+            '''insert into {} select * from path_default'''
+            ''' where source = %(source)s;'''.format(name),
+            '''delete from path_default where source = %(source)s;''',
+            '''alter table path attach partition {}'''
+            ''' for values in (%(source)s);'''.format(name),
+        ]
+        retcode, _, _ = self._execute(commands, {'source': source},
+                                      conn=conn, commit=False)
+        if retcode:
+            DEBUG('Partition %s created for source=%s', name, source)
+        return retcode
+
+    def replace_source(self, conn, source, path_rows):
+        if not self._is_partitioned(conn):
+            cur = conn.cursor()
+            cur.execute('''delete from path where source = %s;''',
+                        (source,))
+            cur.copy_expert("copy path from stdin with delimiter ',' csv",
+                            path_rows)
+            cur.close()
+            self.bump_generation(conn)
+            conn.commit()
+            return True
+
+        # The new rows are loaded into a table of their own, which is
+        # indexed when it is attached, and then swapped in for the old
+        # partition in one transaction.
+        name = self._partition(source)
+        self._lock_partitions(conn)
+        cur = conn.cursor()
+        cur.execute('''drop table if exists {}_new;'''.format(name))
+        cur.execute('''create table {}_new (like path including'''
+                    ''' defaults);'''.format(name))
+        cur.copy_expert("copy {}_new from stdin with delimiter ',' csv"
+                        .format(name), path_rows)
+        if self._has_partition(conn, name):
+            cur.execute('''alter table path detach partition {};'''.format(
+                name))
+            cur.execute('''drop table {};'''.format(name))
+        cur.execute('''delete from path_default where source = %s;''',
+                    (source,))
+        cur.execute('''alter table {0}_new rename to {0};'''.format(name))
+        cur.execute('''alter table path attach partition {}'''
+                    ''' for values in (%s);'''.format(name), (source,))
+        cur.close()
+        self.bump_generation(conn)
+        conn.commit()
+        return True
+
+    def drop_source(self, conn, source):
+        commands = [
+            '''delete from quarantine where source = %(source)s;''',
+            '''delete from verify where source = %(source)s;''',
+        ]
+        name = self._partition(source)
+        if self._is_partitioned(conn) and self._has_partition(conn, name):
+            self._lock_partitions(conn)
+            commands += [
+                '''alter table path detach partition {};'''.format(name),
+                '''drop table {};'''.format(name),
+                '''delete from path_default where source = %(source)s;''',
+            ]
+        else:
+            commands.append('''delete from path where source = %(source)s;''')
+        retcode, _, _ = self._execute(commands, {'source': source},
+                                      conn=conn, commit=False)
+        if retcode:
+            self.bump_generation(conn)
+        conn.commit()
+        if retcode:
+            retcode = self.update_stats(conn, [source])
+        return retcode
+
+    def _has_stats(self, conn):
+        if self.stats is None:
+            retcode, _, cur = self._execute(
+                ['''select to_regclass('stats') is not null;'''],
+                conn=conn, commit=False)
+            self.stats = retcode and cur.fetchone()[0]
+            cur.close()
+        return self.stats
+
+    def update_stats(self, conn, sources=None):
+        if not self._has_stats(conn):
+            return True
+        if sources is None:
+            retcode, _, cur = self._execute(
+                ['''select source from stats union'''
+                 ''' select distinct source from path;'''],
+                conn=conn, commit=False)
+            sources = [row[0] for row in cur] if retcode else []
+            cur.close()
+        retcode = True
+        for source in sources:
+            retcode, _, cur = self._execute(
+                [self.STATS.format('%(source)s')], {'source': source},
+                conn=conn, commit=False)
+            if not retcode:
+                break
+            paths, size, md5s, unique = cur.fetchone()
+            cur.close()
+            if paths == 0:
+                commands = ['''delete from stats where source=%(source)s;''']
+            else:
+                commands = [
+                    '''insert into stats(source,paths,bytes,md5s,'''
+                    '''unique_bytes,time_ns) values(%(source)s,%(paths)s,'''
+                    '''%(bytes)s,%(md5s)s,%(unique)s,%(time_ns)s)'''
+                    ''' on conflict(source) do update set'''
+                    ''' paths=excluded.paths, bytes=excluded.bytes,'''
+                    ''' md5s=excluded.md5s,'''
+                    ''' unique_bytes=excluded.unique_bytes,'''
+                    ''' time_ns=excluded.time_ns;''']
+            retcode, _, _ = self._execute(
+                commands, {'source': source, 'paths': paths, 'bytes': size,
+                           'md5s': md5s, 'unique': unique,
+                           'time_ns': time.time_ns()},
+                conn=conn, commit=False)
+            if not retcode:
+                break
+        conn.commit()
+        return retcode
@@ -0,0 +1,714 @@
+#!/usr/bin/env python3
+# db_sqlite.py -*-python-*-
+
+import csv
+import io
+import json
+import os
+import re
+import sqlite3
+import time
+import urfiles.db
+
+# pylint: disable=unused-import
+from urfiles.log import PDLOG_SET_LEVEL, DEBUG, INFO, ERROR, FATAL, DECODE
+
+
+class SqliteConnection():
+    # Writes are buffered and applied in one transaction per batch, so that
+    # a scan worker does not hold the SQLite write lock while it is hashing.
+    # Other processes see the rows once the batch has been committed.
+    def __init__(self, conn, batch_size=1000, interval=1.0,
+                 generation=False):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.interval = interval
+        # Whether the database has a generation table (see --init).
+        self.generation = generation
+        self.path_rows = []
+        self.meta_rows = dict()
+        self.batch_time = time.time()
+
+    def pending(self):
+        return len(self.path_rows) + len(self.meta_rows)
+
+    def maybe_flush(self):
+        if self.pending() >= self.batch_size or \
+           time.time() - self.batch_time > self.interval:
+            self.commit()
+
+    def commit(self):
+        if self.pending() > 0:
+            with self.conn:
+                self.conn.executemany(
+                    'insert or ignore into meta(md5, metadata) values(?,?)',
+                    self.meta_rows.items())
+                self.conn.executemany(
+                    'insert or ignore into path(path,source,bytes,mtime_ns,'
+                    'md5) values(?,?,?,?,?)', self.path_rows)
+                self.bump()
+            self.path_rows = []
+            self.meta_rows = dict()
+        else:
+            self.conn.commit()
+        self.batch_time = time.time()
+
+    def bump(self):
+        if self.generation:
+            self.conn.execute('update generation set value = value + 1')
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+    def cursor(self):
+        return self.conn.cursor()
+
+    def execute(self, command, args=()):
+        return self.conn.execute(command, args)
+
+
+class SqliteDB(urfiles.db.Backend):
+    # Content in one source that has no path row in another.
+    MISSING = \
+        '''select p.md5, max(p.bytes) as bytes, count(*), min(p.path)''' \
+        ''' from path p where p.source = :source and''' \
+        ''' p.md5 is not null and not exists (select 1 from path q''' \
+        ''' where q.source = :missing_from and q.md5 = p.md5)''' \
+        ''' group by p.md5'''
+
+    def __init__(self, config, section='sqlite'):
+        self.config = config
+        self.section = section
+        self.conn = None
+
+        params = dict()
+        if self.section in self.config:
+            for key, value in self.config[self.section].items():
+                params[key] = value
+        self.database = os.path.expanduser(
+            params.get('database', '~/.urfiles.sqlite'))
+        self.batch_size = int(params.get('batch_size', 1000))
+        self.timeout = float(params.get('timeout', 300))
+
+    @staticmethod
+    def _regexp(expr, value):
+        # re caches compiled expressions, so this is not recompiled per row.
+        return value is not None and re.search(expr, value) is not None
+
+    def _connect(self):
+        try:
+            # A connection may be used by one thread at a time, not only by
+            # the thread that opened it (e.g., from the --serve pool).
+            conn = sqlite3.connect(self.database, timeout=self.timeout,
+                                   check_same_thread=False)
+            conn.execute('pragma journal_mode=wal')
+            conn.execute('pragma synchronous=normal')
+            conn.create_function('regexp', 2, self._regexp,
+                                 deterministic=True)
+            generation = conn.execute(
+                '''select 1 from sqlite_master where type='table' and'''
+                ''' name='generation';''').fetchone() is not None
+        except sqlite3.Error:
+            DECODE('Cannot open %s', self.database)
+            return None
+        return SqliteConnection(conn, batch_size=self.batch_size,
+                                generation=generation)
+
+    def _execute(self, commands, args=(), conn=None):
+        close = False
+        if conn is None:
+            conn = self._connect()
+            if conn is None:
+                FATAL('Cannot open database %s', self.database)
+            close = True
+
+        cur = conn.cursor()
+        retcode = True
+        for command in commands:
+            try:
+                cur.execute(command, args)
+            except sqlite3.Error:
+                DECODE('command=%s args=%s failed', command, args)
+                retcode = False
+                break
+        rows = cur.fetchall() if retcode else []
+        cur.close()
+        if close:
+            conn.close()
+        else:
+            conn.conn.commit()
+        return retcode, rows
+
+    def maybe_create(self):
+        commands = [
+            '''create table if not exists path (
+            path text,
+            source text,
+            bytes bigint,
+            mtime_ns bigint,
+            md5 text,
+            primary key(path, source, bytes, mtime_ns)
+            )''',
+
+            '''create table if not exists meta (
+            md5 text primary key,
+            metadata json
+            )''',
+
+            '''create table if not exists quarantine (
+            path text,
+            source text,
+            bytes bigint,
+            mtime_ns bigint,
+            reason text,
+            time_ns bigint,
+            primary key(path, source, bytes, mtime_ns)
+            )''',
+
+            '''create table if not exists verify (
+            path text,
+            source text,
+            bytes bigint,
+            mtime_ns bigint,
+            status text,
+            md5 text,
+            time_ns bigint,
+            primary key(path, source, bytes, mtime_ns)
+            )''',
+
+            '''create table if not exists generation (
+            value bigint
+            )''',
+
+            '''insert into generation(value) select 0 where not exists'''
+            ''' (select 1 from generation)''',
+
+            '''create table if not exists stats (
+            source text primary key,
+            paths bigint,
+            bytes bigint,
+            md5s bigint,
+            unique_bytes bigint,
+            time_ns bigint
+            )''',
+
+            '''create index if not exists path_md5 on path(md5)''',
+
+            '''create index if not exists path_source_md5 on'''
+            ''' path(source, md5)''',
+
+            '''create index if not exists path_bytes on path(bytes)''',
+
+            '''create index if not exists path_mtime_ns on path(mtime_ns)''',
+
+            '''create index if not exists verify_time_ns on verify(time_ns)'''
+        ]
+        conn = self._connect()
+        if conn is None:
+            return False
+        retcode = True
+        for command in commands:
+            retcode, _ = self._execute([command], conn=conn)
+            if not retcode:
+                break
+        conn.close()
+        return retcode
+
+    def drop(self):
+        for suffix in ['', '-wal', '-shm']:
+            try:
+                os.remove(self.database + suffix)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                ERROR('Cannot remove %s: %s', self.database + suffix,
+                      repr(e))
+                return
+        INFO('Database %s dropped', self.database)
+
+    def connect(self):
+        self.conn = self._connect()
+        return self.conn
+
+    def _get_tables(self):
+        _, rows = self._execute(['''select name from sqlite_master where
+        type='table' and name not like 'sqlite_%' order by name;'''])
+        return [row[0] for row in rows]
+
+    def _get_table_size(self, table):
+        # The dbstat virtual table is optional in SQLite builds.
+        retcode, rows = self._execute(
+            ['''select sum(pgsize) from dbstat where name=?;'''], (table,))
+        if not retcode or not rows or rows[0][0] is None:
+            return '?'
+        return '{} kB'.format(rows[0][0] // 1024)
+
+    def _get_table_count(self, table):
+        _, rows = self._execute(['select count(*) from "{}";'.format(
+            table.replace('"', '""'))])
+        return rows[0][0] if rows else 0
+
+    def _get_table_description(self, table):
+        _, rows = self._execute(['pragma table_info("{}");'.format(
+            table.replace('"', '""'))])
+        return [(row[1], row[2]) for row in rows]
+
+    def info(self, exact=False):
+        # SQLite keeps no row estimates, so the counts are always exact.
+        output = []
+        output.append('Database')
+        output.append('  SQLite {} ({})'.format(sqlite3.sqlite_version,
+                                                self.database))
+
+        output.append('Tables')
+        tables = self._get_tables()
+        for table in tables:
+            size = self._get_table_size(table)
+            count = self._get_table_count(table)
+            output.append('  {:<30s} {:<10s} {:>d} entries'.format(table,
+                                                                   size,
+                                                                   count))
+
+        if 'stats' in tables:
+            _, rows = self._execute(['''select source, paths, bytes, md5s,'''
+                                     ''' unique_bytes, time_ns from stats'''
+                                     ''' order by source;'''])
+            output.extend(self._stats_info(rows,
+                                           self._get_table_count('meta')))
+
+        for table in tables:
+            output.append('Description of {}'.format(table))
+            columns = self._get_table_description(table)
+            for column in columns:
+                output.append('  {:<30s} {}'.format(column[0], column[1]))
+
+        return output
+
+    def dump(self, conn, table, fp, fmt='csv', source=None):
+        if table not in self.TABLES:
+            ERROR('Cannot dump %s: not one of %s', table,
+                  ', '.join(sorted(self.TABLES)))
+            return False
+        if fmt != 'csv':
+            ERROR('Only csv dumps are supported with SQLite')
+            return False
+        query, args = self._dump_query(table, source,
+                                       lambda name: ':' + name)
+        text = io.TextIOWrapper(fp, encoding='utf-8',
+                                errors='surrogateescape', newline='')
+        writer = csv.writer(text)
+        cur = conn.execute(query, args)
+        writer.writerow([column[0] for column in cur.description])
+        while True:
+            rows = cur.fetchmany(10000)
+            if not rows:
+                break
+            writer.writerows(rows)
+        cur.close()
+        text.flush()
+        text.detach()
+        return True
+
+    def restore(self, conn, table, fp, fmt='csv'):
+        if table not in self.TABLES:
+            ERROR('Cannot restore %s: not one of %s', table,
+                  ', '.join(sorted(self.TABLES)))
+            return False
+        if fmt != 'csv':
+            ERROR('Only csv dumps are supported with SQLite')
+            return False
+        reader = csv.reader(io.TextIOWrapper(fp, encoding='utf-8',
+                                             errors='surrogateescape',
+                                             newline=''))
+        columns = next(reader, [])
+        known = [row[0] for row in self._get_table_description(table)]
+        if not columns or not set(columns).issubset(known):
+            ERROR('Cannot restore %s: the header does not match its'
+                  ' columns', table)
+            return False
+        # As with PostgreSQL, an empty field is NULL.
+        rows = ([None if value == '' else value for value in row]
+                for row in reader)
+        conn.commit()
+        try:
+            with conn.conn:
+                conn.conn.executemany(
+                    'insert into {}({}) values({})'.format(
+                        table, ','.join(columns),
+                        ','.join(['?'] * len(columns))), rows)
+                conn.bump()
+        except sqlite3.Error:
+            DECODE('Cannot restore %s', table)
+            return False
+        return True
+
+    def fetch_md5s(self):
+        _, rows = self._execute(['''select md5 from meta;'''])
+        return set(row[0] for row in rows)
+
+    def fetch_paths(self, source):
+        _, rows = self._execute(['''select path from path where source=?;'''],
+                                (source,))
+        return set(row[0] for row in rows)
+
+    def iter_md5s(self, conn):
+        # Text is compared as bytes (the BINARY collation).
+        cur = conn.execute('''select md5 from meta order by md5;''')
+        for row in cur:
+            yield row[0]
+        cur.close()
+
+    def iter_source_paths(self, conn, source):
+        cur = conn.execute('''select path from path where source=?'''
+                           ''' order by path;''', (source,))
+        for row in cur:
+            yield row[0]
+        cur.close()
+
+    def insert_path(self, conn, path, source, size, mtime_ns, md5):
+        conn.path_rows.append((path, source, size, mtime_ns, md5))
+        conn.maybe_flush()
+        return True
+
+    def lookup_path(self, conn, path, size, mtime_ns):
+        cur = conn.execute('''select md5 from path where'''
+                           ''' path=? and bytes=? and mtime_ns=?;''',
+                           (path, size, mtime_ns))
+        md5 = cur.fetchone()
+        cur.close()
+        return md5
+
+    def re_path(self, conn, re):
+        cur = conn.execute('''select path,source,bytes,mtime_ns,md5'''
+                           ''' from path where path regexp ?;''', (re,))
+        paths = cur.fetchall()
+        cur.close()
+        return paths
+
+    def iter_paths(self, conn, ordered=False):
+        cur = conn.execute('''select path, source, bytes, mtime_ns, md5'''
+                           ''' from path{};'''.format(
+                               ' order by path, source' if ordered else ''))
+        yield from cur
+        cur.close()
+
+    def iter_meta(self, conn):
+        cur = conn.execute('''select md5, metadata from meta'''
+                           ''' order by md5;''')
+        yield from cur
+        cur.close()
+
+    def search_path(self, conn, criteria, order_by='path', limit=None,
+                    after=None):
+        query, args = self._search_query(criteria, order_by, limit, after,
+                                         lambda name: ':' + name, 'regexp')
+        cur = conn.execute(query, args)
+        paths = cur.fetchall()
+        cur.close()
+        return paths
+
+    def insert_meta(self, conn, md5, metadata):
+        conn.meta_rows[md5] = json.dumps(metadata)
+        conn.maybe_flush()
+        return True
+
+    def lookup_meta(self, conn, md5):
+        if str(md5) in conn.meta_rows:
+            return json.loads(conn.meta_rows[str(md5)])
+        cur = conn.execute('''select metadata from meta where md5=?;''',
+                           (str(md5),))
+        row = cur.fetchone()
+        cur.close()
+        if row is None or row[0] is None:
+            return None
+        return json.loads(row[0])
+
+    def fetch_dups(self, conn, min_size=0, sources=None, limit=None):
+        # SQLite steps through the result as the cursor is iterated, so only
+        # the grouping itself (in SQLite's temporary storage) sees every row.
+        where = 'bytes >= ?'
+        args = [min_size]
+        if sources:
+            where += ' and source in ({})'.format(
+                ','.join(['?'] * len(sources)))
+            args += list(sources)
+        command = \
+            '''select md5, max(bytes),''' \
+            ''' count(distinct source || char(0) || path) as n,''' \
+            ''' max(bytes) * (count(distinct source || char(0) || path)''' \
+            ''' - 1) as r, json_group_array(json_array(source, path))''' \
+            ''' from path where {} and md5 is not null group by md5''' \
+            ''' having n > 1 order by r desc, md5'''.format(where)
+        if limit is not None:
+            command += ' limit ?'
+            args.append(limit)
+        cur = conn.execute(command, args)
+        for md5, size, copies, reclaimable, paths in cur:
+            yield md5, size, copies, reclaimable, \
+                sorted(set(tuple(path) for path in json.loads(paths)))
+        cur.close()
+
+    def fetch_missing(self, conn, source, missing_from):
+        # The anti-join is answered from the path_source_md5 index.
+        cur = conn.execute(self.MISSING + ' order by p.md5',
+                           {'source': source, 'missing_from': missing_from})
+        for row in cur:
+            yield row
+        cur.close()
+
+    def count_missing(self, conn, source, missing_from):
+        cur = conn.execute('''select count(*), coalesce(sum(bytes), 0)'''
+                           ''' from (''' + self.MISSING + ''') m;''',
+                           {'source': source, 'missing_from': missing_from})
+        row = cur.fetchone()
+        cur.close()
+        return tuple(row)
+
+    def fetch_backfill(self, conn, after, limit, version=None):
+        where = "metadata = '{}'"
+        if version is not None:
+            where += " or coalesce(json_extract(metadata," \
+                " '$.extractor_version'), 0) < :version"
+        cur = conn.execute('''select m.md5, p.path, p.bytes, p.mtime_ns'''
+                           ''' from (select md5 from meta where md5 > :after'''
+                           ''' and ({}) order by md5 limit :limit) m'''
+                           ''' left join path p on p.md5 = m.md5'''
+                           ''' order by m.md5;'''.format(where),
+                           {'after': after, 'limit': limit,
+                            'version': version})
+        rows = cur.fetchall()
+        cur.close()
+        return rows
+
+    def update_meta(self, conn, md5, metadata):
+        # Buffered rows are written with "insert or ignore", so an update
+        # must be executed directly, after any pending insert of this md5.
+        if str(md5) in conn.meta_rows:
+            conn.commit()
+        conn.execute('''update meta set metadata=? where md5=?;''',
+                     (json.dumps(metadata), str(md5)))
+        return True
+
+    def bulk_insert(self, conn, path_rows=None, meta_rows=None):
+        conn.commit()
+        with conn.conn:
+            if path_rows:
+                conn.conn.executemany(
+                    'insert or ignore into path(path,source,bytes,mtime_ns,'
+                    'md5) values(?,?,?,?,?)', csv.reader(path_rows))
+            if meta_rows:
+                conn.conn.executemany(
+                    'insert or ignore into meta(md5, metadata) values(?,?)',
+                    csv.reader(meta_rows))
+            conn.bump()
+
+    def fetch_verify(self, conn, before_ns, limit, source=None,
+                     prefix=None, after=None):
+        where = " and substr(p.path, 1, 1) = '/' and instr(p.path, '//') = 0"
+        if source is not None:
+            where += ' and p.source = :source'
+        if prefix is not None:
+            where += ' and substr(p.path, 1, length(:prefix)) = :prefix'
+        args = {'before': before_ns, 'limit': limit, 'source': source,
+                'prefix': prefix}
+        if after is not None:
+            args.update(zip(['time_ns', 'path', 'source_', 'bytes',
+                             'mtime_ns'], after))
+        rows = []
+        if after is None or not after[0]:
+            keyset = ''
+            if after is not None:
+                keyset = ' and (p.path, p.source, p.bytes, p.mtime_ns) >' \
+                    ' (:path, :source_, :bytes, :mtime_ns)'
+            cur = conn.execute('''select p.path, p.source, p.bytes,'''
+                               ''' p.mtime_ns, p.md5, null from path p'''
+                               ''' where not exists (select 1 from verify v'''
+                               ''' where v.path = p.path and'''
+                               ''' v.source = p.source and'''
+                               ''' v.bytes = p.bytes and'''
+                               ''' v.mtime_ns = p.mtime_ns){}{}'''
+                               ''' order by p.path, p.source, p.bytes,'''
+                               ''' p.mtime_ns limit :limit;'''.format(
+                                   where, keyset), args)
+            rows = cur.fetchall()
+            cur.close()
+        if len(rows) < limit:
+            keyset = ''
+            if after is not None and after[0]:
+                keyset = ' and v.time_ns >= :time_ns and (v.time_ns,' \
+                    ' v.path, v.source, v.bytes, v.mtime_ns) >' \
+                    ' (:time_ns, :path, :source_, :bytes, :mtime_ns)'
+            args['limit'] = limit - len(rows)
+            cur = conn.execute('''select p.path, p.source, p.bytes,'''
+                               ''' p.mtime_ns, p.md5, v.time_ns'''
+                               ''' from verify v join path p on'''
+                               ''' p.path = v.path and'''
+                               ''' p.source = v.source and'''
+                               ''' p.bytes = v.bytes and'''
+                               ''' p.mtime_ns = v.mtime_ns'''
+                               ''' where v.time_ns < :before{}{}'''
+                               ''' order by v.time_ns, v.path, v.source,'''
+                               ''' v.bytes, v.mtime_ns limit :limit;'''.format(
+                                   where, keyset), args)
+            rows += cur.fetchall()
+            cur.close()
+        return rows
+
+    def insert_verify(self, conn, path, source, size, mtime_ns, status,
+                      md5):
+        conn.execute('''insert or replace into verify(path,source,bytes,'''
+                     '''mtime_ns,status,md5,time_ns)'''
+                     ''' values(?,?,?,?,?,?,?);''',
+                     (path, source, size, mtime_ns, status, md5,
+                      time.time_ns()))
+        return True
+
+    def insert_quarantine(self, conn, path, source, size, mtime_ns, reason):
+        conn.commit()
+        with conn.conn:
+            conn.execute('''insert or ignore into quarantine(path,source,'''
+                         '''bytes,mtime_ns,reason,time_ns)'''
+                         ''' values(?,?,?,?,?,?);''',
+                         (path, source, size, mtime_ns, reason,
+                          time.time_ns()))
+        return True
+
+    def lookup_quarantine(self, conn, path, size, mtime_ns):
+        cur = conn.execute('''select reason from quarantine where'''
+                           ''' path=? and bytes=? and mtime_ns=?;''',
+                           (path, size, mtime_ns))
+        row = cur.fetchone()
+        cur.close()
+        return row[0] if row is not None else None
+
+    def delete_quarantine(self, conn, path, source):
+        conn.commit()
+        with conn.conn:
+            conn.execute('''delete from quarantine where path=? and'''
+                         ''' source=?;''', (path, source))
+        return True
+
+    @staticmethod
+    def _noting_sources(rows, sources):
+        # Passes rows through, adding their sources to sources.
+        for row in rows:
+            sources.add(row[1])
+            yield row
+
+    def bulk_merge(self, conn, table, rows, sources=None):
+        conn.commit()
+        before = conn.conn.total_changes
+        rows = csv.reader(rows)
+        merged = set()
+        if table != 'meta':
+            rows = self._noting_sources(rows, merged)
+        columns = {'path': 'path,source,bytes,mtime_ns,md5',
+                   'meta': 'md5,metadata',
+                   'quarantine': 'path,source,bytes,mtime_ns,reason,'
+                                 'time_ns'}[table]
+        try:
+            with conn.conn:
+                conn.conn.executemany(
+                    'insert or ignore into {}({}) values({})'.format(
+                        table, columns,
+                        ','.join(['?'] * len(columns.split(',')))), rows)
+                count = conn.conn.total_changes - before
+                if table in ['path', 'meta']:
+                    conn.bump()
+        except sqlite3.Error:
+            DECODE('Cannot merge rows into %s', table)
+            return None
+        if sources is not None:
+            sources.update(merged)
+        return count
+
+    def write_rows(self, conn, path_rows=(), meta_rows=(),
+                   quarantine_rows=(), unquarantine_rows=(),
+                   meta_update_rows=()):
+        conn.commit()
+        try:
+            with conn.conn:
+                conn.conn.executemany(
+                    'delete from quarantine where path=? and source=?',
+                    unquarantine_rows)
+                conn.conn.executemany(
+                    'insert or ignore into quarantine(path,source,bytes,'
+                    'mtime_ns,reason,time_ns) values(?,?,?,?,?,?)',
+                    quarantine_rows)
+                conn.conn.executemany(
+                    'insert or ignore into meta(md5, metadata) values(?,?)',
+                    meta_rows)
+                conn.conn.executemany(
+                    'insert or replace into meta(md5, metadata) values(?,?)',
+                    meta_update_rows)
+                conn.conn.executemany(
+                    'insert or ignore into path(path,source,bytes,mtime_ns,'
+                    'md5) values(?,?,?,?,?)', path_rows)
+                conn.bump()
+        except sqlite3.Error:
+            DECODE('Cannot write %d path rows', len(path_rows))
+            return False
+        return True
+
+    def fetch_generation(self, conn):
+        if not conn.generation:
+            return None
+        cur = conn.execute('''select value from generation;''')
+        row = cur.fetchone()
+        cur.close()
+        return row[0] if row is not None else None
+
+    def bump_generation(self, conn):
+        # Buffered rows change the generation when they are committed, so
+        # this only matters for direct writes, e.g., update_meta.
+        if conn.conn.in_transaction:
+            conn.bump()
+        return True
+
+    def prepare_source(self, conn, source):
+        return True
+
+    def replace_source(self, conn, source, path_rows):
+        conn.commit()
+        with conn.conn:
+            conn.execute('''delete from path where source=?;''', (source,))
+            conn.conn.executemany(
+                'insert or ignore into path(path,source,bytes,mtime_ns,'
+                'md5) values(?,?,?,?,?)', csv.reader(path_rows))
+            conn.bump()
+        return True
+
+    def drop_source(self, conn, source):
+        conn.commit()
+        with conn.conn:
+            for table in ['path', 'verify', 'quarantine']:
+                conn.execute('''delete from {} where source=?;'''.format(
+                    table), (source,))
+            conn.bump()
+        return self.update_stats(conn, [source])
+
+    def update_stats(self, conn, sources=None):
+        conn.commit()
+        if conn.execute('''select 1 from sqlite_master where'''
+                        ''' type='table' and name='stats';''').fetchone() \
+                is None:
+            return True
+        if sources is None:
+            sources = [row[0] for row in conn.execute(
+                '''select source from stats union'''
+                ''' select distinct source from path;''')]
+        with conn.conn:
+            for source in sources:
+                paths, size, md5s, unique = conn.execute(
+                    self.STATS.format('?'), (source,)).fetchone()
+                if paths == 0:
+                    conn.execute('''delete from stats where source=?;''',
+                                 (source,))
+                    continue
+                conn.execute('''insert or replace into stats(source,'''
+                             '''paths,bytes,md5s,unique_bytes,time_ns)'''
+                             ''' values(?,?,?,?,?,?);''',
+                             (source, paths, size, md5s, unique,
+                              time.time_ns()))
+        return True
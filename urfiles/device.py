@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# device.py -*-python-*-
+
+import fcntl
+import os
+import struct
+
+# pylint: disable=unused-import
+from urfiles.log import DEBUG, INFO, ERROR, FATAL
+
+
+class Device():
+    # From linux/fs.h and linux/fiemap.h
+    FS_IOC_FIEMAP = 0xC020660B
+    FIEMAP_HEADER = '=QQLLLL'
+    FIEMAP_EXTENT = '=QQQQQLLLL'
+
+    rotational_cache = dict()
+
+    @staticmethod
+    def rotational(dev):
+        # Returns True for spinning disks, False for SSD/NVMe, and None when
+        # this cannot be determined (e.g., network or virtual file systems).
+        if dev in Device.rotational_cache:
+            return Device.rotational_cache[dev]
+        result = None
+        sysdir = '/sys/dev/block/{}:{}'.format(os.major(dev), os.minor(dev))
+        # Partitions do not have a queue directory, but their parent does.
+        for path in [os.path.join(sysdir, 'queue', 'rotational'),
+                     os.path.join(os.path.realpath(sysdir), '..', 'queue',
+                                  'rotational')]:
+            try:
+                with open(path, 'r') as fp:
+                    result = fp.read().strip() == '1'
+                break
+            except OSError:
+                continue
+        Device.rotational_cache[dev] = result
+        DEBUG('dev=%d:%d rotational=%s', os.major(dev), os.minor(dev),
+              result)
+        return result
+
+    @staticmethod
+    def physical_offset(path):
+        # Returns the physical offset of the first extent of path, or None
+        # if the file system does not support FIEMAP.
+        extent_size = struct.calcsize(Device.FIEMAP_EXTENT)
+        request = struct.pack(Device.FIEMAP_HEADER, 0, 2**64 - 1, 0, 0, 1,
+                              0) + bytes(extent_size)
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+        except OSError:
+            return None
+        try:
+            response = fcntl.ioctl(fd, Device.FS_IOC_FIEMAP, request)
+        except OSError:
+            return None
+        finally:
+            os.close(fd)
+        header_size = struct.calcsize(Device.FIEMAP_HEADER)
+        mapped = struct.unpack_from(Device.FIEMAP_HEADER, response)[3]
+        if mapped == 0:
+            return None
+        return struct.unpack_from(Device.FIEMAP_EXTENT, response,
+                                  header_size)[1]
+
+    @staticmethod
+    def order(dirname, names):
+        # Orders the names in a batch by their physical location, where
+        # FIEMAP is available. Names without an offset keep their (inode)
+        # order, after the others.
+        offsets = dict()
+        for name in names:
+            offsets[name] = Device.physical_offset(os.path.join(dirname,
+                                                                name))
+        if all(offset is None for offset in offsets.values()):
+            return names
+        return sorted(names, key=lambda name: (offsets[name] is None,
+                                               offsets[name] or 0))
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# dups.py -*-python-*-
+
+import traceback
+import urfiles.db
+
+# pylint: disable=unused-import
+from urfiles.log import DEBUG, INFO, ERROR, FATAL
+
+
+class Dups():
+    def __init__(self, config, min_size=0, sources=None, limit=None,
+                 debug=False):
+        self.config = config
+        self.min_size = min_size
+        self.sources = sources
+        self.limit = limit
+        self.debug = debug
+
+    def dups(self):
+        # Groups are yielded as they are read, so the caller can print them
+        # without holding the whole report in memory.
+        try:
+            db = urfiles.db.DB(self.config.config)
+            conn = db.connect()
+        except Exception as exception:
+            FATAL(traceback.format_exc())
+
+        groups = 0
+        reclaimable = 0
+        for group in db.fetch_dups(conn, min_size=self.min_size,
+                                   sources=self.sources, limit=self.limit):
+            groups += 1
+            reclaimable += group[3]
+            yield group
+        conn.close()
+        INFO('%d duplicate groups, %d bytes reclaimable', groups,
+             reclaimable)
@@ -20,12 +20,14 @@ class Format():
     def __init__(self, debug=False):
         self.debug = debug
 
-    def pretty_print(self, pathdata, metadata, full=False):
+    def pretty_print(self, pathdata, metadata, full=False, ordered=False):
+        # With ordered=True, pathdata is printed in the order given.
         seen = set()
         result = ''
         if self.debug:
             print(sorted(pathdata.items()))
-        for path, source, size, mtime_ns, md5 in sorted(pathdata):
+        for path, source, size, mtime_ns, md5 in \
+                (pathdata if ordered else sorted(pathdata)):
             result += path + '\n'
             result += '    {} ({}) {} [{}]'.format(
                 size,
@@ -50,3 +52,26 @@ class Format():
                 seen.add(md5)
             result += '\n'
         return result
+
+    def pretty_print_missing(self, md5, size, copies, path):
+        return '{} {} ({}) {} {}\n'.format(
+            md5, size, humanize.naturalsize(size, binary=True),
+            copies if copies > 1 else ' ', path)
+
+    def pretty_print_missing_summary(self, source, missing_from, contents,
+                                     size):
+        return '{} md5s, {} ({}), in [{}] are not in [{}]\n'.format(
+            contents, size, humanize.naturalsize(size, binary=True), source,
+            missing_from)
+
+    def pretty_print_dups(self, md5, size, copies, reclaimable, paths):
+        result = '{} ({}) reclaimable: {} copies of {} ({}) {}\n'.format(
+            reclaimable,
+            humanize.naturalsize(reclaimable, binary=True),
+            copies,
+            size,
+            humanize.naturalsize(size, binary=True),
+            md5)
+        for source, path in paths:
+            result += '    [{}] {}\n'.format(source, path)
+        return result
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# hasher.py -*-python-*-
+
+import hashlib
+import mmap
+import os
+
+# pylint: disable=unused-import
+from urfiles.log import DEBUG, INFO, ERROR, FATAL
+
+
+class Hasher():
+    # Files are read once, front to back, and never again, so the hasher
+    # tells the kernel to read ahead (SEQUENTIAL) and to drop the pages it
+    # has already hashed (DONTNEED). That keeps a multi-TB scan from evicting
+    # the working set of everything else on the host. With direct=True, the
+    # page cache is bypassed entirely using O_DIRECT and an aligned buffer.
+    DONTNEED_WINDOW = 2**23
+    ALIGNMENT = 4096
+
+    def __init__(self, block_size=2**20, dontneed=True, direct=False,
+                 device_block_sizes=None):
+        self.block_size = block_size
+        self.dontneed = dontneed and hasattr(os, 'posix_fadvise')
+        self.direct = direct and hasattr(os, 'O_DIRECT')
+        self.device_block_sizes = device_block_sizes or dict()
+        self.buffer = None
+
+    @staticmethod
+    def parse_size(value):
+        value = str(value).strip().upper()
+        multiplier = 1
+        for suffix, power in [('K', 10), ('M', 20), ('G', 30)]:
+            if value.endswith(suffix):
+                value = value[:-1]
+                multiplier = 2**power
+                break
+        return int(value) * multiplier
+
+    @staticmethod
+    def from_config(config):
+        # The [hash] section sets the defaults. A section named after a
+        # mount point, e.g. [hash /mnt/archive], sets the block size for the
+        # device that holds that mount point.
+        section = config['hash'] if 'hash' in config else dict()
+        block_size = Hasher.parse_size(section.get('block_size', 2**20))
+        device_block_sizes = dict()
+        for name in config.sections():
+            if not name.startswith('hash '):
+                continue
+            mountpoint = name[5:].strip()
+            try:
+                dev = os.stat(mountpoint).st_dev
+            except OSError as e:
+                ERROR('Ignoring [%s]: %s', name, repr(e))
+                continue
+            device_block_sizes[dev] = Hasher.parse_size(
+                config[name].get('block_size', block_size))
+        return Hasher(block_size=block_size,
+                      dontneed=str(section.get('dontneed', 'yes')).lower()
+                      in ['yes', 'true', 'on', '1'],
+                      direct=str(section.get('direct', 'no')).lower()
+                      in ['yes', 'true', 'on', '1'],
+                      device_block_sizes=device_block_sizes)
+
+    def _block_size(self, dev):
+        block_size = self.device_block_sizes.get(dev, self.block_size)
+        if self.direct:
+            # O_DIRECT reads must be a multiple of the logical block size.
+            block_size = max(block_size // self.ALIGNMENT, 1) * self.ALIGNMENT
+        return block_size
+
+    def _md5_direct(self, fd, block_size):
+        # mmap returns page-aligned memory, as O_DIRECT requires.
+        if self.buffer is None or len(self.buffer) != block_size:
+            self.buffer = mmap.mmap(-1, block_size)
+        checksum = hashlib.md5()
+        view = memoryview(self.buffer)
+        while True:
+            count = os.readv(fd, [self.buffer])
+            if count == 0:
+                break
+            checksum.update(view[:count])
+        view.release()
+        return checksum.hexdigest()
+
+    def _md5_buffered(self, fd, block_size):
+        if self.dontneed:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        checksum = hashlib.md5()
+        offset = 0
+        dropped = 0
+        while True:
+            data = os.read(fd, block_size)
+            if not data:
+                break
+            checksum.update(data)
+            offset += len(data)
+            if self.dontneed and offset - dropped >= self.DONTNEED_WINDOW:
+                os.posix_fadvise(fd, dropped, offset - dropped,
+                                 os.POSIX_FADV_DONTNEED)
+                dropped = offset
+        if self.dontneed:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        return checksum.hexdigest()
+
+    def md5(self, path, dev=None):
+        block_size = self._block_size(dev)
+        if self.direct:
+            try:
+                fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+            except OSError:
+                # Some file systems (e.g., tmpfs) do not support O_DIRECT.
+                fd = None
+            if fd is not None:
+                try:
+                    return self._md5_direct(fd, block_size)
+                except OSError:
+                    # EINVAL means the alignment was not acceptable here.
+                    pass
+                finally:
+                    os.close(fd)
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            return self._md5_buffered(fd, block_size)
+        finally:
+            os.close(fd)
@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 # identify.py -*-python-*-
 
-import hashlib
+import io
 import json
 import os
 import re
+import stat
 import subprocess
 
 try:
@@ -27,15 +28,46 @@ except ImportError as e:
 # Consider: apt-get install python3-pymediainfo'''.format(e))
     raise SystemExit from e
 
+import urfiles.hasher
+import urfiles.sandbox
+
 # pylint: disable=unused-import
 from urfiles.log import DEBUG, INFO, ERROR, FATAL
 
 
 class Identify():
-    def __init__(self, file, block_size=2**20, debug=False):
+    # Stored in the metadata of regular files as extractor_version. Increase
+    # it when the extractors change, so that --backfill --stale can find
+    # metadata produced by older versions.
+    VERSION = 1
+
+    # Extractors that cannot be run in this process (see
+    # ExtractorUnavailable). Each is reported once, and then skipped.
+    unavailable = set()
+
+    def __init__(self, file, block_size=2**20, debug=False, hasher=None,
+                 sandbox=None, timeout=None, buffer=None):
         self.file = file
         self.block_size = block_size
         self.debug = debug
+        # With a sandbox, the native extractors run in a helper process with
+        # a deadline. Extractors that fail or time out are recorded in
+        # failures as (extractor, reason), and id() carries on without them.
+        self.sandbox = sandbox
+        self.timeout = timeout
+        self.failures = []
+        # Whether an unavailable extractor was skipped.
+        self.incomplete = False
+        # With a buffer, metadata is extracted from the buffer, and file is
+        # only a name (e.g., of an archive member).
+        self.buffer = buffer
+        # System calls made by id() itself (not by the extractors), so that
+        # the scan can report syscalls per file.
+        self.syscalls = 0
+        if hasher is not None:
+            self.hasher = hasher
+        else:
+            self.hasher = urfiles.hasher.Hasher(block_size=block_size)
 
     @staticmethod
     def _add(result, field, data, append=False, force=False):
@@ -78,7 +110,9 @@ class Identify():
 
     def mediainfo(self):
         result = dict()
-        mi = pymediainfo.MediaInfo.parse(self.file, cover_data=True)
+        mi = pymediainfo.MediaInfo.parse(
+            io.BytesIO(self.buffer) if self.buffer is not None else self.file,
+            cover_data=True)
 
         if self.debug:
             print(json.dumps(json.loads(mi.to_json()), indent=4,
@@ -96,17 +130,33 @@ class Identify():
                 self._extract_text(result, track)
         return result
 
+    def magic(self):
+        if self.buffer is not None:
+            return magic.from_buffer(self.buffer)
+        return magic.from_file(self.file)
+
     def exinfo(self):
         result = dict()
-        proc = subprocess.run(['exiftool', '-c', '%f', '-j',
-                               self.file],
-                              capture_output=True,
-                              text=True,
-                              check=False)
+        try:
+            proc = subprocess.run(['exiftool', '-c', '%f', '-j',
+                                   self.file if self.buffer is None else '-'],
+                                  input=self.buffer,
+                                  capture_output=True,
+                                  check=False,
+                                  timeout=self.timeout)
+        except FileNotFoundError as e:
+            raise urfiles.sandbox.ExtractorUnavailable(
+                'exiftool is not installed') from e
+        # exiftool runs in a process of its own, so it needs no sandbox. It
+        # exits with 1 for files it cannot read, which is not a fault, but
+        # being killed by a signal is.
+        if proc.returncode < 0:
+            raise urfiles.sandbox.ExtractorError(
+                'exiftool killed by signal {}'.format(-proc.returncode))
         if proc.returncode != 0:
             return result
 
-        metadata = json.loads(proc.stdout)[0]
+        metadata = json.loads(proc.stdout.decode('utf-8', 'replace'))[0]
         if self.debug:
             print(json.dumps(metadata, indent=4, sort_keys=False))
 
@@ -133,35 +183,89 @@ class Identify():
         self._add(result, 'gps_lat', metadata.get('GPSLatitude', None))
         return result
 
-    def md5(self):
-        checksum = hashlib.md5()
-        with open(self.file, 'rb') as f:
-            while True:
-                data = f.read(self.block_size)
-                if not data:
-                    break
-                checksum.update(data)
-        return checksum.hexdigest()
-
-    def id(self, checksum=True):
+    def _extract(self, extractor, function):
+        if extractor in Identify.unavailable:
+            self.incomplete = True
+            return None
+        try:
+            if self.sandbox is not None and \
+               extractor in urfiles.sandbox.Sandbox.EXTRACTORS:
+                return self.sandbox.run(extractor, self.file,
+                                        buffer=self.buffer)
+            return function()
+        except subprocess.TimeoutExpired as e:
+            reason = 'timeout after {:.0f}s'.format(e.timeout)
+        except urfiles.sandbox.ExtractorUnavailable as e:
+            Identify.unavailable.add(extractor)
+            ERROR('%s: skipping %s for this run', e, extractor)
+            self.incomplete = True
+            return None
+        except Exception as e:
+            reason = str(e) if isinstance(
+                e, urfiles.sandbox.ExtractorError) else repr(e)
+        self.failures.append((extractor, reason))
+        return None
+
+    def _extract_all(self, result):
+        result.update(self._extract('mediainfo', self.mediainfo) or dict())
+        if 'format' not in result:
+            description = self._extract('magic', self.magic)
+            if description is not None:
+                result['magic'] = description
+
+        # Was originall only for PDF, JPEG, TIFF, and PNG, but might as
+        # well get exif for every file
+        result.update(self._extract('exiftool', self.exinfo) or dict())
+        # Metadata without the fields of an extractor that failed or could
+        # not be run has no extractor_version, so that --backfill --stale
+        # completes it later.
+        if not self.failures and not self.incomplete:
+            result['extractor_version'] = self.VERSION
+
+    def id_buffer(self):
+        # Metadata for the contents of buffer, which is a regular file.
+        result = {'type': 'file'}
+        self._extract_all(result)
+        return result
+
+    def md5(self, dev=None):
+        return self.hasher.md5(self.file, dev=dev)
+
+    def _stat(self):
+        self.syscalls += 1
+        try:
+            return os.stat(self.file)
+        except OSError:
+            pass
+        # A dangling symbolic link
+        self.syscalls += 1
+        try:
+            return os.lstat(self.file)
+        except OSError:
+            return None
+
+    def id(self, checksum=True, statinfo=None):
+        # If the caller has already called os.stat on the file, statinfo
+        # saves the stat and access calls here. A file the caller has
+        # stat'ed and hashed is known to be readable.
         result = dict()
         md5 = 0
-        if os.path.isfile(self.file):
+        readable = statinfo is not None
+        if statinfo is None:
+            statinfo = self._stat()
+        mode = statinfo.st_mode if statinfo is not None else 0
+        if stat.S_ISREG(mode):
             result['type'] = 'file'
-            if os.access(self.file, os.R_OK):
-                result.update(self.mediainfo())
-                if 'format' not in result:
-                    result['magic'] = magic.from_file(self.file)
-
-                # Was originall only for PDF, JPEG, TIFF, and PNG, but might as
-                # well get exif for every file
-                result.update(self.exinfo())
-
+            if not readable:
+                self.syscalls += 1
+                readable = os.access(self.file, os.R_OK)
+            if readable:
+                self._extract_all(result)
                 if checksum:
                     md5 = self.md5()
-        elif os.path.isdir(self.file):
+        elif stat.S_ISDIR(mode):
             result['type'] = 'directory'
-        elif os.path.islink(self.file):
+        elif stat.S_ISLNK(mode):
             result['type'] = 'link'
         else:
             result['type'] = 'unknown'
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# ingest.py -*-python-*-
+
+import gzip
+import os
+import urfiles.db
+import urfiles.spool
+
+# pylint: disable=unused-import
+from urfiles.log import DEBUG, INFO, ERROR, FATAL
+
+
+class Ingest():
+    def __init__(self, directories, config, debug=False):
+        self.directories = directories
+        self.config = config
+        self.debug = debug
+
+    def _ingest_file(self, db, conn, table, filename, sources):
+        # A file that cannot be merged is left in the spool directory.
+        # bulk_merge rolls back its transaction, so nothing from the file is
+        # committed, and the connection can be used for the next file.
+        try:
+            with gzip.open(filename, 'rt', newline='') as fp:
+                count = db.bulk_merge(conn, table, fp, sources=sources)
+        except (OSError, EOFError) as e:
+            ERROR('Cannot ingest %s: %s', filename, repr(e))
+            return False
+        if count is None:
+            ERROR('Cannot ingest %s', filename)
+            return False
+        INFO('%s: %d new %s rows', filename, count, table)
+        return True
+
+    @staticmethod
+    def _done_name(done, filename):
+        # Worker process IDs are reused, so a later spool file can have the
+        # name of one that is already in done. It is not overwritten.
+        name = os.path.basename(filename)
+        stem = name[:-len('.csv.gz')]
+        count = 0
+        while os.path.exists(os.path.join(done, name)):
+            count += 1
+            name = '{}-{}.csv.gz'.format(stem, count)
+        return os.path.join(done, name)
+
+    def ingest(self):
+        try:
+            db = urfiles.db.DB(self.config.config)
+            conn = db.connect()
+        except Exception as e:
+            FATAL('Cannot connect to database: %s', repr(e))
+
+        sources = set()
+        for directory in self.directories:
+            done = os.path.join(directory, 'ingested')
+            os.makedirs(done, exist_ok=True)
+            # Metadata is ingested first, so that a path row never refers
+            # to content without a meta row.
+            for table in ['meta', 'path', 'quarantine']:
+                for filename in urfiles.spool.Spool.spool_files(directory,
+                                                                table):
+                    if self._ingest_file(db, conn, table, filename,
+                                         sources):
+                        os.rename(filename,
+                                  self._done_name(done, filename))
+        INFO('Updating stats for %d sources', len(sources))
+        db.update_stats(conn, sorted(sources))
+        conn.close()
+        INFO('Data ingested')
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# journal.py -*-python-*-
+
+import hashlib
+import json
+import os
+import time
+
+# pylint: disable=unused-import
+from urfiles.log import DEBUG, INFO, ERROR, FATAL
+
+
+class Journal():
+    # The journal is an append-only file of JSON records, one per line:
+    #   ["header", {...}]   parameters of the scan that wrote the journal
+    #   ["queued", dir]     dir has been queued for scanning
+    #   ["completed", dir]  every file directly in dir has been scanned, and
+    #                       its subdirectories have been queued
+    #   ["done"]            the scan finished
+    # Directories that were queued but not completed are pending, and are
+    # queued again when the scan is resumed.
+
+    def __init__(self, filename, interval=10.0):
+        self.filename = filename
+        self.interval = interval
+        self.fp = None
+        self.flush_time = time.time()
+        self.pending = dict()
+        self.completed = set()
+        self.done = False
+
+    @staticmethod
+    def default_filename(directories, source):
+        key = json.dumps([sorted(directories), source])
+        return os.path.join(os.path.expanduser('~/.cache/urfiles'),
+                            'scan-{}.journal'.format(
+                                hashlib.sha1(key.encode()).hexdigest()[:16]))
+
+    def _write(self, record):
+        self.fp.write(json.dumps(record) + '\n')
+
+    def _replay(self, header):
+        try:
+            fp = open(self.filename, 'r')
+        except FileNotFoundError:
+            return False
+        with fp:
+            for count, line in enumerate(fp):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line may be incomplete after a crash.
+                    ERROR('%s:%d: ignoring corrupt record', self.filename,
+                          count + 1)
+                    continue
+                if record[0] == 'header':
+                    if record[1] != header:
+                        FATAL('%s was written by a different scan: %s',
+                              self.filename, record[1])
+                elif record[0] == 'queued':
+                    self.pending[record[1]] = True
+                elif record[0] == 'completed':
+                    self.pending.pop(record[1], None)
+                    self.completed.add(record[1])
+                elif record[0] == 'done':
+                    self.done = True
+        return True
+
+    def open(self, header, resume=False):
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)),
+                    exist_ok=True)
+        if resume and self._replay(header):
+            INFO('Resuming from %s: %d directories completed, %d pending',
+                 self.filename, len(self.completed), len(self.pending))
+            self.fp = open(self.filename, 'a')
+        else:
+            if resume:
+                INFO('No journal in %s, starting from the beginning',
+                     self.filename)
+            self.fp = open(self.filename, 'w')
+            self._write(['header', header])
+        self.flush(sync=True)
+
+    def queued(self, dirname):
+        self._write(['queued', dirname])
+
+    def complete(self, dirname):
+        self.completed.add(dirname)
+        self._write(['completed', dirname])
+
+    def flush(self, sync=False):
+        self.fp.flush()
+        if sync:
+            os.fsync(self.fp.fileno())
+        self.flush_time = time.time()
+
+    def maybe_flush(self):
+        if time.time() - self.flush_time > self.interval:
+            self.flush(sync=True)
+
+    def close(self, done=True):
+        if done:
+            self._write(['done'])
+        self.flush(sync=True)
+        self.fp.close()
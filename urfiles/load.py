@@ -2,38 +2,64 @@
 # load.py -*-python-*-
 
 import csv
-import io
 import os
 import re
+import tempfile
 import time
+import urfiles.compact
 import urfiles.db
+import urfiles.manifest
+import urfiles.progress
 
 # pylint: disable=unused-import
 from urfiles.log import DEBUG, INFO, ERROR, FATAL
 
 class Load():
+    # Load keeps little in memory, so that tapes with tens of millions of
+    # files can be loaded: md5sum.txt and stat.txt are each sorted by path
+    # with an external merge sort and then joined; the known md5s and paths
+    # are held in compact sets; and the rows to insert are written to
+    # temporary CSV files.
     def __init__(self, directories, config, source=None, debug=False,
-                 md5file='md5sum.txt', statfile='stat.txt'):
+                 md5file='md5sum.txt', statfile='stat.txt', report=None,
+                 replace=False, max_lines=250000):
         self.directories = directories
         self.config = config
         self.source = source
         self.debug = debug
+        # With replace, the rows loaded replace all the rows of the source,
+        # rather than being added to them.
+        self.replace = replace
         self.md5file = md5file
         self.statfile = statfile
-        self.md5 = dict()
+        self.report = report
+        self.max_lines = max_lines
+        self.progress = urfiles.progress.Progress('load')
 
-        # List of all known md5s
-        self.known_md5s = set()
+        # Every md5 in meta, and the paths already loaded for the source
+        self.known_md5s = urfiles.compact.DigestSet()
+        self.known_paths = urfiles.compact.PathSet()
 
-        # Lists of data that needs updating in the database
-        self.path_data = []
-        self.meta_data = []
+        # Lines of "escaped path\0md5" and "escaped path\0size\0mtime_ns"
+        # for the current directory, and the md5s that are not in meta
+        self.md5s = None
+        self.stats = None
+        self.new_md5s = None
 
-    def _unescape(self, path):
-        result = path.replace(r'\\', '\\').replace(r'\n', '\n')
-#        if path != result:
-#            INFO('path=%s -> %s', path, result)
-        return result
+        # Rows that need to be added to the database
+        self.path_rows = None
+        self.path_count = 0
+        # The meta rows written, over all directories
+        self.meta_count = 0
+
+    @staticmethod
+    def _unescape(path):
+        # The inverse of Manifest.escape. (Replacing the two escapes in turn
+        # would read an escaped backslash followed by n as a newline.)
+        if '\\' not in path:
+            return path
+        return re.sub(r'\\([\\n])',
+                      lambda m: '\n' if m.group(1) == 'n' else '\\', path)
 
     def _load_md5file(self, directory):
         filename = os.path.join(directory, self.md5file)
@@ -65,7 +91,8 @@ class Load():
                 path = self._unescape(path)
             if re.search('md5sum.txt', path):
                 INFO(path)
-            self.md5[path] = md5
+            self.md5s.add('{}\0{:012d}\0{}\n'.format(self._key(path), count,
+                                                    md5))
             count += 1
             if time.time() - current_time > 1.0:
                 INFO('%d lines read', count)
@@ -73,30 +100,35 @@ class Load():
 
         INFO('%d lines read', count)
 
-    def _file(self, db, conn, path, source, size, mtime_ns):
-        # Look up the md5 for this file
-        try:
-            md5 = self.md5[path]
-        except KeyError as e:
+    @staticmethod
+    def _key(path):
+        # Paths are sorted in their escaped form, which has no newlines.
+        return urfiles.manifest.Manifest.escape(path)[0]
+
+    def _file(self, db, conn, path, source, size, mtime_ns, md5):
+        self.progress.counts['files'] += 1
+        self.progress.counts['bytes'] += int(size)
+        if md5 is None:
             ERROR('Cannot find md5 for path="%s"', path)
+            self.progress.counts['skipped'] += 1
             return
 
         if path not in self.known_paths:
-            self.path_data.append([path, source, size, mtime_ns, md5])
+            self.path_rows.writerow([path, source, size, mtime_ns, md5])
+            self.path_count += 1
+            self.progress.counts['new'] += 1
+        else:
+            self.progress.counts['unchanged'] += 1
 
         if md5 not in self.known_md5s:
-            self.meta_data.append([md5, '{}'])
-            self.known_md5s.add(md5)
+            self.new_md5s.add(md5 + '\n')
 
-    def _load_statfile(self, directory, db, conn):
+    def _source(self, directory):
         if self.source is None:
-            source = os.path.basename(directory)
-        else:
-            source = self.source
-
-        INFO('Reading paths for source=%s', source)
-        self.known_paths = db.fetch_paths(source)
+            return os.path.basename(directory)
+        return self.source
 
+    def _load_statfile(self, directory):
         filename = os.path.join(directory, self.statfile)
         if not os.path.isfile(filename):
             ERROR('Cannot find %s', filename)
@@ -110,15 +142,39 @@ class Load():
 
         INFO('Reading %s', filename)
 
+        # stat.txt files written by --manifest --filename-last start with a
+        # header, and have the (escaped) file name at the end of the line.
+        filename_last = fp.readline()
+        if filename_last != urfiles.manifest.Manifest.STAT_HEADER:
+            fp.seek(0)
+            filename_last = None
+
         current_time = time.time()
         count = 0
         for line in fp:
+            if filename_last:
+                try:
+                    _, _, size, _, _, timestamp, _, tm, _, path = \
+                        line.rstrip('\n').split(' ', 9)
+                except ValueError as e:
+                    ERROR('Cannot split "%s": %s', line.strip(), repr(e))
+                    self.progress.counts['errors'] += 1
+                    continue
+                path = self._unescape(path)
+                ns = re.sub(r'^.*\.', '', tm)
+                mtime_ns = int(timestamp) * 10**9 + int(ns)
+                self.stats.add('{}\0{}\0{}\n'.format(self._key(path), size,
+                                                     mtime_ns))
+                count += 1
+                continue
+
             try:
                 # Because we anchor with a number, we won' have the correct
                 # mode.
                 path, attr = re.split(r' r [0-9]', line)
             except ValueError as e:
                 ERROR('Cannot split "%s": %s', line.strip(), repr(e))
+                self.progress.counts['errors'] += 1
                 continue
 
             path = path.strip()
@@ -126,31 +182,119 @@ class Load():
             ns = re.sub(r'^.*\.', '', tm)
             mtime_ns = int(float(timestamp) * 1e9 + int(ns))
 
-            self._file(db, conn, path, source, size, mtime_ns)
+            self.stats.add('{}\0{}\0{}\n'.format(self._key(path), size,
+                                                 mtime_ns))
             count += 1
             if time.time() - current_time > 1.0:
                 INFO('%d lines read', count)
                 current_time = time.time()
+                self.progress.log()
 
-        INFO('%d lines read: %d path updates and %d meta updates pending',
-             count, len(self.path_data), len(self.meta_data))
+        INFO('%d lines read', count)
+
+    def _md5s(self):
+        # Yields (encoded key, md5) for each path in md5sum.txt, in order.
+        # Lines for the same path are sorted by line number, and the last one
+        # wins.
+        key, md5 = None, None
+        for line in self.md5s.merged():
+            next_key, _, next_md5 = line.rstrip('\n').split('\0')
+            if key is not None and next_key != key:
+                yield urfiles.manifest.Sorter._key(key), md5
+            key, md5 = next_key, next_md5
+        if key is not None:
+            yield urfiles.manifest.Sorter._key(key), md5
 
-    def _update_database(self, db, conn):
+    def _join(self, db, conn, source):
+        # Both files are now sorted by path, so the md5 for each stat.txt
+        # line is found by stepping through md5sum.txt alongside it.
+        md5s = self._md5s()
+        current = next(md5s, (None, None))
+        current_time = time.time()
+        for line in self.stats.merged():
+            key, size, mtime_ns = line.rstrip('\n').split('\0')
+            encoded = urfiles.manifest.Sorter._key(key)
+            while current[0] is not None and current[0] < encoded:
+                current = next(md5s, (None, None))
+            md5 = current[1] if current[0] == encoded else None
+            self._file(db, conn, self._unescape(key), source, size,
+                       int(mtime_ns), md5)
+            if time.time() - current_time > 1.0:
+                current_time = time.time()
+                self.progress.log()
+        self.md5s.close()
+        self.stats.close()
+
+    def _update_database(self, db, conn, source, tmpdir):
         INFO('Preparing data for bulk load')
-        path_rows = io.StringIO()
-        path_writer = csv.writer(path_rows)
-        path_writer.writerows(self.path_data)
-
-        meta_rows = io.StringIO()
-        meta_writer = csv.writer(meta_rows)
-        meta_writer.writerows(self.meta_data)
-
-        path_rows.seek(0)
-        meta_rows.seek(0)
-        INFO('Bulk load starting')
-        db.bulk_insert(conn, path_rows=path_rows, meta_rows=meta_rows)
+        self.path_rows.seek(0)
+
+        # new_md5s has an md5 for each new path: write each one once.
+        def written(meta_writer):
+            previous = None
+            for line in self.new_md5s.merged():
+                if line != previous:
+                    meta_writer.writerow([line.rstrip('\n'), '{}'])
+                    yield line.rstrip('\n')
+                previous = line
+
+        with open(os.path.join(tmpdir, 'meta.csv'), 'w+',
+                  newline='') as meta_rows:
+            new_md5s = urfiles.compact.DigestSet(
+                written(csv.writer(meta_rows)))
+            meta_count = len(new_md5s)
+            self.meta_count += meta_count
+            self.new_md5s.close()
+            meta_rows.seek(0)
+
+            INFO('%d path updates and %d meta updates pending',
+                 self.path_count, meta_count)
+            INFO('Bulk load starting')
+            if self.replace and not self.path_count:
+                # E.g., stat.txt could not be read.
+                ERROR('No paths for source=%s: not replacing it', source)
+                db.bulk_insert(conn, meta_rows=meta_rows)
+            elif self.replace:
+                db.replace_source(conn, source, self.path_rows)
+                db.bulk_insert(conn, meta_rows=meta_rows)
+            else:
+                db.prepare_source(conn, source)
+                db.bulk_insert(conn, path_rows=self.path_rows,
+                               meta_rows=meta_rows)
+        # A later directory of the same load may have the same new content,
+        # which must not be written to meta again.
+        self.known_md5s.update(new_md5s)
+        db.update_stats(conn, [source])
         INFO('Bulk load finished')
 
+    def _load_directory(self, db, conn, directory, tmpdir):
+        source = self._source(directory)
+        if self.replace:
+            self.known_paths = urfiles.compact.PathSet()
+        else:
+            INFO('Reading paths for source=%s', source)
+            self.known_paths = urfiles.compact.PathSet(
+                db.iter_source_paths(conn, source))
+
+        self.md5s = urfiles.manifest.Sorter(tmpdir, self.max_lines)
+        self.stats = urfiles.manifest.Sorter(tmpdir, self.max_lines)
+        self.new_md5s = urfiles.manifest.Sorter(tmpdir, self.max_lines)
+        try:
+            self._load_md5file(directory)
+        except UnicodeDecodeError as e:
+            FATAL('Cannot parse from %s: %s', directory, repr(e))
+        self._load_statfile(directory)
+
+        with open(os.path.join(tmpdir, 'path.csv'), 'w+', newline='',
+                  **urfiles.manifest.Sorter.ENCODING) as path_rows:
+            self.path_rows = csv.writer(path_rows)
+            self.path_count = 0
+            self._join(db, conn, source)
+            self.path_rows = path_rows
+            self._update_database(db, conn, source, tmpdir)
+        self.path_rows = None
+        self.known_paths = urfiles.compact.PathSet()
+
     def load(self):
         try:
             db = urfiles.db.DB(self.config.config)
@@ -159,17 +303,18 @@ class Load():
             FATAL('Cannot connect to database: %s', repr(e))
 
         INFO('Reading all md5s')
-        self.known_md5s = db.fetch_md5s()
+        self.known_md5s = urfiles.compact.DigestSet(db.iter_md5s(conn))
 
         for directory in self.directories:
-            self.path_data = []
-            self.meta_data = []
             INFO('Loading data from %s', directory)
-            try:
-                self._load_md5file(directory)
-            except UnicodeDecodeErro as e:
-                FATAL('Cannot parse from %s: %s', directory, repr(e))
-            self._load_statfile(directory, db, conn)
-            self._update_database(db, conn)
+            with tempfile.TemporaryDirectory(prefix='urfiles-load-') as tmpdir:
+                self._load_directory(db, conn, directory, tmpdir)
         INFO('Data loaded')
 
+        self.progress.finish()
+        self.progress.log(force=True)
+        if self.report:
+            self.progress.write_report(self.report,
+                                       directories=self.directories,
+                                       source=self.source,
+                                       replace=self.replace)
@@ -1,20 +1,377 @@
 #!/usr/bin/env python3
 # main.py -*-python-*-
 
+# Each command is run by a function that imports the modules it uses when it
+# is called, so that, e.g., --show-config or a search does not pay for
+# loading magic, pymediainfo or psycopg2. benchmarks/importtime.py checks the
+# cost of starting a search.
+
 import argparse
 import os
 import urfiles.config
-import urfiles.db
-import urfiles.format
-import urfiles.identify
-import urfiles.load
-import urfiles.scan
-import urfiles.search
-
-# pylint: disable=unused-import
+
+# pylint: disable=unused-import,import-outside-toplevel
 from urfiles.log import PDLOG_SET_LEVEL, DEBUG, INFO, ERROR, FATAL
 
 
+def _show_config(args, config):
+    print('config')
+    for section in config.config.sections():
+        print('  [{}]'.format(section))
+        for key, value in config.config[section].items():
+            print('    {} = {}'.format(key, value))
+    return 0
+
+
+def _identify(args, config):
+    import urfiles.format
+    import urfiles.identify
+    import urfiles.sandbox
+    section = config.config['identify']
+    timeout = float(section.get('timeout', 60)) or None
+    sandbox = None
+    if section.getboolean('sandbox', True):
+        sandbox = urfiles.sandbox.Sandbox(timeout=timeout)
+    for file in args.id:
+        fmt = urfiles.format.Format(debug=args.debug)
+        statinfo = os.stat(file)
+        identify = urfiles.identify.Identify(file, debug=args.debug,
+                                             sandbox=sandbox,
+                                             timeout=timeout)
+        md5, meta = identify.id(checksum=args.full)
+        for extractor, reason in identify.failures:
+            ERROR('%s: %s failed: %s', file, extractor, reason)
+        print(fmt.pretty_print([(file, '', statinfo.st_size,
+                                 statinfo.st_mtime_ns, md5)],
+                               {md5: meta},
+                               full=args.full),
+              end='')
+    if sandbox is not None:
+        sandbox.close()
+    return 0
+
+
+def _manifest(args, config):
+    import urfiles.manifest
+    manifest = urfiles.manifest.Manifest(args.manifest, config,
+                                         output=args.output,
+                                         max_workers=args.workers,
+                                         filename_last=args.filename_last,
+                                         debug=args.debug,
+                                         report=args.report)
+    manifest.manifest()
+    return 0
+
+
+def _scan(args, config):
+    import urfiles.scan
+    scan = urfiles.scan.Scan(args.scan, config, source=args.source,
+                             debug=args.debug,
+                             precount=not args.no_precount,
+                             report=args.report, spool=args.spool,
+                             known_md5s=args.known_md5s,
+                             journal=args.journal, resume=args.resume,
+                             max_workers=args.workers,
+                             schedule=args.schedule,
+                             retry=args.retry_quarantined)
+    scan.scan()
+    return 0
+
+
+def _drop(args, config):
+    import urfiles.db
+    db = urfiles.db.DB(config.config)
+    db.drop()
+    return 0
+
+
+def _drop_source(args, config):
+    import urfiles.db
+    db = urfiles.db.DB(config.config)
+    conn = db.connect()
+    if not conn:
+        FATAL('Cannot connect to database')
+    if db.drop_source(conn, args.drop_source):
+        INFO('Source %s dropped', args.drop_source)
+    conn.close()
+    return 0
+
+
+def _init(args, config):
+    import urfiles.db
+    db = urfiles.db.DB(config.config)
+    db.maybe_create()
+    if not db.connect():
+        FATAL('Cannot connect to database')
+    return 0
+
+
+def _info(args, config):
+    import urfiles.cache
+    import urfiles.db
+    db = urfiles.db.DB(config.config)
+    if args.exact:
+        # Counting every row is slow anyway: bring the stats up to date too.
+        conn = db.connect()
+        if not conn:
+            FATAL('Cannot connect to database')
+        db.update_stats(conn)
+        conn.close()
+    for line in db.info(exact=args.exact):
+        print(line)
+    cache = urfiles.cache.Cache.from_config(config)
+    if cache is not None:
+        for line in cache.info():
+            print(line)
+        cache.close()
+    return 0
+
+
+def _export_md5s(args, config):
+    import urfiles.db
+    import urfiles.spool
+    db = urfiles.db.DB(config.config)
+    urfiles.spool.Spool.write_md5s(args.export_md5s, db.fetch_md5s())
+    return 0
+
+
+def _export_snapshot(args, config):
+    import urfiles.db
+    import urfiles.snapshot
+    db = urfiles.db.DB(config.config)
+    conn = db.connect()
+    if not conn:
+        FATAL('Cannot connect to database')
+    rows, meta_rows = urfiles.snapshot.Snapshot.export(
+        db, conn, args.export_snapshot)
+    conn.close()
+    INFO('Wrote %d path rows and %d meta rows to %s', rows, meta_rows,
+         args.export_snapshot)
+    return 0
+
+
+def _backfill(args, config):
+    import urfiles.backfill
+    backfill = urfiles.backfill.Backfill(config,
+                                         max_workers=args.workers,
+                                         debug=args.debug,
+                                         stale=args.stale,
+                                         rate=args.rate,
+                                         budget=args.budget,
+                                         report=args.report)
+    backfill.backfill()
+    return 0
+
+
+def _verify(args, config):
+    import urfiles.hasher
+    import urfiles.verify
+    verify = urfiles.verify.Verify(
+        args.verify if args.verify != '' else None, config,
+        max_workers=args.workers, debug=args.debug,
+        bandwidth=urfiles.hasher.Hasher.parse_size(args.bandwidth)
+        if args.bandwidth else None,
+        budget=args.budget, min_age=args.min_age, report=args.report)
+    verify.verify()
+    return 0
+
+
+def _ingest(args, config):
+    import urfiles.ingest
+    ingest = urfiles.ingest.Ingest(args.ingest, config, debug=args.debug)
+    ingest.ingest()
+    return 0
+
+
+def _dump(args, config):
+    import sys
+    import urfiles.db
+    db = urfiles.db.DB(config.config)
+    conn = db.connect()
+    if not conn:
+        FATAL('Cannot connect to database')
+    if args.output is None:
+        sys.stdout.flush()
+        ok = db.dump(conn, args.dump[0], sys.stdout.buffer,
+                     fmt=args.format, source=args.source)
+        sys.stdout.buffer.flush()
+    else:
+        with open(args.output, 'wb') as fp:
+            ok = db.dump(conn, args.dump[0], fp, fmt=args.format,
+                         source=args.source)
+    if not ok:
+        FATAL('Cannot dump %s', args.dump[0])
+    return 0
+
+
+def _restore(args, config):
+    import sys
+    import urfiles.db
+    table, filename = args.restore
+    db = urfiles.db.DB(config.config)
+    conn = db.connect()
+    if not conn:
+        FATAL('Cannot connect to database')
+    if filename == '-':
+        ok = db.restore(conn, table, sys.stdin.buffer, fmt=args.format)
+    else:
+        with open(filename, 'rb') as fp:
+            ok = db.restore(conn, table, fp, fmt=args.format)
+    if not ok:
+        FATAL('Cannot restore %s from %s', table, filename)
+    if table == 'path':
+        db.update_stats(conn)
+    INFO('Restored %s from %s', table, filename)
+    return 0
+
+
+def _dups(args, config):
+    import urfiles.dups
+    import urfiles.format
+    import urfiles.hasher
+    dups = urfiles.dups.Dups(config,
+                             min_size=urfiles.hasher.Hasher.parse_size(
+                                 args.min_size) if args.min_size else 0,
+                             sources=args.dups, limit=args.limit,
+                             debug=args.debug)
+    fmt = urfiles.format.Format(debug=args.debug)
+    for group in dups.dups():
+        print(fmt.pretty_print_dups(*group), end='')
+    return 0
+
+
+def _missing(args, config):
+    import urfiles.format
+    import urfiles.missing
+    if args.source is None:
+        FATAL('--missing-from requires --source')
+    missing = urfiles.missing.Missing(args.source, args.missing_from,
+                                      config, reverse=args.reverse,
+                                      debug=args.debug)
+    fmt = urfiles.format.Format(debug=args.debug)
+    if args.summary:
+        print(fmt.pretty_print_missing_summary(missing.source,
+                                               missing.missing_from,
+                                               *missing.summary()),
+              end='')
+        return 0
+    for row in missing.missing():
+        print(fmt.pretty_print_missing(*row), end='')
+    return 0
+
+
+def _serve(args, config):
+    import urfiles.client
+    import urfiles.server
+    server = urfiles.server.Server(
+        config, urfiles.client.Client.default_socket(config),
+        pool_size=int(config.config['serve']['pool_size']),
+        index=args.index, max_workers=args.workers, debug=args.debug)
+    server.serve()
+    return 0
+
+
+def _serve_reload(args, config):
+    import urfiles.client
+    socket_path = urfiles.client.Client.default_socket(config)
+    try:
+        reloaded = urfiles.client.Client(socket_path).reload()
+    except OSError as exception:
+        FATAL('Cannot reach a server on %s: %s', socket_path, exception)
+    INFO('Index %s', 'rebuilt' if reloaded else 'not in use')
+    return 0
+
+
+def _search(args, config):
+    import urfiles.client
+    import urfiles.format
+    import urfiles.hasher
+    import urfiles.search
+    parse_size = urfiles.hasher.Hasher.parse_size
+    parse_time = urfiles.search.Search.parse_time
+    socket_path = urfiles.client.Client.default_socket(config)
+    snapshot = None
+    if args.snapshot:
+        import urfiles.snapshot
+        snapshot = urfiles.snapshot.Snapshot(args.snapshot,
+                                             max_workers=args.workers)
+    search = urfiles.search.Search(
+        args.re, config, debug=args.debug, source=args.source,
+        md5=args.md5,
+        min_size=parse_size(args.min_size) if args.min_size else None,
+        max_size=parse_size(args.max_size) if args.max_size else None,
+        newer=parse_time(args.newer) if args.newer else None,
+        older=parse_time(args.older) if args.older else None,
+        limit=args.limit, order_by=args.order_by or 'path',
+        after=args.after,
+        server=socket_path if os.path.exists(socket_path) and
+        not args.no_server and snapshot is None else None,
+        snapshot=snapshot)
+    result, meta = search.re()
+    fmt = urfiles.format.Format(debug=args.debug)
+    print(fmt.pretty_print(result, meta, full=args.full,
+                           ordered=args.order_by is not None),
+          end='')
+    if search.next_after is not None:
+        INFO("More results: --after '%s'", search.next_after)
+    return 0
+
+
+def _scan_archive(args, config):
+    import urfiles.archive
+    archive = urfiles.archive.Archive(args.scan_archive, config,
+                                      source=args.source,
+                                      debug=args.debug,
+                                      report=args.report)
+    archive.scan()
+    return 0
+
+
+def _scan_load(args, config):
+    # A large reload should use --replace: the rows are copied into a new
+    # partition that is only indexed (on md5 and the rest) when it is
+    # attached, rather than updating the indexes row by row.
+    if args.scan:
+        _scan(args, config)
+    if args.load:
+        import urfiles.load
+        load = urfiles.load.Load(args.load, config, source=args.source,
+                                 debug=args.debug, report=args.report,
+                                 replace=args.replace)
+        load.load()
+    return 0
+
+
+# The commands in order of precedence: the first whose test is true for the
+# arguments is run. The commands before --drop do not use the database.
+COMMANDS = [
+    (lambda args: args.show_config, _show_config),
+    (lambda args: args.id, _identify),
+    (lambda args: args.manifest, _manifest),
+    (lambda args: args.scan and args.spool, _scan),
+    (lambda args: args.drop, _drop),
+    (lambda args: args.drop_source is not None, _drop_source),
+    (lambda args: args.init, _init),
+    (lambda args: args.info, _info),
+    (lambda args: args.export_md5s, _export_md5s),
+    (lambda args: args.export_snapshot, _export_snapshot),
+    (lambda args: args.backfill, _backfill),
+    (lambda args: args.verify is not None, _verify),
+    (lambda args: args.ingest, _ingest),
+    (lambda args: args.dump, _dump),
+    (lambda args: args.restore, _restore),
+    (lambda args: args.dups is not None, _dups),
+    (lambda args: args.missing_from is not None, _missing),
+    (lambda args: args.serve_reload, _serve_reload),
+    (lambda args: args.serve, _serve),
+    (lambda args: (args.re or args.md5 or args.min_size or args.max_size or
+                   args.newer or args.older or args.order_by or args.limit or
+                   args.after), _search),
+    (lambda args: args.scan_archive, _scan_archive),
+    (lambda args: args.scan or args.load, _scan_load),
+]
+
+
 def main():
     parser = argparse.ArgumentParser(description='urfiles')
     # Configuration maintenance
@@ -28,18 +385,105 @@ def main():
                         help='Initialize database')
     parser.add_argument('--drop', action='store_true', default=False,
                         help='Drop database and exit')
+    parser.add_argument('--drop-source', default=None, metavar=('SOURCE'),
+                        help='Delete all the rows of SOURCE and exit')
     parser.add_argument('--info', action='store_true', default=False,
                         help='Get information about the database')
+    parser.add_argument('--exact', action='store_true', default=False,
+                        help='With --info, count rows exactly and recompute'
+                        ' the stats of every source (slow)')
     parser.add_argument('--dump', nargs=1, type=str, metavar=('TABLE'),
-                        help='Dump specified table')
+                        help='Dump specified table to standard output (or'
+                        ' --output), only the rows of --source if given')
+    parser.add_argument('--restore', nargs=2, default=None,
+                        metavar=('TABLE', 'FILE'),
+                        help='Add the rows of FILE (- for standard input),'
+                        ' written by --dump, to TABLE')
+    parser.add_argument('--format', default='csv', choices=['csv', 'binary'],
+                        help='For --dump and --restore: CSV with a header'
+                        ' line, or the PostgreSQL binary COPY format')
 
     # Scanning
     parser.add_argument('--scan', default=None, nargs='+', metavar=('DIR'),
                         help='Directory trees to scan')
+    parser.add_argument('--scan-archive', default=None, nargs='+',
+                        metavar=('FILE'),
+                        help='Record the members of tar and zip files as'
+                        ' FILE//MEMBER without extracting them')
+    parser.add_argument('--manifest', default=None, metavar=('DIR'),
+                        help='Write md5sum.txt and stat.txt for the tree DIR'
+                        ' (see --load)')
+    parser.add_argument('--output', default=None, metavar=('PATH'),
+                        help='With --manifest, write the files to the'
+                        ' directory PATH (default: the tree itself); with'
+                        ' --dump, write to the file PATH')
+    parser.add_argument('--filename-last', action='store_true',
+                        default=False,
+                        help='With --manifest, write stat.txt with the file'
+                        ' name at the end of each line')
     parser.add_argument('--load', default=None, nargs='+', metavar=('DIR'),
                         help='Load tape archive files (md5sum.txt, stat.txt)')
+    parser.add_argument('--replace', action='store_true', default=False,
+                        help='With --load, replace the rows of the source'
+                        ' instead of adding to them')
+    parser.add_argument('--workers', type=int, default=3, metavar=('N'),
+                        help='Number of --scan worker processes')
+    parser.add_argument('--schedule', default='fifo',
+                        choices=['fifo', 'device'],
+                        help='--scan scheduling: fifo, or per device with'
+                        ' limited readers per disk')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='Resume an interrupted --scan from its journal')
+    parser.add_argument('--retry-quarantined', action='store_true',
+                        default=False,
+                        help='With --scan, try quarantined files again')
+    parser.add_argument('--journal', default=None, metavar=('FILE'),
+                        help='Checkpoint journal for --scan (default: in'
+                        ' ~/.cache/urfiles)')
+    parser.add_argument('--spool', default=None, metavar=('DIR'),
+                        help='With --scan, write rows to spool files in DIR'
+                        ' instead of the database')
+    parser.add_argument('--known-md5s', default=None, metavar=('FILE'),
+                        help='With --spool, skip metadata for md5s in FILE'
+                        ' (see --export-md5s)')
+    parser.add_argument('--backfill', action='store_true', default=False,
+                        help='Extract metadata for content loaded from tape'
+                        ' that now has a readable copy on disk')
+    parser.add_argument('--stale', action='store_true', default=False,
+                        help='With --backfill, also refresh metadata from'
+                        ' older extractor versions')
+    parser.add_argument('--rate', type=float, default=None, metavar=('N'),
+                        help='With --backfill, identify at most N files per'
+                        ' second')
+    parser.add_argument('--budget', type=float, default=None,
+                        metavar=('SECONDS'),
+                        help='With --backfill or --verify, stop starting new'
+                        ' work after SECONDS')
+    parser.add_argument('--verify', default=None, nargs='?', const='',
+                        metavar=('SOURCE|DIR'),
+                        help='Re-hash files and compare them with their'
+                        ' stored md5, least recently verified first')
+    parser.add_argument('--bandwidth', default=None, metavar=('BYTES'),
+                        help='With --verify, read at most BYTES per second'
+                        ' (e.g., 100M)')
+    parser.add_argument('--min-age', type=float, default=None,
+                        metavar=('DAYS'),
+                        help='With --verify, skip files verified in the last'
+                        ' DAYS days')
+    parser.add_argument('--ingest', default=None, nargs='+', metavar=('DIR'),
+                        help='Bulk load spool files written by --spool')
+    parser.add_argument('--export-md5s', default=None, metavar=('FILE'),
+                        help='Write all known md5s to FILE and exit')
+    parser.add_argument('--export-snapshot', default=None, metavar=('FILE'),
+                        help='Write the path and meta tables to FILE, which'
+                        ' --snapshot can search without a database')
     parser.add_argument('--source', default=None,
-                        help='SOURCE tag for path entry')
+                        help='SOURCE tag for path entry; when searching, only'
+                        ' list paths from SOURCE')
+    parser.add_argument('--report', default=None, metavar=('FILE'),
+                        help='Write a JSON run report for --scan or --load')
+    parser.add_argument('--no-precount', action='store_true', default=False,
+                        help='Do not pre-count files for the --scan ETA')
     parser.add_argument('--debug', action='store_true', default=False,
                         help='Output verbose debugging messages')
     parser.add_argument('--id', default=None, nargs='+', metavar=('FILE'),
@@ -51,79 +495,72 @@ def main():
     # Searching
     parser.add_argument('--re', default=None, metavar=('RE'),
                         help='Search paths using regular expression')
+    parser.add_argument('--serve', action='store_true', default=False,
+                        help='Answer searches from a daemon on a Unix'
+                        ' socket; later searches use it when it is running')
+    parser.add_argument('--index', action='store_true', default=False,
+                        help='With --serve, keep an in-memory index of paths'
+                        ' for --re searches with --workers processes')
+    parser.add_argument('--serve-reload', action='store_true',
+                        default=False,
+                        help='Ask a running --serve daemon to rebuild its'
+                        ' --index now')
+    parser.add_argument('--no-server', action='store_true', default=False,
+                        help='Search the database even if a --serve daemon'
+                        ' is running')
+    parser.add_argument('--snapshot', default=None, metavar=('FILE'),
+                        help='Search FILE, written by --export-snapshot,'
+                        ' instead of the database')
+    parser.add_argument('--dups', default=None, nargs='*',
+                        metavar=('SOURCE'),
+                        help='List duplicate content, most reclaimable bytes'
+                        ' first, optionally only within SOURCEs')
+    parser.add_argument('--missing-from', default=None, metavar=('SOURCE'),
+                        help='List content in --source that has no copy in'
+                        ' SOURCE')
+    parser.add_argument('--reverse', action='store_true', default=False,
+                        help='With --missing-from, list content in SOURCE'
+                        ' that has no copy in --source')
+    parser.add_argument('--summary', action='store_true', default=False,
+                        help='With --missing-from, print only counts and'
+                        ' bytes')
+    parser.add_argument('--min-size', default=None, metavar=('BYTES'),
+                        help='Only list files of at least BYTES (e.g., 1M)')
+    parser.add_argument('--max-size', default=None, metavar=('BYTES'),
+                        help='Only list files of at most BYTES')
+    parser.add_argument('--newer', default=None, metavar=('TIME'),
+                        help='Only list files modified at or after TIME'
+                        ' (YYYY-MM-DD[ HH:MM], or Nd for N days ago)')
+    parser.add_argument('--older', default=None, metavar=('TIME'),
+                        help='Only list files modified before TIME')
+    parser.add_argument('--md5', default=None,
+                        help='Only list files with content MD5')
+    parser.add_argument('--order-by', default=None,
+                        choices=['size', 'mtime', 'path'],
+                        help='Sort search results: largest, newest, or by'
+                        ' path (the default)')
+    parser.add_argument('--limit', type=int, default=None, metavar=('N'),
+                        help='List at most N search results or --dups'
+                        ' groups')
+    parser.add_argument('--after', default=None, metavar=('KEY'),
+                        help='Continue a --limit search after KEY, as'
+                        ' printed by the previous search')
     args = parser.parse_args()
 
     if args.debug:
         PDLOG_SET_LEVEL('DEBUG')
 
+    check = not (args.show_config or args.id or args.manifest or
+                 (args.scan and args.spool) or args.snapshot or
+                 args.serve_reload)
     if args.config:
-        config = urfiles.config.Config([args.config])
+        config = urfiles.config.Config([args.config], check=check)
     else:
-        config = urfiles.config.Config()
-
-    if args.show_config:
-        print('config')
-        for section in config.config.sections():
-            print('  [{}]'.format(section))
-            for key, value in config.config[section].items():
-                print('    {} = {}'.format(key, value))
-        return 0
-
-    if args.id:
-        for file in args.id:
-            fmt = urfiles.format.Format(debug=args.debug)
-            statinfo = os.stat(file)
-            identify = urfiles.identify.Identify(file, debug=args.debug)
-            md5, meta = identify.id(checksum=args.full)
-            print(fmt.pretty_print({file: [(-1, md5, statinfo.st_size,
-                                            statinfo.st_mtime_ns)]},
-                                   {md5: meta},
-                                   full=args.full),
-                  end='')
-        return 0
-
-    db = urfiles.db.DB(config.config)
-
-    if args.drop:
-        db.drop()
-        return 0
-
-    if args.init:
-        db.maybe_create()
-        if not db.connect():
-            FATAL('Cannot connect to database')
-        return 0
-
-    if args.info:
-        for line in db.info():
-            print(line)
-        return 0
-
-    if args.dump:
-        rows = db.fetch_rows(args.dump[0])
-        for row in rows:
-            print(row)
-        return 0
+        config = urfiles.config.Config(check=check)
 
-    if args.re:
-        search = urfiles.search.Search(args.re, config, debug=args.debug)
-        result, meta = search.re()
-        fmt = urfiles.format.Format(debug=args.debug)
-        print(fmt.pretty_print(result, meta, full=args.full), end='')
-        return 0
-
-    if args.scan or args.load:
-        # FIXME If we add an index for md5, then we may want to drop it before
-        # updating the database, and then recreate it afterward. (Or similar.)
-        if args.scan:
-            scan = urfiles.scan.Scan(args.scan, config, source=args.source,
-                                     debug=args.debug)
-            scan.scan()
-        if args.load:
-            load = urfiles.load.Load(args.load, config, source=args.source,
-                                     debug=args.debug)
-            load.load()
-        return 0
+    for test, command in COMMANDS:
+        if test(args):
+            return command(args, config)
 
     parser.print_help()
     return -1
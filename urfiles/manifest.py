@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# manifest.py -*-python-*-
+
+import concurrent.futures
+import heapq
+import os
+import stat
+import tempfile
+import time
+import urfiles.hasher
+import urfiles.progress
+
+# pylint: disable=unused-import
+from urfiles.log import DEBUG, INFO, ERROR, FATAL
+
+
+class Sorter():
+    # An external merge sort of text lines, in byte order (as with
+    # LC_ALL=C sort). Lines are sorted in memory in runs of up to max_lines,
+    # each run is written to a temporary file, and the runs are merged when
+    # the output is written, so memory use does not depend on the number of
+    # lines.
+    ENCODING = {'encoding': 'utf-8', 'errors': 'surrogateescape'}
+
+    def __init__(self, directory, max_lines=10**6):
+        self.directory = directory
+        self.max_lines = max_lines
+        self.lines = []
+        self.runs = []
+
+    @staticmethod
+    def _key(line):
+        return line.encode(**Sorter.ENCODING)
+
+    def _spill(self):
+        self.lines.sort(key=self._key)
+        fp = tempfile.TemporaryFile('w+', dir=self.directory, newline='\n',
+                                    **self.ENCODING)
+        fp.writelines(self.lines)
+        fp.seek(0)
+        self.runs.append(fp)
+        self.lines = []
+
+    def add(self, line):
+        self.lines.append(line)
+        if len(self.lines) >= self.max_lines:
+            self._spill()
+
+    def merged(self):
+        # Returns an iterator over all the lines, in order.
+        if self.lines or not self.runs:
+            self._spill()
+        return heapq.merge(*self.runs, key=self._key)
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+
+    def write(self, filename, header=None):
+        tmpname = filename + '.tmp'
+        with open(tmpname, 'w', newline='\n', **self.ENCODING) as fp:
+            if header is not None:
+                fp.write(header)
+            fp.writelines(self.merged())
+        os.replace(tmpname, filename)
+        self.close()
+
+
+class Manifest():
+    # Manifest writes the md5sum.txt and stat.txt files that --load reads
+    # for a tape archive, in one walk of the tree, hashing files in
+    # --workers processes. md5sum.txt uses the GNU md5sum format, including
+    # its escaping of backslashes and newlines. stat.txt uses the format of
+    # stat --format='%n %1.1F %a %s %u %g %Y %y' or, with filename_last, the
+    # same fields with the (escaped) name moved to the end, after a header
+    # line, which --load can parse without ambiguity.
+    STAT_HEADER = '# urfiles stat.txt: %1.1F %a %s %u %g %Y %y %n\n'
+    BATCH_SIZE = 64
+
+    # Set in each worker process by _init_worker.
+    hasher = None
+
+    def __init__(self, directory, config, output=None, max_workers=3,
+                 filename_last=False, max_lines=10**6, debug=False,
+                 report=None):
+        self.directory = directory
+        self.config = config
+        self.output = output if output is not None else directory
+        self.max_workers = max_workers
+        self.filename_last = filename_last
+        self.max_lines = max_lines
+        self.debug = debug
+        self.report = report
+        self.progress = urfiles.progress.Progress('manifest', max_workers)
+        self.pending = set()
+        self.md5s = None
+        self.stats = None
+
+    @staticmethod
+    def escape(path):
+        # As GNU md5sum: returns the escaped path, and whether it needed
+        # escaping (in which case the line starts with a backslash).
+        escaped = path.replace('\\', '\\\\').replace('\n', '\\n')
+        return escaped, escaped != path
+
+    @staticmethod
+    def _init_worker(config):
+        Manifest.hasher = urfiles.hasher.Hasher.from_config(config.config)
+
+    @staticmethod
+    def _hash_batch(batch):
+        results = []
+        for path, size, dev in batch:
+            start_time = time.time()
+            try:
+                md5 = Manifest.hasher.md5(path, dev=dev)
+            except OSError as e:
+                results.append((path, size, None, repr(e), 0.0))
+                continue
+            results.append((path, size, md5, None, time.time() - start_time))
+        return results
+
+    def _md5_line(self, path, md5):
+        escaped, flag = self.escape(path)
+        return '{}{}  {}\n'.format('\\' if flag else '', md5, escaped)
+
+    def _stat_line(self, path, statinfo):
+        mtime = statinfo.st_mtime_ns // 10**9
+        local = time.localtime(mtime)
+        fields = '{} {:o} {} {} {} {} {}.{:09d} {}'.format(
+            'r', stat.S_IMODE(statinfo.st_mode), statinfo.st_size,
+            statinfo.st_uid, statinfo.st_gid, mtime,
+            time.strftime('%Y-%m-%d %H:%M:%S', local),
+            statinfo.st_mtime_ns % 10**9, time.strftime('%z', local))
+        if self.filename_last:
+            return '{} {}\n'.format(fields, self.escape(path)[0])
+        return '{} {}\n'.format(path, fields)
+
+    def _results(self, futures):
+        for future in futures:
+            counts = urfiles.progress.Progress.new_counts()
+            for path, size, md5, error, seconds in future.result():
+                counts['files'] += 1
+                counts['bytes'] += size
+                if md5 is None:
+                    ERROR('%s: %s', path, error)
+                    counts['errors'] += 1
+                    continue
+                counts['new'] += 1
+                counts['hashed_bytes'] += size
+                counts['hash_seconds'] += seconds
+                self.md5s.add(self._md5_line(path, md5))
+            self.progress.update(-1, counts)
+
+    def _submit(self, executor, batch):
+        # At most two batches per worker are in flight, so the walk does not
+        # run far ahead of the hashing.
+        while len(self.pending) >= 2 * self.max_workers:
+            done, self.pending = concurrent.futures.wait(
+                self.pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            self._results(done)
+            self.progress.log()
+        self.pending.add(executor.submit(self._hash_batch, batch))
+
+    def _walk(self, executor, tmpdir):
+        # The output files and the sort runs may be inside the tree.
+        names = set(['md5sum.txt', 'stat.txt', 'md5sum.txt.tmp',
+                     'stat.txt.tmp', os.path.basename(tmpdir)])
+        skip = set(os.path.realpath(os.path.join(self.output, name))
+                   for name in names)
+        batch = []
+        stack = [self.directory]
+        while stack:
+            dirname = stack.pop()
+            try:
+                with os.scandir(dirname) as entries:
+                    entries = list(entries)
+            except OSError as e:
+                ERROR('%s: %s', dirname, repr(e))
+                self.progress.update(-1, {'errors': 1})
+                continue
+            for entry in entries:
+                try:
+                    if entry.name in names and \
+                       os.path.realpath(entry.path) in skip:
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                        continue
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    statinfo = entry.stat(follow_symlinks=False)
+                except OSError as e:
+                    ERROR('%s: %s', entry.path, repr(e))
+                    self.progress.update(-1, {'errors': 1})
+                    continue
+                self.stats.add(self._stat_line(entry.path, statinfo))
+                batch.append((entry.path, statinfo.st_size,
+                              statinfo.st_dev))
+                if len(batch) >= self.BATCH_SIZE:
+                    self._submit(executor, batch)
+                    batch = []
+        if batch:
+            self._submit(executor, batch)
+
+    def manifest(self):
+        os.makedirs(self.output, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=self.output) as tmpdir:
+            self.md5s = Sorter(tmpdir, max_lines=self.max_lines)
+            self.stats = Sorter(tmpdir, max_lines=self.max_lines)
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    initializer=self._init_worker,
+                    initargs=(self.config,)) as executor:
+                self._walk(executor, tmpdir)
+                self._results(concurrent.futures.as_completed(self.pending))
+                self.pending = set()
+
+            INFO('Sorting')
+            self.md5s.write(os.path.join(self.output, 'md5sum.txt'))
+            self.stats.write(os.path.join(self.output, 'stat.txt'),
+                             header=self.STAT_HEADER if self.filename_last
+                             else None)
+
+        self.progress.finish()
+        self.progress.log(force=True)
+        if self.report:
+            self.progress.write_report(self.report, directory=self.directory,
+                                       output=self.output,
+                                       workers=self.max_workers,
+                                       filename_last=self.filename_last)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# missing.py -*-python-*-
+
+import traceback
+import urfiles.db
+
+# pylint: disable=unused-import
+from urfiles.log import DEBUG, INFO, ERROR, FATAL
+
+
+class Missing():
+    # Content in source that has no copy in missing_from, e.g. what on a
+    # disk has not yet been archived to tape. The set difference is computed
+    # by the database as an anti-join.
+    def __init__(self, source, missing_from, config, reverse=False,
+                 debug=False):
+        if reverse:
+            source, missing_from = missing_from, source
+        self.source = source
+        self.missing_from = missing_from
+        self.config = config
+        self.debug = debug
+
+    def _connect(self):
+        try:
+            db = urfiles.db.DB(self.config.config)
+            conn = db.connect()
+        except Exception as exception:
+            FATAL(traceback.format_exc())
+        return db, conn
+
+    def missing(self):
+        db, conn = self._connect()
+        yield from db.fetch_missing(conn, self.source, self.missing_from)
+        conn.close()
+
+    def summary(self):
+        db, conn = self._connect()
+        contents, size = db.count_missing(conn, self.source,
+                                          self.missing_from)
+        conn.close()
+        return contents, size
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# progress.py -*-python-*-
+
+import json
+import os
+import socket
+import time
+
+# pylint: disable=unused-import
+from urfiles.log import DEBUG, INFO, ERROR, FATAL
+
+
+class Progress():
+    COUNTERS = ['files', 'new', 'unchanged', 'skipped', 'errors',
+                'directories', 'bytes', 'hashed_bytes', 'hash_seconds',
+                'syscalls', 'quarantined', 'mismatched', 'missing']
+
+    def __init__(self, command, workers=0, interval=1.5):
+        self.command = command
+        self.workers = workers
+        self.interval = interval
+        self.start_time = time.time()
+        self.end_time = None
+        self.message_time = 0
+        self.counts = self.new_counts()
+        self.busy = [0.0] * workers
+        self.expected_files = None
+
+    @staticmethod
+    def new_counts():
+        return dict.fromkeys(Progress.COUNTERS, 0)
+
+    @staticmethod
+    def precount(directories):
+        # Count regular files using only the d_type information returned by
+        # scandir, so this does not stat every file. The result is used for
+        # the ETA, so it does not need to be exact.
+        files = 0
+        stack = list(directories)
+        while stack:
+            dirname = stack.pop()
+            try:
+                with os.scandir(dirname) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                stack.append(entry.path)
+                            else:
+                                files += 1
+                        except OSError:
+                            continue
+            except OSError:
+                continue
+        return files
+
+    def expect(self, files):
+        self.expected_files = files
+        INFO('Pre-count: %d files', files)
+
+    def update(self, idx, counts, busy=0.0):
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+        if 0 <= idx < len(self.busy):
+            self.busy[idx] += busy
+
+    def finish(self):
+        self.end_time = time.time()
+
+    def elapsed(self):
+        end_time = self.end_time if self.end_time else time.time()
+        return max(end_time - self.start_time, 1e-6)
+
+    def rate(self, key):
+        return self.counts.get(key, 0) / self.elapsed()
+
+    def read_throughput(self):
+        # Bytes per second achieved by one worker while it is reading. Unlike
+        # rate('hashed_bytes'), this does not include time spent on
+        # metadata, the database, or waiting for work.
+        if self.counts['hash_seconds'] == 0:
+            return 0.0
+        return self.counts['hashed_bytes'] / self.counts['hash_seconds']
+
+    def utilization(self):
+        return [busy / self.elapsed() for busy in self.busy]
+
+    def eta(self):
+        if self.expected_files is None or self.counts['files'] == 0:
+            return None
+        remaining = max(self.expected_files - self.counts['files'], 0)
+        return remaining / self.rate('files')
+
+    @staticmethod
+    def _format_seconds(seconds):
+        if seconds is None:
+            return '?'
+        seconds = int(seconds)
+        return '{}:{:02d}:{:02d}'.format(seconds // 3600,
+                                         (seconds // 60) % 60,
+                                         seconds % 60)
+
+    def log(self, force=False):
+        if not force and time.time() - self.message_time < self.interval:
+            return
+        self.message_time = time.time()
+        utilization = ' '.join(['{:.0f}%'.format(100 * value)
+                                for value in self.utilization()])
+        INFO('files=%d/%s (%.1f/s) hashed=%.1fMiB (%.1f MiB/s, read %.1f'
+             ' MiB/s) new=%d unchanged=%d skipped=%d errors=%d'
+             ' quarantined=%d util=[%s] eta=%s',
+             self.counts['files'],
+             self.expected_files if self.expected_files is not None
+             else '?',
+             self.rate('files'),
+             self.counts['hashed_bytes'] / 2**20,
+             self.rate('hashed_bytes') / 2**20,
+             self.read_throughput() / 2**20,
+             self.counts['new'], self.counts['unchanged'],
+             self.counts['skipped'], self.counts['errors'],
+             self.counts['quarantined'], utilization,
+             self._format_seconds(self.eta()))
+
+    def report(self, **extra):
+        report = {
+            'command': self.command,
+            'host': socket.gethostname(),
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+            'elapsed': self.elapsed(),
+            'expected_files': self.expected_files,
+            'counts': self.counts,
+            'rates': {key: self.rate(key) for key in self.counts},
+            'read_throughput': self.read_throughput(),
+            'syscalls_per_file': self.counts['syscalls'] /
+            max(self.counts['files'], 1),
+            'utilization': self.utilization(),
+        }
+        report.update(extra)
+        return report
+
+    def write_report(self, filename, **extra):
+        try:
+            with open(filename, 'w') as fp:
+                json.dump(self.report(**extra), fp, indent=4, sort_keys=True)
+                fp.write('\n')
+        except OSError as e:
+            ERROR('Cannot write report to %s: %s', filename, repr(e))
+            return
+        INFO('Report written to %s', filename)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# sandbox.py -*-python-*-
+
+import base64
+import json
+import os
+import selectors
+import subprocess
+import sys
+import time
+
+# pylint: disable=unused-import
+from urfiles.log import DEBUG, INFO, ERROR, FATAL
+
+
+class ExtractorError(Exception):
+    pass
+
+
+class ExtractorUnavailable(ExtractorError):
+    # The extractor cannot be run at all (e.g., exiftool is not installed),
+    # which says nothing about the file.
+    pass
+
+
+class Sandbox():
+    # Native extractors (libmediainfo, libmagic) run in a helper process, so
+    # that a file that hangs or crashes them costs one helper process rather
+    # than a scan worker. The helper reads one JSON request per line on
+    # stdin and writes one JSON response per line on its protocol pipe. It
+    # is killed when a request takes longer than the timeout, and restarted
+    # for the next request.
+    EXTRACTORS = ['mediainfo', 'magic']
+
+    def __init__(self, timeout=60.0):
+        self.timeout = timeout
+        self.proc = None
+        self.selector = None
+
+    def _start(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = os.environ.copy()
+        env['PYTHONPATH'] = root + os.pathsep + env.get('PYTHONPATH', '')
+        self.proc = subprocess.Popen([sys.executable, '-m', 'urfiles.sandbox'],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     env=env, text=True, bufsize=1)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.proc.stdout, selectors.EVENT_READ)
+
+    def close(self):
+        if self.proc is None:
+            return
+        self.selector.close()
+        self.proc.kill()
+        self.proc.wait()
+        self.proc = None
+
+    def run(self, extractor, file, buffer=None):
+        if self.proc is None or self.proc.poll() is not None:
+            self._start()
+        request = {'extractor': extractor, 'file': file}
+        if buffer is not None:
+            request['buffer'] = base64.b64encode(buffer).decode('ascii')
+        try:
+            self.proc.stdin.write(json.dumps(request) + '\n')
+            self.proc.stdin.flush()
+        except OSError as e:
+            self.close()
+            raise ExtractorError('helper failed: {}'.format(repr(e))) from e
+
+        # Without a timeout, the helper is waited for indefinitely.
+        deadline = time.time() + self.timeout if self.timeout else None
+        while True:
+            remaining = deadline - time.time() if deadline else None
+            if (remaining is not None and remaining <= 0) or \
+               not self.selector.select(remaining):
+                self.close()
+                raise ExtractorError('timeout after {:.0f}s'.format(
+                    self.timeout))
+            line = self.proc.stdout.readline()
+            if line == '':
+                returncode = self.proc.wait()
+                self.close()
+                raise ExtractorError('helper exited with {}'.format(
+                    returncode))
+            response = json.loads(line)
+            if 'error' in response:
+                raise ExtractorError(response['error'])
+            return response['result']
+
+    @staticmethod
+    def serve():
+        # Libraries may print to stdout, so the protocol uses a copy of the
+        # original stdout, and stdout itself goes to stderr.
+        protocol = os.fdopen(os.dup(1), 'w')
+        os.dup2(2, 1)
+
+        # pylint: disable=import-outside-toplevel
+        import urfiles.identify
+        for line in sys.stdin:
+            request = json.loads(line)
+            buffer = None
+            if 'buffer' in request:
+                buffer = base64.b64decode(request['buffer'])
+            identify = urfiles.identify.Identify(request['file'],
+                                                 buffer=buffer)
+            try:
+                if request['extractor'] == 'mediainfo':
+                    response = {'result': identify.mediainfo()}
+                elif request['extractor'] == 'magic':
+                    response = {'result': identify.magic()}
+                else:
+                    response = {'error': 'unknown extractor {}'.format(
+                        request['extractor'])}
+            except Exception as e:
+                response = {'error': repr(e)}
+            try:
+                text = json.dumps(response)
+            except (TypeError, ValueError) as e:
+                text = json.dumps({'error': repr(e)})
+            protocol.write(text + '\n')
+            protocol.flush()
+
+
+if __name__ == '__main__':
+    Sandbox.serve()
@@ -2,16 +2,25 @@
 # scan.py -*-python-*-
 
 # We use multiprocessing.Queue, so importing queue only for queue.Empty
+import collections
 import concurrent.futures
 import multiprocessing
 import os
 import queue
 import stat
+import threading
 import time
 import traceback
 import urfiles.config
 import urfiles.db
+import urfiles.device
+import urfiles.hasher
 import urfiles.identify
+import urfiles.journal
+import urfiles.progress
+import urfiles.sandbox
+import urfiles.spool
+import urfiles.writer
 
 # pylint: disable=unused-import
 from urfiles.log import DEBUG, INFO, ERROR, FATAL
@@ -19,10 +28,14 @@ from urfiles.log import DEBUG, INFO, ERROR, FATAL
 
 class Scan():
     MAX_MESSAGE_TYPE = 9
+    BATCH_SIZE = 256
 
     def __init__(self, directories, config, source=None, max_workers=3,
-                 debug=False):
-        self.directories = directories
+                 debug=False, precount=True, report=None, spool=None,
+                 known_md5s=None, journal=None, resume=False,
+                 checkpoint=10.0, schedule='fifo', retry=False):
+        self.directories = [os.path.abspath(directory)
+                            for directory in directories]
         self.config = config
         if source is not None:
             self.source = source
@@ -30,6 +43,41 @@ class Scan():
             self.source = ''
         self.max_workers = max_workers
         self.debug = debug
+        self.precount = precount
+        self.report = report
+        self.spool = spool
+        self.known_md5s = known_md5s
+        if journal is not None:
+            self.journal_file = journal
+        else:
+            self.journal_file = urfiles.journal.Journal.default_filename(
+                self.directories, self.source)
+        self.resume = resume
+        self.retry = retry
+        self.checkpoint = checkpoint
+        self.journal = None
+        self.inflight = 0
+        self.unwritten = 0
+        self.outstanding = dict()
+        self.failed = set()
+        # Directories queued by this run
+        self.queued = set()
+
+        # With schedule='device', work is queued per device (st_dev), and
+        # the number of workers reading from one device at a time is
+        # limited, so that spinning disks are not thrashed.
+        self.schedule = schedule
+        self.hdd_readers = 1
+        self.ssd_readers = max_workers
+        if 'scan' in self.config.config:
+            section = self.config.config['scan']
+            self.hdd_readers = int(section.get('hdd_readers',
+                                               self.hdd_readers))
+            self.ssd_readers = int(section.get('ssd_readers', 0)) or \
+                max_workers
+        self.waiting = collections.OrderedDict()
+        self.active = collections.Counter()
+        self.progress = urfiles.progress.Progress('scan', max_workers)
 
     @staticmethod
     def _log_callback(target, msg_type, debug_info, msg):
@@ -41,98 +89,258 @@ class Scan():
             INFO(":%c:%s: %s", code, target, msg)
 
     @staticmethod
-    def _directory(idx, dirname, workq, resultq):
-        if not os.access(dirname, os.X_OK | os.R_OK):
+    def _directory(idx, dirname, resultq, counts, schedule='fifo'):
+        # Subdirectories are returned to the coordinator, which queues them,
+        # and files are returned in batches. A directory is complete when
+        # all of its batches have been processed.
+        counts['directories'] += 1
+        subdirs = []
+        batches = []
+        names = []
+        files = []
+        counts['syscalls'] += 1
+        try:
+            entries = os.scandir(dirname)
+        except PermissionError:
+            counts['errors'] += 1
             resultq.put((idx, 'noaccess', dirname))
-            return
-        with os.scandir(dirname) as entries:
+            return subdirs, batches
+        # The file type comes from d_type in getdents, so only symbolic
+        # links (and file systems that return DT_UNKNOWN) need a stat here.
+        # Sockets, fifos and devices are skipped without one.
+        with entries:
             for entry in entries:
                 if entry.name in ['.', '..']:
                     continue
-                workq.put(('entry', dirname, entry.name))
+                try:
+                    if entry.is_dir():
+                        subdirs.append(entry.path)
+                    elif entry.is_file():
+                        files.append((entry.inode(), entry.name))
+                    else:
+                        counts['skipped'] += 1
+                except OSError:
+                    counts['errors'] += 1
+        # Reading files in inode order keeps the disk heads moving in one
+        # direction on most file systems. The inode comes from getdents, so
+        # this costs no extra system calls.
+        if schedule == 'device':
+            files.sort()
+        for _, name in files:
+            names.append(name)
+            if len(names) >= Scan.BATCH_SIZE:
+                batches.append(names)
+                names = []
+        if names:
+            batches.append(names)
+        return subdirs, batches
 
     @staticmethod
-    def _file(db, conn, statinfo, idx, path, source, workq, resultq):
+    def _entry(db, conn, writer, hasher, idx, path, source, resultq,
+               counts, sandbox=None, timeout=None, retry=False):
+        # This is the only stat for a file: the result is used for the path
+        # lookup, the hasher, and Identify.
+        counts['syscalls'] += 1
+        try:
+            statinfo = os.stat(path)
+        except FileNotFoundError as exception:
+            counts['errors'] += 1
+            resultq.put((idx, 'notfound', path + ': ' + repr(exception)))
+            return
+        except OSError as exception:
+            counts['errors'] += 1
+            resultq.put((idx, 'oserror', path + ': ' + repr(exception)))
+            return
+        Scan._file(db, conn, writer, hasher, statinfo, idx, path, source,
+                   resultq, counts, sandbox=sandbox, timeout=timeout,
+                   retry=retry)
+
+    @staticmethod
+    def _file(db, conn, writer, hasher, statinfo, idx, path, source,
+              resultq, counts, sandbox=None, timeout=None, retry=False):
+        # Lookups use conn, and rows are handed to writer, which writes them
+        # while the next files are hashed.
+        # If this is not a regular file (e.g., a socket), skip it.
+        if not stat.S_ISREG(statinfo.st_mode):
+            counts['skipped'] += 1
+            return
+
+        counts['files'] += 1
+        counts['bytes'] += statinfo.st_size
         md5 = db.lookup_path(conn, path, statinfo.st_size,
                              statinfo.st_mtime_ns)
-        if md5 is not None:
-            return
 
-        # This file has a new size or timestamp. Get new metadata.
-        identify = urfiles.identify.Identify(path)
-        md5, metadata = identify.id()
+        # Extractors are not run again on a file that made one fail or hang
+        # until it changes, or until --retry-quarantined is used. It is
+        # still hashed and recorded, so with --retry-quarantined, a file
+        # that has not changed is looked up in the quarantine table too.
+        quarantined = None
+        if md5 is None or retry:
+            quarantined = db.lookup_quarantine(conn, path, statinfo.st_size,
+                                               statinfo.st_mtime_ns)
+        if md5 is not None and quarantined is None:
+            counts['unchanged'] += 1
+            return
+        extract = quarantined is None or retry
+        # The metadata of a retried file replaces what was stored for it.
+        retrying = quarantined is not None and retry
 
-        # If this is not a file or directory (e.g., a socket), skip it.
-        if metadata['type'] == 'unknown':
+        # This file has a new size or timestamp. The md5 is computed first,
+        # so that metadata is only extracted for content we have not seen.
+        identify = urfiles.identify.Identify(path, hasher=hasher,
+                                             sandbox=sandbox, timeout=timeout)
+        start_time = time.time()
+        counts['syscalls'] += 1
+        try:
+            md5 = identify.md5(dev=statinfo.st_dev)
+        except OSError as exception:
+            counts['errors'] += 1
+            resultq.put((idx, 'oserror', path + ': ' + repr(exception)))
             return
-        if md5 == 0:
-            ERROR('path=%s metadata=%s', path, metadata)
+        counts['hash_seconds'] += time.time() - start_time
+        counts['new'] += 1
+        counts['hashed_bytes'] += statinfo.st_size
 
-        db.insert_path(conn, path, source, statinfo.st_size,
-                       statinfo.st_mtime_ns, md5)
+        # Do we already have metadata for this md5? If an extractor fails,
+        # the metadata of the others is kept (see Identify._extract_all),
+        # and if extraction is not tried, it is left empty, as --load does.
+        # Either way --backfill can complete it later, and the path is still
+        # recorded.
+        failed = not extract
+        if retrying or \
+           (not writer.has_meta(md5) and db.lookup_meta(conn, md5) is None):
+            metadata = dict()
+            if extract:
+                _, metadata = identify.id(checksum=False, statinfo=statinfo)
+                counts['syscalls'] += identify.syscalls
+            if identify.failures:
+                reason = '; '.join(['{}: {}'.format(extractor, failure)
+                                    for extractor, failure
+                                    in identify.failures])
+                writer.insert_quarantine(path, source, statinfo.st_size,
+                                         statinfo.st_mtime_ns, reason)
+                resultq.put((idx, 'quarantine', path + ': ' + reason))
+                failed = True
+            if retrying:
+                writer.update_meta(md5, metadata)
+            else:
+                writer.insert_meta(md5, metadata)
+        if failed:
+            counts['quarantined'] += 1
+        elif quarantined is not None:
+            writer.delete_quarantine(path, source)
 
-        # Do we already have metadata for this md5?
-        existing_metadata = db.lookup_meta(conn, md5)
-        if not existing_metadata:
-            db.insert_meta(conn, md5, metadata)
-        elif metadata != existing_metadata:
-            INFO(repr(metadata))
-            ERROR(repr(existing_metadata))
+        writer.insert_path(path, source, statinfo.st_size,
+                           statinfo.st_mtime_ns, md5)
 
     @staticmethod
-    def _worker(config, idx, workq, resultq, source):
-        def internal_worker(db, conn, idx, workq, resultq, source):
-            working = True
+    def _worker(config, idx, workq, resultq, source, spool=None,
+                known_md5s=None, schedule='fifo', retry=False):
+        def internal_worker(db, conn, writer, hasher, sandbox, timeout, idx,
+                            workq, resultq, source):
+            # Counters are sent to the coordinator at intervals, rather than
+            # once per file, to keep the result queue small.
+            counts = urfiles.progress.Progress.new_counts()
+            busy = 0.0
+            flush_time = time.time()
             while True:
+                if time.time() - flush_time > 1.0:
+                    resultq.put((idx, 'progress', (counts, busy)))
+                    counts = urfiles.progress.Progress.new_counts()
+                    busy = 0.0
+                    flush_time = time.time()
                 try:
-                    command, basename, dirname = workq.get(True, 1)
+                    command, dirname, names, dev = workq.get(True, 1)
                 except queue.Empty:
-                    if working:
-                        resultq.put((idx, 'idle', None))
-                    working = False
-                    time.sleep(1)
                     continue
 
                 if command == 'quit':
+                    resultq.put((idx, 'progress', (counts, busy)))
                     return
 
-                if command != 'entry':
-                    resultq.put((idx, 'error',
-                                 'command={} basename={} dirname={}'.format(
-                                     command, basename, dirname)))
-
-                working = True
-
-                if basename is not None:
-                    fulldirname = os.path.join(basename, dirname)
+                start_time = time.time()
+                # Every item taken from the queue is answered with exactly one
+                # 'listed' or 'batch' message, even if it fails, because the
+                # coordinator counts the items that are still in flight.
+                if command == 'directory':
+                    subdirs, batches = [], []
+                    dirdev = dev
+                    try:
+                        counts['syscalls'] += 1
+                        dirdev = os.stat(dirname).st_dev
+                        subdirs, batches = Scan._directory(idx, dirname,
+                                                           resultq, counts,
+                                                           schedule)
+                    except OSError as exception:
+                        counts['errors'] += 1
+                        resultq.put((idx, 'oserror',
+                                     dirname + ': ' + repr(exception)))
+                    resultq.put((idx, 'listed', (dirname, dev, dirdev,
+                                                 subdirs, batches)))
+                elif command == 'files':
+                    if schedule == 'device' and \
+                       urfiles.device.Device.rotational(dev):
+                        names = urfiles.device.Device.order(dirname, names)
+                    for name in names:
+                        try:
+                            Scan._entry(db, conn, writer, hasher, idx,
+                                        os.path.join(dirname, name), source,
+                                        resultq, counts, sandbox=sandbox,
+                                        timeout=timeout, retry=retry)
+                        except Exception:
+                            counts['errors'] += 1
+                            resultq.put((idx, 'error',
+                                         traceback.format_exc()))
+                    # The files have been read, so the next batch can
+                    # start. The batch must be durable before the journal
+                    # can record its directory as completed, so that waits
+                    # for a 'written' message, sent once it is committed.
+                    resultq.put((idx, 'batch', (dirname, dev)))
+                    writer.flush(lambda ok, dirname=dirname: resultq.put(
+                        (idx, 'written', (dirname, ok))))
                 else:
-                    fulldirname = dirname
-
-                try:
-                    statinfo = os.stat(fulldirname)
-                except FileNotFoundError as exception:
-                    resultq.put((idx, 'notfound',
-                                 fulldirname + ': ' + repr(exception)))
-                    continue
-                except OSError as exception:
-                    resultq.put((idx, 'oserror',
-                                 fulldirname + ': ' + repr(exception)))
-                    continue
-
-                if stat.S_ISDIR(statinfo.st_mode):
-                    Scan._directory(idx, fulldirname, workq, resultq)
-                else:
-                    Scan._file(db, conn, statinfo,
-                               idx, fulldirname, source, workq, resultq)
+                    resultq.put((idx, 'error',
+                                 'command={} dirname={} names={}'.format(
+                                     command, dirname, names)))
+                    resultq.put((idx, 'batch', (dirname, dev)))
+                    writer.flush(lambda ok, dirname=dirname: resultq.put(
+                        (idx, 'written', (dirname, ok))))
+                busy += time.time() - start_time
 
         assert workq
         assert resultq
         resultq.put((idx, 'starting'), True)
-        time.sleep(1)
         try:
-            db = urfiles.db.DB(config.config)
+            if spool:
+                db = urfiles.spool.Spool(spool, known_md5s=known_md5s)
+            else:
+                db = urfiles.db.DB(config.config)
             conn = db.connect()
-            internal_worker(db, conn, idx, workq, resultq, source)
+            db.prepare_source(conn, source)
+            conn.commit()
+            # The writer has a connection of its own, so that its commits
+            # do not wait for the worker's lookups (a spool has no
+            # connection, and is shared).
+            writer_conn = conn if spool else db.connect()
+            writer = urfiles.writer.Writer(
+                db, writer_conn,
+                error=lambda message: resultq.put((idx, 'error', message)))
+            hasher = urfiles.hasher.Hasher.from_config(config.config)
+            section = config.config['identify']
+            timeout = float(section.get('timeout', 60)) or None
+            sandbox = None
+            if section.getboolean('sandbox', True):
+                sandbox = urfiles.sandbox.Sandbox(timeout=timeout)
+            try:
+                internal_worker(db, conn, writer, hasher, sandbox, timeout,
+                                idx, workq, resultq, source)
+            finally:
+                if sandbox is not None:
+                    sandbox.close()
+                writer.close()
+                if writer_conn is not conn:
+                    writer_conn.close()
+            db.bump_generation(conn)
             conn.commit()
             conn.close()
         except Exception as exception:
@@ -149,71 +357,225 @@ class Scan():
         if result is not None:
             INFO('worker %d: %d', idx, str(future.result()))
 
+    def _precount(self, directories):
+        self.progress.expect(urfiles.progress.Progress.precount(directories))
+
+    @staticmethod
+    def _dev(path):
+        try:
+            return os.stat(path).st_dev
+        except OSError:
+            return 0
+
+    def _limit(self, dev):
+        if self.schedule != 'device':
+            return self.max_workers
+        if urfiles.device.Device.rotational(dev):
+            return self.hdd_readers
+        return self.ssd_readers
+
+    def _queue(self, command, dirname, names, dev):
+        if dev not in self.waiting:
+            self.waiting[dev] = collections.deque()
+        self.waiting[dev].append((command, dirname, names))
+        self.inflight += 1
+
+    def _dispatch(self, workq):
+        # Items are handed out round-robin across devices, and only while
+        # the device is below its limit. Items stay in self.waiting until
+        # then, so the work queue only holds items that may run now.
+        dispatched = True
+        while dispatched:
+            dispatched = False
+            for dev, items in self.waiting.items():
+                if items and self.active[dev] < self._limit(dev):
+                    command, dirname, names = items.popleft()
+                    workq.put((command, dirname, names, dev))
+                    self.active[dev] += 1
+                    dispatched = True
+
+    def _queue_directory(self, dirname, dev):
+        self.queued.add(dirname)
+        self._queue('directory', dirname, None, dev)
+        self.journal.queued(dirname)
+
+    def _listed(self, dirname, dev, dirdev, subdirs, batches):
+        self.inflight -= 1
+        self.active[dev] -= 1
+        # Subdirectories are usually on the same device. If one is a mount
+        # point, its files are still queued on the right device once it has
+        # been listed.
+        # On --resume, a pending directory is usually listed again along
+        # with its pending subdirectories, which are already queued.
+        for subdir in subdirs:
+            if subdir not in self.journal.completed and \
+               subdir not in self.journal.pending and \
+               subdir not in self.queued:
+                self._queue_directory(subdir, dirdev)
+        for names in batches:
+            self._queue('files', dirname, names, dirdev)
+        # If a directory is listed twice, it is complete once the batches of
+        # both listings are written.
+        self.outstanding[dirname] = self.outstanding.get(dirname, 0) + \
+            len(batches)
+        self._written(dirname, True, done=False)
+
+    def _batch(self, dirname, dev):
+        # The files of a batch have been read. Their rows are written in the
+        # background, and _written is called once they are committed.
+        self.inflight -= 1
+        self.active[dev] -= 1
+        self.unwritten += 1
+
+    def _written(self, dirname, ok, done=True):
+        if done:
+            self.unwritten -= 1
+        if dirname not in self.outstanding:
+            # Files named on the command line are not part of a listing.
+            return
+        if not ok:
+            # The directory stays pending, so --resume scans it again.
+            self.failed.add(dirname)
+        if done:
+            self.outstanding[dirname] -= 1
+        if self.outstanding[dirname] == 0:
+            del self.outstanding[dirname]
+            if dirname in self.failed:
+                ERROR('Not all rows of %s were written', dirname)
+            else:
+                self.journal.complete(dirname)
+
+    def _fill(self):
+        if self.resume and (self.journal.done or self.journal.pending):
+            for dirname in list(self.journal.pending):
+                self._queue_directory(dirname, self._dev(dirname))
+            return
+        for directory in self.directories:
+            INFO('Adding {}'.format(directory))
+            if os.path.isdir(directory):
+                self._queue_directory(directory, self._dev(directory))
+            else:
+                self._queue('files', os.path.dirname(directory),
+                            [os.path.basename(directory)],
+                            self._dev(directory))
+
+    def _update_stats(self):
+        # The workers have committed their rows, so the stats of the source
+        # can be brought up to date.
+        db = urfiles.db.DB(self.config.config)
+        conn = db.connect()
+        if not conn:
+            ERROR('Cannot connect to database to update stats')
+            return
+        db.update_stats(conn, [self.source])
+        conn.close()
+
     def scan(self, callback=_log_callback.__func__):
+        self.journal = urfiles.journal.Journal(self.journal_file,
+                                               interval=self.checkpoint)
+        self.journal.open({'directories': self.directories,
+                           'source': self.source,
+                           'spool': self.spool},
+                          resume=self.resume)
+        self.inflight = 0
+        self.unwritten = 0
+        self.outstanding = dict()
+        self.failed = set()
+        # Directories queued by this run
+        self.queued = set()
+        self.waiting = collections.OrderedDict()
+        self.active = collections.Counter()
+
         # Start the workers
         manager = multiprocessing.Manager()
         workq = manager.Queue()
         resultq = manager.Queue()
-        resultq.put((-1, 'test'))
         futures = []
         INFO('Starting {} concurrent worker(s)'.format(self.max_workers))
-        message_time = 0
         with concurrent.futures.ProcessPoolExecutor(
                 max_workers=self.max_workers) as executor:
             for idx in range(self.max_workers):
                 future = executor.submit(self._worker, self.config, idx, workq,
-                                         resultq, self.source)
+                                         resultq, self.source,
+                                         spool=self.spool,
+                                         known_md5s=self.known_md5s,
+                                         schedule=self.schedule,
+                                         retry=self.retry)
                 futures.append(future)
                 future.add_done_callback(
                     lambda future, idx=idx: self._done_callback(idx, future))
 
             INFO('Filling the queue from {} directory'.format(
                 len(self.directories)))
-            # Fill the queue
-            for directory in self.directories:
-                if directory[0] == '/':
-                    INFO('Adding {}'.format(directory))
-                    workq.put(('entry', None, directory))
-                else:
-                    INFO('Adding {} in {}'.format(directory, os.getcwd()))
-                    workq.put(('entry', os.getcwd(), directory))
+            self._fill()
+            self._dispatch(workq)
+
+            # The pre-count runs alongside the workers, so it does not delay
+            # the scan. Until it finishes, no ETA is available.
+            if self.precount and not self.resume:
+                threading.Thread(target=self._precount,
+                                 args=(self.directories,),
+                                 daemon=True).start()
 
-            # Get results
+            # Get results until every queued item has been answered, and its
+            # rows written.
             results = 0
-            working = [True] * self.max_workers
-            while True:
-                for idx, future in enumerate(futures):
-                    if working[idx] and future.done():
-                        INFO('worker %d: no longer running', idx)
-                        working[idx] = False
+            finished = True
+            while self.inflight > 0 or self.unwritten > 0:
+                if all(future.done() for future in futures):
+                    ERROR('All workers stopped with %d items in flight',
+                          self.inflight + self.unwritten)
+                    finished = False
+                    break
+                self.journal.maybe_flush()
+                self.progress.log()
                 try:
-                    result = resultq.get(False)
-                    results += 1
-                    DEBUG('result=%s', result)
-                    if time.time() - message_time > 1.5:
-                        message_time = time.time()
-                        INFO('workq=%d resultq=%d workers=%d results=%d',
-                             workq.qsize(), resultq.qsize(), sum(working),
-                             results)
-                    if result[1] == 'metadata':
-                        INFO('metadata=%s', str(result[2]))
-                    if result[1] == 'working':
-                        working[result[0]] = True
-                        continue
-                    if result[1] == 'idle':
-                        working[result[0]] = False
-                    if result[1] == 'error':
-                        INFO('worker %d: %s', result[0], result[2])
+                    result = resultq.get(True, 1)
                 except queue.Empty:
-                    INFO('workq=%d resultq=%d workers=%d results=%d',
-                         workq.qsize(), resultq.qsize(), sum(working),
-                         results)
-                    time.sleep(1)
-                if resultq.qsize() == 0 and sum(working) == 0:
-                    INFO('workq=%d resultq=%d workers=%d results=%d',
-                         workq.qsize(), resultq.qsize(), sum(working),
-                         results)
-                    INFO('exiting: %d results', results)
-                    break
+                    DEBUG('workq=%d resultq=%d inflight=%d results=%d',
+                          workq.qsize(), resultq.qsize(), self.inflight,
+                          results)
+                    continue
+                results += 1
+                DEBUG('result=%s', result)
+                if result[1] == 'progress':
+                    self.progress.update(result[0], *result[2])
+                elif result[1] == 'listed':
+                    self._listed(*result[2])
+                    self._dispatch(workq)
+                elif result[1] == 'batch':
+                    self._batch(*result[2])
+                    self._dispatch(workq)
+                elif result[1] == 'written':
+                    self._written(*result[2])
+                elif result[1] == 'error':
+                    INFO('worker %d: %s', result[0], result[2])
+                elif result[1] == 'quarantine':
+                    ERROR('quarantined %s', result[2])
+            INFO('exiting: %d results', results)
             for idx in range(self.max_workers):
-                workq.put(('quit', None, None))
+                workq.put(('quit', None, None, None))
+
+        # Collect the counters that the workers sent when they stopped.
+        while True:
+            try:
+                result = resultq.get(False)
+            except queue.Empty:
+                break
+            if result[1] == 'progress':
+                self.progress.update(result[0], *result[2])
+        self.journal.close(done=finished and not self.failed)
+        if self.spool is None:
+            self._update_stats()
+
+        self.progress.finish()
+        self.progress.log(force=True)
+        if self.report:
+            self.progress.write_report(self.report,
+                                       directories=self.directories,
+                                       source=self.source,
+                                       workers=self.max_workers,
+                                       spool=self.spool,
+                                       resumed=self.resume,
+                                       schedule=self.schedule,
+                                       retry_quarantined=self.retry)
@@ -1,32 +1,161 @@
 #!/usr/bin/env python3
 # search.py -*-python-*-
 
+import datetime
+import json
+import time
+import sqlite3
 import traceback
+import urfiles.cache
+import urfiles.client
 import urfiles.config
+import urfiles.db
 
 # pylint: disable=unused-import
 from urfiles.log import DEBUG, INFO, ERROR, FATAL
 
 
 class Search():
-    def __init__(self, expr, config, debug=False):
+    # A relative time (Nd) is different for every search, so the cache key
+    # has --newer rounded down and --older rounded up to a multiple of this
+    # many seconds. The cached rows are then filtered with the exact times.
+    CACHE_SECONDS = 3600
+
+    def __init__(self, expr, config, debug=False, source=None, md5=None,
+                 min_size=None, max_size=None, newer=None, older=None,
+                 limit=None, order_by='path', after=None, server=None,
+                 snapshot=None):
         self.expr = expr
         self.config = config
         self.debug = debug
+        # All criteria are combined into one query, which the database can
+        # answer from its indexes on md5, bytes and mtime_ns.
+        self.criteria = {'re': expr, 'source': source, 'md5': md5,
+                         'min_size': min_size, 'max_size': max_size,
+                         'newer': newer, 'older': older}
+        self.limit = limit
+        self.order_by = order_by
+        self.after = json.loads(after) if after is not None else None
+        # With the socket of a --serve daemon, the search is sent to the
+        # daemon, and only falls back to the database if that fails.
+        self.server = server
+        # With a Snapshot, the search reads the snapshot file instead of the
+        # database.
+        self.snapshot = snapshot
+        # Set by re() when there may be more results: pass it as after to
+        # get the next page.
+        self.next_after = None
 
-    def re(self):
+    @staticmethod
+    def parse_time(value):
+        # Returns ns since the epoch for an ISO date or time (in local time),
+        # or for a number of days ago, e.g. 30d.
+        if value.endswith('d') and value[:-1].isdigit():
+            return int((time.time() - int(value[:-1]) * 86400) * 10**9)
         try:
-            db = urfiles.db.DB(self.config.config)
-            conn = db.connect()
-        except Exception as exception:
-            FATAL(traceback.format_exc())
+            when = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            FATAL('Cannot parse time "%s": use YYYY-MM-DD[ HH:MM[:SS]] or'
+                  ' Nd', value)
+        return int(when.timestamp()) * 10**9
 
-        matches = db.re_path(conn, self.expr)
+    @staticmethod
+    def next_key(matches, order_by, limit):
+        if limit is not None and len(matches) == limit:
+            return json.dumps(
+                urfiles.db.Backend.search_key(matches[-1], order_by))
+        return None
 
+    @staticmethod
+    def query(db, conn, criteria, order_by='path', limit=None, after=None):
+        # Returns the matching rows, their metadata by md5, and the key for
+        # the next page (or None).
+        matches = db.search_path(conn, criteria, order_by=order_by,
+                                 limit=limit, after=after)
         meta = dict()
         for path, source, size, mtime_ns, md5 in matches:
             if md5 not in meta:
                 meta[md5] = db.lookup_meta(conn, md5)
+        return matches, meta, Search.next_key(matches, order_by, limit)
 
+    def _snapshot_query(self):
+        matches = self.snapshot.search(self.criteria, order_by=self.order_by,
+                                       limit=self.limit, after=self.after)
+        meta = self.snapshot.lookup_metas([row[4] for row in matches])
+        return matches, meta, self.next_key(matches, self.order_by,
+                                            self.limit)
+
+    def re(self):
+        if self.snapshot is not None:
+            matches, meta, self.next_after = self._snapshot_query()
+            return matches, meta
+
+        if self.server is not None:
+            try:
+                matches, meta, self.next_after = \
+                    urfiles.client.Client(self.server).search(
+                        self.criteria, order_by=self.order_by,
+                        limit=self.limit, after=self.after)
+                return matches, meta
+            except (OSError, ValueError) as e:
+                DEBUG('Cannot use %s: %s', self.server, repr(e))
+
+        try:
+            db = urfiles.db.DB(self.config.config)
+            conn = db.connect()
+        except Exception as exception:
+            FATAL(traceback.format_exc())
+
+        matches, meta, self.next_after = self._cached_query(db, conn)
         conn.close()
         return matches, meta
+
+    @staticmethod
+    def widen(criteria):
+        # The criteria for the cache key, which match every row that criteria
+        # match: the times are moved out to multiples of CACHE_SECONDS.
+        step = Search.CACHE_SECONDS * 10**9
+        widened = dict(criteria)
+        if criteria.get('newer') is not None:
+            widened['newer'] = criteria['newer'] // step * step
+        if criteria.get('older') is not None:
+            widened['older'] = -(-criteria['older'] // step) * step
+        return widened
+
+    def _cached_query(self, db, conn):
+        # The generation is read before the query, so a result is never
+        # cached under a generation older than the rows it reflects.
+        cache = urfiles.cache.Cache.from_config(self.config)
+        generation = db.fetch_generation(conn) if cache is not None else None
+        if generation is None:
+            return self.query(db, conn, self.criteria, order_by=self.order_by,
+                              limit=self.limit, after=self.after)
+
+        section = self.config.config[db.name]
+        widened = self.widen(self.criteria)
+        key = cache.key([db.name] + [section.get(name) for name in
+                                     ['host', 'port', 'database']],
+                        widened, self.order_by, self.limit, self.after)
+        try:
+            value = cache.get(key, generation)
+        except sqlite3.Error as e:
+            DEBUG('Cannot read cache %s: %s', cache.path, repr(e))
+            value = None
+        if value is None:
+            value = self.query(db, conn, widened, order_by=self.order_by,
+                               limit=self.limit, after=self.after)
+            try:
+                cache.put(key, generation, list(value))
+            except sqlite3.Error as e:
+                DEBUG('Cannot write cache %s: %s', cache.path, repr(e))
+        cache.close()
+
+        rows, meta, next_after = value
+        matches = [tuple(row) for row in rows
+                   if urfiles.db.Backend.accept(row, self.criteria)]
+        if len(matches) < len(rows) and self.limit is not None and \
+           len(rows) == self.limit:
+            # The page is short of rows that the exact times would match.
+            return self.query(db, conn, self.criteria, order_by=self.order_by,
+                              limit=self.limit, after=self.after)
+        return matches, meta, next_after
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# server.py -*-python-*-
+
+import array
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import socketserver
+import threading
+import time
+import traceback
+import urfiles.client
+import urfiles.compact
+import urfiles.db
+import urfiles.search
+
+# pylint: disable=unused-import
+from urfiles.log import DEBUG, INFO, ERROR, FATAL
+
+
+class Shard():
+    # A compact copy of part of the path table. Paths are kept as one string,
+    # one path per line, so a regular expression is run over the shard with
+    # one call rather than once per row, and a row costs a few bytes of
+    # arrays instead of several Python objects. Newlines in paths are stored
+    # as NUL, which cannot occur in a path.
+    def __init__(self):
+        self.lines = []
+        self.text = None
+        self.starts = array.array('q')
+        self.sizes = array.array('q')
+        self.mtimes = array.array('q')
+        self.sources = array.array('l')
+        self.md5s = []
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def add(self, path, source, size, mtime_ns, md5):
+        self.lines.append(path.replace('\n', '\0'))
+        self.sizes.append(size)
+        self.mtimes.append(mtime_ns)
+        self.sources.append(source)
+        self.md5s.append(md5)
+
+    def seal(self):
+        offset = 0
+        for line in self.lines:
+            self.starts.append(offset)
+            offset += len(line) + 1
+        self.text = '\n'.join(self.lines) + '\n'
+        self.lines = None
+
+    def path(self, idx):
+        end = self.starts[idx + 1] - 1 if idx + 1 < len(self.starts) else \
+            len(self.text) - 1
+        return self.text[self.starts[idx]:end].replace('\0', '\n')
+
+    def match(self, expr):
+        return urfiles.compact.match_lines(self.text, expr)
+
+
+# The index of the running server. Worker processes are forked after it has
+# been built, so they share it with the server rather than copying it.
+INDEX = None
+
+
+def _init_worker():
+    # Workers may be forked after the server has set its SIGTERM handler,
+    # and Pool.terminate stops them with SIGTERM.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def _match_shard(args):
+    shard, expr = args
+    return shard, INDEX.shards[shard].match(expr)
+
+
+class Index():
+    SHARD_ROWS = 2**20
+
+    def __init__(self, max_workers=3):
+        self.max_workers = max_workers
+        self.shards = []
+        self.sources = []
+        self.pool = None
+        self.generation = None
+
+    def build(self, db, conn):
+        # The generation is read first, so rows written while the index is
+        # being built make it stale rather than being missed.
+        self.generation = db.fetch_generation(conn)
+        source_ids = dict()
+        shard = None
+        for path, source, size, mtime_ns, md5 in db.iter_paths(conn):
+            if shard is None or len(shard) >= self.SHARD_ROWS:
+                if shard is not None:
+                    shard.seal()
+                shard = Shard()
+                self.shards.append(shard)
+            if source not in source_ids:
+                source_ids[source] = len(self.sources)
+                self.sources.append(source)
+            shard.add(path, source_ids[source], size, mtime_ns, md5)
+        if shard is not None:
+            shard.seal()
+        INFO('Index: %d rows in %d shards',
+             sum(len(shard) for shard in self.shards), len(self.shards))
+
+    def start(self):
+        global INDEX
+        INDEX = self
+        self.pool = multiprocessing.get_context('fork').Pool(
+            self.max_workers, initializer=_init_worker)
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    def _row(self, shard, idx):
+        data = self.shards[shard]
+        return (data.path(idx), self.sources[data.sources[idx]],
+                data.sizes[idx], data.mtimes[idx], data.md5s[idx])
+
+    def search(self, criteria, order_by='path', limit=None, after=None):
+        # The same rows, in the same order, as Backend.search_path.
+        matches = []
+        for shard, indexes in self.pool.imap_unordered(
+                _match_shard,
+                [(shard, criteria['re']) for shard in
+                 range(len(self.shards))]):
+            for idx in indexes:
+                matches.append(self._row(shard, idx))
+        return urfiles.db.Backend.select_rows(matches, criteria,
+                                              order_by=order_by,
+                                              limit=limit, after=after)
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.server.urfiles.handle(json.loads(line))
+            except Exception:
+                ERROR(traceback.format_exc())
+                response = {'error': traceback.format_exc(limit=1)}
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
+
+
+class Server():
+    # A --serve daemon keeps database connections open, and optionally an
+    # in-memory index of the path table for regular expression searches
+    # across cores, and answers requests on a Unix socket. Each request and
+    # response is a line of JSON.
+    def __init__(self, config, socket_path, pool_size=4, index=False,
+                 max_workers=3, debug=False):
+        self.config = config
+        self.socket_path = socket_path
+        self.pool_size = pool_size
+        self.use_index = index
+        self.max_workers = max_workers
+        self.debug = debug
+        self.db = None
+        self.conns = queue.Queue()
+        self.index = None
+        self.rebuilding = False
+        self.lock = threading.Lock()
+
+    def _build_index(self):
+        start_time = time.time()
+        index = Index(max_workers=self.max_workers)
+        conn = self.conns.get()
+        try:
+            index.build(self.db, conn)
+        finally:
+            self.conns.put(conn)
+        index.start()
+        INFO('Index built in %.1fs', time.time() - start_time)
+        with self.lock:
+            old, self.index = self.index, index
+        if old is not None:
+            old.stop()
+
+    def _rebuild_index(self):
+        try:
+            self._build_index()
+        except Exception:
+            ERROR(traceback.format_exc())
+        finally:
+            with self.lock:
+                self.rebuilding = False
+
+    def _index_current(self, index, conn):
+        # A scan, --load or --ingest since the index was built changes the
+        # generation. The index is then rebuilt in the background, and
+        # searches use the database until the new index is ready. Without a
+        # generation table, staleness cannot be seen, and the index is only
+        # rebuilt on a reload request.
+        generation = self.db.fetch_generation(conn)
+        if generation == index.generation:
+            return True
+        with self.lock:
+            if self.rebuilding:
+                return False
+            self.rebuilding = True
+        INFO('Generation changed from %s to %s, rebuilding index',
+             index.generation, generation)
+        threading.Thread(target=self._rebuild_index, daemon=True).start()
+        return False
+
+    def _search(self, request):
+        criteria = request['criteria']
+        order_by = request.get('order_by', 'path')
+        limit = request.get('limit')
+        after = request.get('after')
+        with self.lock:
+            index = self.index
+        conn = self.conns.get()
+        try:
+            if index is not None and criteria.get('re') is not None and \
+               self._index_current(index, conn):
+                matches = index.search(criteria, order_by=order_by,
+                                       limit=limit, after=after)
+                meta = dict()
+                for row in matches:
+                    if row[4] not in meta:
+                        meta[row[4]] = self.db.lookup_meta(conn, row[4])
+                next_after = urfiles.search.Search.next_key(matches,
+                                                            order_by, limit)
+            else:
+                matches, meta, next_after = urfiles.search.Search.query(
+                    self.db, conn, criteria, order_by=order_by, limit=limit,
+                    after=after)
+            conn.commit()
+        except Exception:
+            # The connection may be unusable (e.g., in a failed
+            # transaction), so it is replaced.
+            conn.close()
+            conn = self.db.connect()
+            raise
+        finally:
+            self.conns.put(conn)
+        return {'matches': matches, 'meta': meta, 'next_after': next_after}
+
+    def handle(self, request):
+        command = request.get('command')
+        if command == 'search':
+            return self._search(request)
+        if command == 'ping':
+            return {'pong': os.getpid()}
+        if command == 'reload':
+            if self.use_index:
+                self._build_index()
+            return {'reloaded': self.use_index}
+        return {'error': 'unknown command {}'.format(command)}
+
+    def serve(self):
+        self.db = urfiles.db.DB(self.config.config)
+        for _ in range(self.pool_size):
+            conn = self.db.connect()
+            if not conn:
+                FATAL('Cannot connect to database')
+            self.conns.put(conn)
+        if self.use_index:
+            self._build_index()
+
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        if os.path.exists(self.socket_path):
+            try:
+                urfiles.client.Client(self.socket_path).request(
+                    {'command': 'ping'})
+                FATAL('A server is already listening on %s',
+                      self.socket_path)
+            except OSError:
+                os.remove(self.socket_path)
+
+        old_umask = os.umask(0o077)
+        server = socketserver.ThreadingUnixStreamServer(self.socket_path,
+                                                        Handler)
+        os.umask(old_umask)
+        server.daemon_threads = True
+        server.urfiles = self
+
+        # SIGTERM stops the daemon as SIGINT does, removing the socket.
+        def interrupt(signum, frame):
+            raise KeyboardInterrupt
+
+        signal.signal(signal.SIGTERM, interrupt)
+        INFO('Listening on %s', self.socket_path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.remove(self.socket_path)
+            if self.index is not None:
+                self.index.stop()
+            while not self.conns.empty():
+                self.conns.get().close()
+
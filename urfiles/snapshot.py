@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# snapshot.py -*-python-*-
+
+import array
+import bisect
+import itertools
+import json
+import mmap
+import multiprocessing
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import zlib
+import urfiles.compact
+import urfiles.db
+
+# pylint: disable=unused-import
+from urfiles.log import DEBUG, INFO, ERROR, FATAL
+
+
+# The snapshot that the worker processes of a search read.
+SNAPSHOT = None
+
+
+def _init_worker(filename):
+    global SNAPSHOT
+    SNAPSHOT = Snapshot(filename)
+
+
+def _search_chunk(args):
+    idx, criteria, order_by, limit, after = args
+    return SNAPSHOT.search_chunk(idx, criteria, order_by=order_by,
+                                 limit=limit, after=after)
+
+
+class Snapshot():
+    # A snapshot is a copy of the path and meta tables in one file, which
+    # can be searched without a database, e.g., on a laptop or at a site
+    # with no network. Path rows are sorted by path and stored by column,
+    # in chunks of CHUNK_ROWS rows, each column compressed by itself:
+    #
+    #   paths   one per line (newlines stored as NUL). zlib codes a path
+    #           that shares a prefix with the one before it as a
+    #           back-reference, which does the work of front coding, and a
+    #           chunk decompresses straight into the text that a regular
+    #           expression is run over.
+    #   sources indexes into the list of sources
+    #   sizes   sizes
+    #   mtimes  the difference from the mtime of the row before
+    #   md5s    16-byte digests
+    #
+    # Numbers are little-endian 64-bit integers, which zlib shrinks to about
+    # the size of a varint, but which are decoded by array in C rather than
+    # one byte at a time in Python.
+    #
+    # The md5s of meta are stored as sorted 16-byte digests, uncompressed so
+    # that they can be searched in place, and the metadata in compressed
+    # chunks of META_ROWS lines of JSON. A JSON footer locates the chunks.
+    # The file is mapped into memory, and chunks are searched in --workers
+    # processes.
+    MAGIC = b'URFSNAP1'
+    VERSION = 1
+    CHUNK_ROWS = 65536
+    META_ROWS = 1024
+    # The offset of the footer, and MAGIC again.
+    TRAILER = struct.Struct('<Q8s')
+    WIDTH = 16
+
+    def __init__(self, filename, max_workers=3):
+        self.filename = filename
+        self.max_workers = max_workers
+        with open(filename, 'rb') as fp:
+            try:
+                self.data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                FATAL('%s is not a snapshot', filename)
+        trailer = self.data[-self.TRAILER.size:]
+        if self.data[:len(self.MAGIC)] != self.MAGIC or \
+           len(trailer) != self.TRAILER.size or \
+           self.TRAILER.unpack(trailer)[1] != self.MAGIC:
+            FATAL('%s is not a snapshot', filename)
+        offset = self.TRAILER.unpack(trailer)[0]
+        self.footer = json.loads(
+            self.data[offset:len(self.data) - self.TRAILER.size])
+        if self.footer['version'] != self.VERSION:
+            FATAL('%s is a version %d snapshot: cannot read it', filename,
+                  self.footer['version'])
+        meta = self.footer['meta']
+        self.digests = urfiles.compact.Records(self.data, self.WIDTH,
+                                               start=meta['digests'],
+                                               count=meta['count'])
+        self.cached = None
+        self.cached_lines = None
+
+    @staticmethod
+    def _put(fp, data):
+        # Writes data, compressed, and returns where it is.
+        data = zlib.compress(data)
+        offset = fp.tell()
+        fp.write(data)
+        return [offset, len(data)]
+
+    def _get(self, location):
+        offset, length = location
+        return zlib.decompress(self.data[offset:offset + length])
+
+    @staticmethod
+    def _digest(md5):
+        # Returns the 16-byte digest of md5, or None if it is not one.
+        try:
+            digest = bytes.fromhex(md5)
+        except (TypeError, ValueError):
+            return None
+        return digest if len(digest) == Snapshot.WIDTH else None
+
+    @staticmethod
+    def _put_array(fp, values):
+        values = array.array('q', values)
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return Snapshot._put(fp, values.tobytes())
+
+    def _get_array(self, location):
+        values = array.array('q', self._get(location))
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values
+
+    @staticmethod
+    def _write_chunk(fp, rows, source_ids):
+        # Rows that the columns cannot hold (e.g., a NULL size, or an md5
+        # that is not hex) are kept as they are in the footer, under other.
+        chunk = {'rows': len(rows), 'other': dict()}
+        chunk['paths'] = Snapshot._put(fp, '\n'.join(
+            [row[0].replace('\n', '\0') for row in rows]).encode(
+                'utf-8', 'surrogateescape'))
+        sizes = []
+        mtimes = []
+        md5s = bytearray()
+        previous = 0
+        for idx, row in enumerate(rows):
+            _, _, size, mtime_ns, md5 = row
+            digest = Snapshot._digest(md5)
+            if size is None or mtime_ns is None or digest is None:
+                chunk['other'][str(idx)] = [size, mtime_ns, md5]
+                size, mtime_ns, digest = 0, previous, bytes(Snapshot.WIDTH)
+            sizes.append(size)
+            mtimes.append(mtime_ns - previous)
+            previous = mtime_ns
+            md5s += digest
+        chunk['sources'] = Snapshot._put_array(
+            fp, [source_ids[row[1]] for row in rows])
+        chunk['sizes'] = Snapshot._put_array(fp, sizes)
+        chunk['mtimes'] = Snapshot._put_array(fp, mtimes)
+        chunk['md5s'] = Snapshot._put(fp, bytes(md5s))
+        return chunk
+
+    @staticmethod
+    def export(db, conn, filename):
+        # Writes the path and meta tables to filename. Rows are read in
+        # order from cursors and written a chunk at a time, so memory use
+        # does not depend on the size of the tables.
+        footer = {'version': Snapshot.VERSION, 'time_ns': time.time_ns(),
+                  'rows': 0, 'sources': [], 'chunks': []}
+        source_ids = dict()
+        tmpname = filename + '.tmp'
+        with open(tmpname, 'wb') as fp:
+            fp.write(Snapshot.MAGIC)
+            rows = []
+            for row in itertools.chain(db.iter_paths(conn, ordered=True),
+                                       [None]):
+                if row is not None:
+                    if row[1] not in source_ids:
+                        source_ids[row[1]] = len(footer['sources'])
+                        footer['sources'].append(row[1])
+                    rows.append(row)
+                if len(rows) == Snapshot.CHUNK_ROWS or \
+                   (row is None and rows):
+                    footer['chunks'].append(
+                        Snapshot._write_chunk(fp, rows, source_ids))
+                    footer['rows'] += len(rows)
+                    rows = []
+                    INFO('%d path rows written', footer['rows'])
+
+            # The digests are collected in a temporary file while the
+            # metadata is written, and then appended in one piece.
+            meta = {'count': 0, 'chunks': [], 'other': dict()}
+            with tempfile.TemporaryFile(
+                    dir=os.path.dirname(os.path.abspath(filename))) as digests:
+                lines = []
+                for md5, metadata in itertools.chain(db.iter_meta(conn),
+                                                     [(None, None)]):
+                    if md5 is not None:
+                        digest = Snapshot._digest(md5)
+                        if digest is None:
+                            meta['other'][md5] = metadata
+                            continue
+                        digests.write(digest)
+                        # A newline in JSON can only be whitespace.
+                        lines.append('null' if metadata is None
+                                     else metadata.replace('\n', ' '))
+                        meta['count'] += 1
+                    if len(lines) == Snapshot.META_ROWS or \
+                       (md5 is None and lines):
+                        meta['chunks'].append(Snapshot._put(
+                            fp, '\n'.join(lines).encode(
+                                'utf-8', 'surrogateescape')))
+                        lines = []
+                digests.seek(0)
+                meta['digests'] = fp.tell()
+                shutil.copyfileobj(digests, fp)
+            INFO('%d meta rows written', meta['count'])
+            footer['meta'] = meta
+
+            offset = fp.tell()
+            fp.write(json.dumps(footer).encode())
+            fp.write(Snapshot.TRAILER.pack(offset, Snapshot.MAGIC))
+        os.replace(tmpname, filename)
+        return footer['rows'], meta['count']
+
+    def _rows(self, idx, indexes, lines):
+        # Returns the path rows at indexes in chunk idx, whose paths are
+        # lines.
+        chunk = self.footer['chunks'][idx]
+        sources = self._get_array(chunk['sources'])
+        sizes = self._get_array(chunk['sizes'])
+        mtimes = list(itertools.accumulate(self._get_array(chunk['mtimes'])))
+        md5s = self._get(chunk['md5s'])
+        other = chunk['other']
+        rows = []
+        for row in indexes:
+            if str(row) in other:
+                size, mtime_ns, md5 = other[str(row)]
+            else:
+                size, mtime_ns = sizes[row], mtimes[row]
+                md5 = md5s[row * self.WIDTH:(row + 1) * self.WIDTH].hex()
+            rows.append((lines[row].replace('\0', '\n'),
+                         self.footer['sources'][sources[row]], size,
+                         mtime_ns, md5))
+        return rows
+
+    def search_chunk(self, idx, criteria, order_by='path', limit=None,
+                     after=None):
+        # Returns the rows of chunk idx that search_path would return.
+        chunk = self.footer['chunks'][idx]
+        text = self._get(chunk['paths']).decode('utf-8',
+                                                'surrogateescape') + '\n'
+        if criteria.get('re') is not None:
+            indexes = urfiles.compact.match_lines(text, criteria['re'])
+        else:
+            indexes = range(chunk['rows'])
+        if not indexes:
+            return []
+        lines = text.split('\n')
+        return urfiles.db.Backend.select_rows(
+            self._rows(idx, indexes, lines), criteria, order_by=order_by,
+            limit=limit, after=after)
+
+    def search(self, criteria, order_by='path', limit=None, after=None):
+        # The same rows, in the same order, as Backend.search_path. Each
+        # chunk returns at most limit rows, so the rows kept in memory are
+        # bounded even when most paths match.
+        jobs = [(idx, criteria, order_by, limit, after)
+                for idx in range(len(self.footer['chunks']))]
+        if self.max_workers > 1 and len(jobs) > 1:
+            with multiprocessing.Pool(min(self.max_workers, len(jobs)),
+                                      initializer=_init_worker,
+                                      initargs=(self.filename,)) as pool:
+                results = list(pool.imap_unordered(_search_chunk, jobs))
+        else:
+            results = [self.search_chunk(*job) for job in jobs]
+        return urfiles.db.Backend.select_rows(
+            itertools.chain.from_iterable(results), criteria,
+            order_by=order_by, limit=limit, after=after)
+
+    def lookup_meta(self, md5):
+        digest = self._digest(md5)
+        if digest is None:
+            metadata = self.footer['meta']['other'].get(md5)
+            return json.loads(metadata) if metadata is not None else None
+        idx = bisect.bisect_left(self.digests, digest)
+        if idx >= len(self.digests) or self.digests[idx] != digest:
+            return None
+        chunk = idx // self.META_ROWS
+        if self.cached != chunk:
+            self.cached_lines = self._get(
+                self.footer['meta']['chunks'][chunk]).decode(
+                    'utf-8', 'surrogateescape').split('\n')
+            self.cached = chunk
+        return json.loads(self.cached_lines[idx % self.META_ROWS])
+
+    def lookup_metas(self, md5s):
+        # Returns the metadata of each of md5s by md5. They are looked up in
+        # order, so each chunk of metadata is decompressed once.
+        return {md5: self.lookup_meta(md5)
+                for md5 in sorted(set(md5s), key=str)}
+
+    def close(self):
+        self.data.close()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# spool.py -*-python-*-
+
+import csv
+import gzip
+import json
+import os
+import socket
+import time
+
+# pylint: disable=unused-import
+from urfiles.log import DEBUG, INFO, ERROR, FATAL
+
+
+class Spool():
+    # A Spool stands in for urfiles.db.DB in a scan worker when there is no
+    # database. Rows are appended to gzip-compressed CSV files, one set per
+    # worker, in the column order of the database tables, so that --ingest
+    # can COPY them directly. Each flush closes the current gzip member, so
+    # a crash loses at most the rows written since the last flush.
+    TABLES = ['path', 'meta', 'quarantine']
+
+    def __init__(self, directory, known_md5s=None, flush_rows=10000):
+        self.directory = directory
+        self.known_md5s_file = known_md5s
+        self.flush_rows = flush_rows
+        self.known_md5s = set()
+        self.rows = dict()
+        self.filenames = dict()
+
+    @staticmethod
+    def read_md5s(filename):
+        md5s = set()
+        opener = gzip.open if filename.endswith('.gz') else open
+        with opener(filename, 'rt') as fp:
+            for line in fp:
+                line = line.strip()
+                if line != '':
+                    md5s.add(line)
+        return md5s
+
+    @staticmethod
+    def write_md5s(filename, md5s):
+        opener = gzip.open if filename.endswith('.gz') else open
+        with opener(filename, 'wt') as fp:
+            for md5 in sorted(md5s):
+                fp.write(md5 + '\n')
+
+    @staticmethod
+    def spool_files(directory, table):
+        prefix = table + '-'
+        return sorted([os.path.join(directory, name)
+                       for name in os.listdir(directory)
+                       if name.startswith(prefix) and
+                       name.endswith('.csv.gz')])
+
+    def connect(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if self.known_md5s_file:
+            self.known_md5s = self.read_md5s(self.known_md5s_file)
+            DEBUG('%d known md5s read from %s', len(self.known_md5s),
+                  self.known_md5s_file)
+        tag = '{}-{}'.format(socket.gethostname(), os.getpid())
+        for table in self.TABLES:
+            self.rows[table] = []
+            self.filenames[table] = os.path.join(
+                self.directory, '{}-{}.csv.gz'.format(table, tag))
+        return self
+
+    def _append(self, table, row):
+        self.rows[table].append(row)
+        if len(self.rows[table]) >= self.flush_rows:
+            self.commit()
+
+    def commit(self):
+        for table in self.TABLES:
+            if not self.rows[table]:
+                continue
+            with gzip.open(self.filenames[table], 'at', newline='') as fp:
+                csv.writer(fp).writerows(self.rows[table])
+            self.rows[table] = []
+
+    def close(self):
+        self.commit()
+
+    # pylint: disable=unused-argument
+    def lookup_path(self, conn, path, size, mtime_ns):
+        # Without a database, every file is new.
+        return None
+
+    def insert_path(self, conn, path, source, size, mtime_ns, md5):
+        self._append('path', [path, source, size, mtime_ns, md5])
+        return True
+
+    def lookup_meta(self, conn, md5):
+        # Content that is already known, either from the snapshot or because
+        # this worker has already spooled it, does not need new metadata.
+        # The metadata itself is not available here.
+        if md5 in self.known_md5s:
+            return dict()
+        return None
+
+    def insert_meta(self, conn, md5, metadata):
+        self.known_md5s.add(md5)
+        self._append('meta', [md5, json.dumps(metadata)])
+        return True
+
+    def insert_quarantine(self, conn, path, source, size, mtime_ns, reason):
+        self._append('quarantine', [path, source, size, mtime_ns, reason,
+                                    time.time_ns()])
+        return True
+
+    def lookup_quarantine(self, conn, path, size, mtime_ns):
+        return None
+
+    def delete_quarantine(self, conn, path, source):
+        return True
+
+    def write_rows(self, conn, path_rows=(), meta_rows=(),
+                   quarantine_rows=(), unquarantine_rows=(),
+                   meta_update_rows=()):
+        # Quarantine rows are never found here, so there are none to delete,
+        # and no metadata to update.
+        for row in meta_rows:
+            self.known_md5s.add(row[0])
+        for table, rows in [('path', path_rows), ('meta', meta_rows),
+                            ('quarantine', quarantine_rows)]:
+            self.rows[table].extend([list(row) for row in rows])
+        self.commit()
+        return True
+
+    def prepare_source(self, conn, source):
+        return True
+
+    def bump_generation(self, conn):
+        # --ingest changes the generation when the rows reach the database.
+        return True
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# verify.py -*-python-*-
+
+import collections
+import concurrent.futures
+import os
+import time
+import urfiles.db
+import urfiles.device
+import urfiles.hasher
+import urfiles.progress
+
+# pylint: disable=unused-import
+from urfiles.log import DEBUG, INFO, ERROR, FATAL
+
+
+class Verify():
+    # Verify re-hashes files and compares them with the md5 in their path
+    # row. The result of each check is recorded in the verify table with the
+    # time it was made, and path rows are verified oldest first, so repeated
+    # runs with a time budget work through the whole table over time. A run
+    # that is interrupted simply leaves the rest for the next run. Tapes and
+    # archive members are not verified, as their paths cannot be opened.
+    CHUNK = 1000
+
+    # Set in each worker process by _init_worker.
+    hasher = None
+
+    def __init__(self, target, config, max_workers=3, debug=False,
+                 bandwidth=None, budget=None, min_age=None, report=None):
+        # The target is a directory tree, a source, or None for everything.
+        self.source = None
+        self.prefix = None
+        if target is not None and os.path.isdir(target):
+            self.prefix = os.path.join(os.path.abspath(target), '')
+        elif target is not None:
+            self.source = target
+        self.config = config
+        self.max_workers = max_workers
+        self.debug = debug
+        self.bandwidth = bandwidth
+        self.budget = budget
+        self.min_age = min_age
+        self.report = report
+        self.progress = urfiles.progress.Progress('verify', max_workers)
+
+        self.hdd_readers = 1
+        self.ssd_readers = max_workers
+        if 'scan' in self.config.config:
+            section = self.config.config['scan']
+            self.hdd_readers = int(section.get('hdd_readers',
+                                               self.hdd_readers))
+            self.ssd_readers = int(section.get('ssd_readers', 0)) or \
+                max_workers
+        self.waiting = collections.OrderedDict()
+        self.active = collections.Counter()
+        self.pending = dict()
+        self.start_time = None
+        self.submitted_bytes = 0
+        self.stopped = None
+
+    @staticmethod
+    def _init_worker(config):
+        Verify.hasher = urfiles.hasher.Hasher.from_config(config.config)
+
+    @staticmethod
+    def _hash(path, dev):
+        start_time = time.time()
+        md5 = Verify.hasher.md5(path, dev=dev)
+        return md5, time.time() - start_time
+
+    def _limit(self, dev):
+        if urfiles.device.Device.rotational(dev):
+            return self.hdd_readers
+        return self.ssd_readers
+
+    def _record(self, db, conn, row, status, md5=None):
+        path, source, size, mtime_ns, _, _ = row
+        db.insert_verify(conn, path, source, size, mtime_ns, status, md5)
+        if status != 'ok':
+            DEBUG('%s [%s]: %s', path, source, status)
+
+    def _check(self, db, conn, row):
+        # Files that are gone, or that have changed since they were scanned,
+        # are recorded without hashing them. Only a file with the same size
+        # and mtime but different content is a mismatch.
+        path, _, size, mtime_ns, _, _ = row
+        counts = urfiles.progress.Progress.new_counts()
+        counts['syscalls'] += 1
+        try:
+            statinfo = os.stat(path)
+        except FileNotFoundError:
+            counts['missing'] += 1
+            self._record(db, conn, row, 'missing')
+            self.progress.update(-1, counts)
+            return
+        except OSError as e:
+            ERROR('%s: %s', path, repr(e))
+            counts['errors'] += 1
+            self._record(db, conn, row, 'error')
+            self.progress.update(-1, counts)
+            return
+        if statinfo.st_size != size or statinfo.st_mtime_ns != mtime_ns:
+            counts['skipped'] += 1
+            self._record(db, conn, row, 'changed')
+            self.progress.update(-1, counts)
+            return
+        dev = statinfo.st_dev
+        if dev not in self.waiting:
+            self.waiting[dev] = collections.deque()
+        self.waiting[dev].append(row)
+
+    def _out_of_budget(self):
+        if self.budget is not None and \
+           time.time() - self.start_time >= self.budget:
+            self.stopped = 'time budget exhausted'
+        return self.stopped is not None
+
+    def _throttled(self):
+        # The bandwidth cap is applied when a file is handed to a worker, so
+        # a large file may briefly exceed it, but the average does not.
+        if not self.bandwidth:
+            return False
+        allowed = self.bandwidth * (time.time() - self.start_time)
+        return self.submitted_bytes > allowed
+
+    def _dispatch(self, executor):
+        # Round-robin across devices, within the per-device limits.
+        dispatched = True
+        while dispatched:
+            dispatched = False
+            for dev, rows in self.waiting.items():
+                if not rows or self.active[dev] >= self._limit(dev) or \
+                   self._out_of_budget() or self._throttled():
+                    continue
+                row = rows.popleft()
+                future = executor.submit(self._hash, row[0], dev)
+                self.pending[future] = (row, dev)
+                self.active[dev] += 1
+                self.submitted_bytes += row[2]
+                dispatched = True
+
+    def _hashed(self, db, conn, future):
+        row, dev = self.pending.pop(future)
+        self.active[dev] -= 1
+        counts = urfiles.progress.Progress.new_counts()
+        counts['files'] += 1
+        counts['bytes'] += row[2]
+        try:
+            md5, seconds = future.result()
+        except OSError as e:
+            ERROR('%s: %s', row[0], repr(e))
+            counts['errors'] += 1
+            self._record(db, conn, row, 'error')
+            self.progress.update(-1, counts)
+            return
+        counts['hashed_bytes'] += row[2]
+        counts['hash_seconds'] += seconds
+        if md5 == row[4]:
+            self._record(db, conn, row, 'ok', md5)
+        else:
+            ERROR('%s [%s]: md5 is %s, expected %s', row[0], row[1], md5,
+                  row[4])
+            counts['mismatched'] += 1
+            self._record(db, conn, row, 'mismatch', md5)
+        self.progress.update(-1, counts)
+
+    def verify(self):
+        try:
+            db = urfiles.db.DB(self.config.config)
+            conn = db.connect()
+        except Exception as e:
+            FATAL('Cannot connect to database: %s', repr(e))
+
+        # Each chunk is read on from the last row of the one before, and
+        # rows verified during this run have a later time, so no row is
+        # fetched twice.
+        self.start_time = time.time()
+        before_ns = time.time_ns()
+        if self.min_age is not None:
+            before_ns -= int(self.min_age * 86400 * 1e9)
+
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                initializer=self._init_worker,
+                initargs=(self.config,)) as executor:
+            after = None
+            while not self._out_of_budget():
+                rows = db.fetch_verify(conn, before_ns, self.CHUNK,
+                                       source=self.source,
+                                       prefix=self.prefix, after=after)
+                if not rows:
+                    self.stopped = 'done'
+                    break
+                after = urfiles.db.Backend.verify_key(rows[-1])
+                for row in rows:
+                    self._check(db, conn, row)
+
+                while True:
+                    self._dispatch(executor)
+                    if not self.pending:
+                        if not any(self.waiting.values()) or \
+                           self._out_of_budget():
+                            break
+                        # Throttled by the bandwidth cap.
+                        time.sleep(0.1)
+                        continue
+                    done, _ = concurrent.futures.wait(
+                        self.pending, timeout=1.0,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        self._hashed(db, conn, future)
+                    self.progress.log()
+                conn.commit()
+
+                # Rows that were not started before the budget ran out keep
+                # their old verification time, so the next run starts with
+                # them.
+                self.waiting = collections.OrderedDict()
+        conn.commit()
+        conn.close()
+        INFO('Verify stopped: %s', self.stopped)
+
+        self.progress.finish()
+        self.progress.log(force=True)
+        INFO('%d mismatched, %d missing', self.progress.counts['mismatched'],
+             self.progress.counts['missing'])
+        if self.report:
+            self.progress.write_report(self.report, source=self.source,
+                                       prefix=self.prefix,
+                                       bandwidth=self.bandwidth,
+                                       budget=self.budget,
+                                       min_age=self.min_age,
+                                       workers=self.max_workers,
+                                       stopped=self.stopped)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# writer.py -*-python-*-
+
+import json
+import queue
+import threading
+import time
+import traceback
+
+# pylint: disable=unused-import
+from urfiles.log import DEBUG, INFO, ERROR, FATAL
+
+
+class Writer():
+    # Writes the rows of a scan worker from a thread of its own, on a
+    # connection of its own, so that the worker goes on to stat and hash
+    # the next files while earlier rows are written and committed. Rows are
+    # collected into batches of batch_rows and written with write_rows, a
+    # few statements per batch. At most max_batches are queued: a worker
+    # that gets ahead of the database waits for the writer, rather than
+    # holding more and more rows in memory.
+    def __init__(self, db, conn, max_batches=4, batch_rows=1000,
+                 error=None):
+        self.db = db
+        self.conn = conn
+        self.batch_rows = batch_rows
+        # Called with a message when a batch cannot be written.
+        self.error = error
+        self.batches = queue.Queue(max_batches)
+        self.batch = self._new_batch()
+        # md5s whose meta rows have been queued but not yet committed, so
+        # that the worker does not extract their metadata again.
+        self.pending_md5s = set()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def _new_batch():
+        return {'path': [], 'meta': [], 'meta_update': [], 'quarantine': [],
+                'unquarantine': [], 'done': []}
+
+    def _rows(self):
+        return len(self.batch['path']) + len(self.batch['meta']) + \
+            len(self.batch['meta_update']) + len(self.batch['quarantine']) + \
+            len(self.batch['unquarantine'])
+
+    def _send(self):
+        # Blocks while max_batches are already queued.
+        self.batches.put(self.batch)
+        self.batch = self._new_batch()
+
+    def _add(self, table, row):
+        self.batch[table].append(row)
+        if self._rows() >= self.batch_rows:
+            self._send()
+
+    def insert_path(self, path, source, size, mtime_ns, md5):
+        self._add('path', (path, source, size, mtime_ns, md5))
+
+    def insert_meta(self, md5, metadata):
+        self.pending_md5s.add(md5)
+        self._add('meta', (md5, json.dumps(metadata)))
+
+    def update_meta(self, md5, metadata):
+        self._add('meta_update', (md5, json.dumps(metadata)))
+
+    def has_meta(self, md5):
+        return md5 in self.pending_md5s
+
+    def insert_quarantine(self, path, source, size, mtime_ns, reason):
+        self._add('quarantine', (path, source, size, mtime_ns, reason,
+                                 time.time_ns()))
+
+    def delete_quarantine(self, path, source):
+        self._add('unquarantine', (path, source))
+
+    def flush(self, done=None):
+        # Queues the rows added so far. done, if given, is called with
+        # whether they were written, once they have been committed (or have
+        # failed). Batches are written in order, so this is also after every
+        # row added before.
+        if done is not None:
+            self.batch['done'].append(done)
+        self._send()
+
+    def _write(self, batch):
+        if not (batch['path'] or batch['meta'] or batch['meta_update'] or
+                batch['quarantine'] or batch['unquarantine']):
+            return True
+        try:
+            ok = self.db.write_rows(self.conn, path_rows=batch['path'],
+                                    meta_rows=batch['meta'],
+                                    quarantine_rows=batch['quarantine'],
+                                    unquarantine_rows=batch['unquarantine'],
+                                    meta_update_rows=batch['meta_update'])
+        except Exception:
+            if self.error is not None:
+                self.error(traceback.format_exc())
+            return False
+        if not ok and self.error is not None:
+            self.error('Cannot write {} path rows and {} meta rows'.format(
+                len(batch['path']), len(batch['meta'])))
+        return ok
+
+    def _run(self):
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                return
+            ok = self._write(batch)
+            # Once committed, the rows are visible to the worker's lookups.
+            for md5, _ in batch['meta']:
+                self.pending_md5s.discard(md5)
+            for done in batch['done']:
+                done(ok)
+
+    def close(self):
+        # Writes everything that is queued, and stops the thread.
+        self.flush()
+        self.batches.put(None)
+        self.thread.join()